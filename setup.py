@@ -52,8 +52,14 @@ setup(
             'source_spec = sourcespec.source_spec:main',
             'source_model = sourcespec.source_model:main',
             'source_residuals = sourcespec.source_residuals:main',
+            'source_gsi = sourcespec.source_gsi:main',
             'clipping_detection = sourcespec.clipping_detection:main',
             'plot_sourcepars = sourcespec.plot_sourcepars:main',
+            'source_benchmark = sourcespec.source_benchmark:main',
+            'source_spec_cache = sourcespec.ssp_cache:main',
+            'source_spec_plot = sourcespec.ssp_render:main',
+            'source_spec_export = sourcespec.source_spec_export:main',
+            'source_spec_compare = sourcespec.source_spec_compare:main',
         ]
     },
     version=versioneer.get_version(),
@@ -10,6 +10,10 @@ Two methods are available:
     2.  :func:`clipping_peaks()`: check if trace is clipped, based on the
         number of peaks in the kernel density estimation;
 
+Waveform archives can be screened in batch with the ``batch`` command of the
+command line interface. The resulting table (CSV or SQLite) can be used as a
+skip list by ``source_spec`` (see the "clipping_skip_list" config parameter).
+
 :copyright:
     2023 Claudio Satriano <satriano@ipgp.fr>,
          Kris Vanneste <kris.vanneste@oma.be>
@@ -17,9 +21,23 @@ Two methods are available:
     CeCILL Free Software License Agreement v2.1
     (http://www.cecill.info/licences.en.html)
 """
+import os
+import csv
+import sqlite3
 import numpy as np
-from scipy.stats import gaussian_kde
-from scipy.signal import find_peaks
+from scipy.signal import find_peaks, fftconvolve
+
+# Maximum number of points of the grid used for the binned kernel density
+MAX_KDE_GRID_POINTS = 2**18
+
+# Columns of the clipping table written by the batch screening
+CLIPPING_TABLE_COLUMNS = (
+    'trace_id', 'starttime', 'endtime', 'clipping_score',
+    'npeaks', 'npeaks_clipped', 'clipped'
+)
+# File extensions for which the clipping table is written in SQLite format
+# (CSV is used otherwise)
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
 
 
 def _get_baseline(signal):
@@ -49,12 +67,64 @@ def _preprocess(trace, remove_linear_trend=False, remove_baseline=False):
     return trace, trace_baseline, max_abs_data
 
 
+def _kde_bandwidth(data, bw_method):
+    """
+    Gaussian kernel bandwidth, with the same semantics as
+    :class:`scipy.stats.gaussian_kde`: the data standard deviation times a
+    factor given by the Scott or Silverman rule, or by a scalar.
+    """
+    npts = len(data)
+    if bw_method == 'scott':
+        factor = npts**(-1. / 5)
+    elif bw_method == 'silverman':
+        factor = (npts * 3. / 4)**(-1. / 5)
+    elif np.isscalar(bw_method) and not isinstance(bw_method, str):
+        factor = bw_method
+    else:
+        raise ValueError(f'Invalid bw_method: {bw_method}')
+    return np.std(data, ddof=1) * factor
+
+
+def _binned_kde(data, points, bw_method='scott'):
+    """
+    Gaussian kernel density, evaluated at the given points.
+
+    Data are linearly binned on a regular grid and the binned counts are
+    convolved with the Gaussian kernel via FFT. The cost is
+    O(npts + ngrid log ngrid), instead of O(npts * len(points)) for
+    :class:`scipy.stats.gaussian_kde`.
+    """
+    data = np.asarray(data, dtype=float)
+    bandwidth = _kde_bandwidth(data, bw_method)
+    if not np.isfinite(bandwidth) or bandwidth <= 0:
+        raise ValueError('Unable to compute kernel density: zero bandwidth')
+    # grid extending 5 bandwidths beyond data and evaluation points
+    grid_min = min(data.min(), points.min()) - 5 * bandwidth
+    grid_max = max(data.max(), points.max()) + 5 * bandwidth
+    # at least 8 grid points per bandwidth
+    ngrid = int(np.ceil(8 * (grid_max - grid_min) / bandwidth))
+    ngrid = min(max(ngrid, 1024), MAX_KDE_GRID_POINTS)
+    grid, dx = np.linspace(grid_min, grid_max, ngrid, retstep=True)
+    # linear binning: each sample is shared between its two nearest nodes
+    pos = (data - grid_min) / dx
+    idx = np.clip(np.floor(pos).astype(int), 0, ngrid - 2)
+    frac = pos - idx
+    counts = np.bincount(idx, weights=1 - frac, minlength=ngrid)
+    counts += np.bincount(idx + 1, weights=frac, minlength=ngrid)
+    # Gaussian kernel, truncated at 5 bandwidths
+    nkernel = int(np.ceil(5 * bandwidth / dx))
+    kernel_x = np.arange(-nkernel, nkernel + 1) * dx
+    kernel = np.exp(-0.5 * (kernel_x / bandwidth)**2)
+    kernel /= bandwidth * np.sqrt(2 * np.pi) * len(data)
+    density_grid = fftconvolve(counts, kernel, mode='same')
+    return np.interp(points, grid, density_grid)
+
+
 def _get_kernel_density(trace, min_data, max_data, num_kde_bins=101,
                         bw_method='scott'):
     """Compute the kernel density of a trace."""
-    kde = gaussian_kde(trace.data, bw_method=bw_method)
     density_points = np.linspace(min_data, max_data, num_kde_bins)
-    density = kde.pdf(density_points)
+    density = _binned_kde(trace.data, density_points, bw_method=bw_method)
     density /= np.max(density)
     return density, density_points
 
@@ -175,7 +245,7 @@ def clipping_peaks(trace, sensitivity=3, clipping_percentile=10, debug=False):
     density_weight = density_weight[1:-1]
     npeaks = len(peaks)
     # Clipped peaks are peaks in the edge bins
-    npeaks_clipped = np.sum(
+    npeaks_clipped = sum(
         peak < num_edge_bins or peak > (num_kde_bins - 1 - num_edge_bins)
         for peak in peaks
     )
@@ -252,8 +322,13 @@ def compute_clipping_score(trace, remove_baseline=False, debug=False):
     kernel density (unweighted and weighted), the kernel baseline model,
     and the misfit.
     """
+    max_abs_raw_data = np.max(np.abs(trace.data))
     trace, trace_baseline, max_data = _preprocess(
         trace, remove_linear_trend=True, remove_baseline=remove_baseline)
+    # if the detrended trace is only round-off noise (e.g., constant or
+    # linear trace), return the maximum clipping score
+    if max_data <= 1e-10 * max_abs_raw_data:
+        return 100
     try:
         density, density_points = _get_kernel_density(
             trace, -max_data, max_data, 101)
@@ -285,6 +360,120 @@ def compute_clipping_score(trace, remove_baseline=False, debug=False):
     return clipping_score
 
 
+def _is_sqlite_file(filename):
+    """Check if the clipping table file is in SQLite format."""
+    return os.path.splitext(filename)[1].lower() in SQLITE_EXTENSIONS
+
+
+def write_clipping_table(rows, filename):
+    """
+    Write the results of a batch screening to a CSV or SQLite file.
+
+    The file format is chosen from the file extension: ``.sqlite``,
+    ``.sqlite3`` or ``.db`` for SQLite (table "Clipping"), CSV otherwise.
+    Rows of an existing SQLite file are updated, while a CSV file is
+    overwritten.
+
+    Parameters
+    ----------
+    rows : list of dict
+        Screening results, with keys given by ``CLIPPING_TABLE_COLUMNS``.
+    filename : str
+        Output file name.
+    """
+    if not _is_sqlite_file(filename):
+        with open(filename, 'w', encoding='utf-8', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=CLIPPING_TABLE_COLUMNS)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({
+                    key: '' if row[key] is None else row[key]
+                    for key in CLIPPING_TABLE_COLUMNS})
+        return
+    sql_create = (
+        'CREATE TABLE IF NOT EXISTS Clipping '
+        '(trace_id TEXT, starttime TEXT, endtime TEXT, clipping_score REAL, '
+        'npeaks INT, npeaks_clipped INT, clipped INT, '
+        'PRIMARY KEY(trace_id, starttime));'
+    )
+    placeholders = ', '.join('?' * len(CLIPPING_TABLE_COLUMNS))
+    sql_insert = f'INSERT OR REPLACE INTO Clipping VALUES ({placeholders});'
+    # store "clipped" as an integer, so that it can be queried as 0 or 1
+    values = [
+        tuple(
+            int(row[key]) if key == 'clipped' else row[key]
+            for key in CLIPPING_TABLE_COLUMNS)
+        for row in rows]
+    conn = sqlite3.connect(filename, timeout=60)
+    with conn:
+        conn.execute(sql_create)
+        conn.executemany(sql_insert, values)
+    conn.close()
+
+
+def read_clipping_skip_list(filename):
+    """
+    Read the clipped traces from a clipping table written by
+    :func:`write_clipping_table()`.
+
+    Parameters
+    ----------
+    filename : str
+        Clipping table file name (CSV or SQLite).
+
+    Returns
+    -------
+    skip_list : dict
+        Dictionary mapping trace ids to a list of
+        (:class:`~obspy.core.utcdatetime.UTCDateTime`,
+        :class:`~obspy.core.utcdatetime.UTCDateTime`) tuples: the time spans
+        over which the trace has been found clipped.
+    """
+    # pylint: disable=import-outside-toplevel
+    from obspy import UTCDateTime
+    if not os.path.exists(filename):
+        raise FileNotFoundError(f'File not found: {filename}')
+    if _is_sqlite_file(filename):
+        conn = sqlite3.connect(filename, timeout=60)
+        try:
+            rows = conn.execute(
+                'SELECT trace_id, starttime, endtime FROM Clipping '
+                # older files stored "clipped" as a one-byte blob
+                "WHERE clipped = 1 OR clipped = X'01';").fetchall()
+        finally:
+            conn.close()
+    else:
+        with open(filename, encoding='utf-8', newline='') as fp:
+            reader = csv.DictReader(fp)
+            fieldnames = reader.fieldnames or []
+            missing = set(CLIPPING_TABLE_COLUMNS) - set(fieldnames)
+            if missing:
+                raise ValueError(
+                    f'{filename}: missing columns: '
+                    f'{", ".join(sorted(missing))}')
+            rows = [
+                (row['trace_id'], row['starttime'], row['endtime'])
+                for row in reader if row['clipped'] == 'True'
+            ]
+    skip_list = {}
+    for trace_id, starttime, endtime in rows:
+        skip_list.setdefault(trace_id, []).append(
+            (UTCDateTime(starttime), UTCDateTime(endtime)))
+    return skip_list
+
+
+def listed_as_clipped(skip_list, trace_id, starttime, endtime):
+    """
+    Check if a trace is listed as clipped, over a time span overlapping
+    the given one, in a skip list returned by
+    :func:`read_clipping_skip_list()`.
+    """
+    return any(
+        start <= endtime and end >= starttime
+        for start, end in skip_list.get(trace_id, [])
+    )
+
+
 def _get_plotting_axes():
     """Get matplotlib axes for plotting"""
     # pylint: disable=import-outside-toplevel unused-import
@@ -427,6 +616,49 @@ Two methods are implemented:
         '-p', '--clipping_percentile', type=float, default=10,
         help='Percentile of trace amplitude range (expressed as percentage) '
         'to check for clipping. Default is %(default)s%%.')
+    sp_batch = subparser.add_parser(
+        'batch', help='Screen all the traces in the given files or '
+        'directories (recursively), with parallel workers, and write the '
+        'results to a CSV or SQLite table')
+    sp_batch.add_argument(
+        'path', nargs='+', help='Input file(s) or directories. Files can be '
+        'in any format supported by ObsPy, including compressed files and '
+        'archives (gzip, bzip2, zip, tar)')
+    sp_batch.add_argument(
+        '--traceid', '-t', help='Only process this trace ID. Trace ID can '
+        'contain wildcards (e.g., "IU.ANMO.00.BHZ", "IU.ANMO.00.*", '
+        '"IU.*.00.BHZ", etc.)')
+    sp_batch.add_argument(
+        '--remove_baseline', '-r', action='store_true',
+        help='Remove trace baseline before computing the clipping score',
+        default=False)
+    sp_batch.add_argument(
+        '-o', '--outfile', default='clipping.csv',
+        help='Output file. SQLite format is used if the file extension is '
+        f'one of {", ".join(SQLITE_EXTENSIONS)}, CSV otherwise. '
+        'Default is "%(default)s".')
+    sp_batch.add_argument(
+        '-m', '--method', choices=('clipping_score', 'clipping_peaks'),
+        default='clipping_score',
+        help='Method used to flag a trace as clipped. Both the clipping '
+        'score and the number of peaks are written to the output table. '
+        'Default is %(default)s.')
+    sp_batch.add_argument(
+        '-T', '--threshold', type=float, default=10,
+        help='Clipping score threshold for the "clipping_score" method. '
+        'Default is %(default)s%%.')
+    sp_batch.add_argument(
+        '-s', '--sensitivity', type=int, choices=range(1, 6), default=3,
+        help='Sensitivity level for the "clipping_peaks" method, from 1 '
+        '(least sensitive) to 5 (most sensitive). Default is %(default)s.')
+    sp_batch.add_argument(
+        '-p', '--clipping_percentile', type=float, default=10,
+        help='Percentile of trace amplitude range (expressed as percentage) '
+        'to check for clipping, for the "clipping_peaks" method. '
+        'Default is %(default)s%%.')
+    sp_batch.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='Number of parallel workers. Default is the number of CPUs.')
     args = parser.parse_args()
     if args.command is None:
         parser.print_usage(sys.stderr)
@@ -470,11 +702,135 @@ def _run_clipping_score(trace, args):
     print(f'{trace.id} - clipping score: {color}{score:.2f}%{RESET}')
 
 
+def _screen_trace(trace, args):
+    """Compute clipping score and peaks of a trace, for batch mode"""
+    score = compute_clipping_score(trace, args.remove_baseline)
+    peaks_clipped = False
+    npeaks = npeaks_clipped = None
+    if args.clipping_percentile > 0:
+        try:
+            peaks_clipped, properties = clipping_peaks(
+                trace, args.sensitivity, args.clipping_percentile)
+            npeaks = int(properties['npeaks'])
+            npeaks_clipped = int(properties['npeaks_clipped'])
+        except ValueError:
+            # kernel density fails for flat traces
+            peaks_clipped = True
+    if args.method == 'clipping_score':
+        clipped = bool(score > args.threshold)
+    else:
+        clipped = bool(peaks_clipped)
+    return {
+        'trace_id': trace.id,
+        'starttime': str(trace.stats.starttime),
+        'endtime': str(trace.stats.endtime),
+        'clipping_score': round(float(score), 2),
+        'npeaks': npeaks,
+        'npeaks_clipped': npeaks_clipped,
+        'clipped': clipped,
+    }
+
+
+def _screen_file(filename, args):
+    """Screen all the traces in a file, for batch mode"""
+    # pylint: disable=import-outside-toplevel
+    from obspy import read
+    try:
+        st = read(filename)
+    except Exception:
+        # not a waveform file
+        return []
+    if args.traceid is not None:
+        st = st.select(id=args.traceid)
+    rows = []
+    for tr in st:
+        if not tr.stats.npts:
+            continue
+        rows.append(_screen_trace(tr, args))
+    return rows
+
+
+def _find_files(paths, exclude=None):
+    """
+    Find all the files in the given paths, walking directories.
+
+    Files in ``exclude`` (e.g., the output table and its SQLite journals)
+    are skipped when walking directories.
+    """
+    exclude = {os.path.abspath(filename) for filename in exclude or []}
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                dirs.sort()
+                files += [
+                    os.path.join(root, filename)
+                    for filename in sorted(filenames)
+                    if not filename.startswith('.')
+                    and os.path.abspath(os.path.join(root, filename))
+                    not in exclude]
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            print(f'Error: no such file or directory: {path}')
+    return files
+
+
+def _run_batch(args):
+    """Run batch screening and write the results table"""
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    if args.clipping_percentile < 0 or args.clipping_percentile > 100:
+        raise ValueError('clipping_percentile must be between 0 and 100')
+    outfiles = [args.outfile] + [
+        f'{args.outfile}{suffix}' for suffix in ('-journal', '-wal', '-shm')]
+    files = _find_files(args.path, exclude=outfiles)
+    if not files:
+        print('No files found')
+        return
+    n_jobs = args.jobs or os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(files)))
+    print(f'Screening {len(files)} files on {n_jobs} parallel job(s)...')
+    rows = []
+    if n_jobs == 1:
+        for file in files:
+            rows += _screen_file(file, args)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {
+                executor.submit(_screen_file, file, args): file
+                for file in files
+            }
+            for future in as_completed(futures):
+                try:
+                    rows += future.result()
+                except Exception as msg:
+                    print(f'Error screening file {futures[future]}: {msg}')
+    if not rows:
+        print('No traces found')
+        return
+    rows.sort(key=lambda row: (row['trace_id'], row['starttime']))
+    for row in rows:
+        if row['clipped']:
+            print(
+                f'{row["trace_id"]} {row["starttime"]} - {row["endtime"]} - '
+                f'clipping score: {row["clipping_score"]:.2f}% - '
+                f'{RED}clipped!{RESET}')
+    nclipped = sum(row['clipped'] for row in rows)
+    write_clipping_table(rows, args.outfile)
+    print(
+        f'{len(rows)} traces screened, {nclipped} clipped. '
+        f'Results written to file: {args.outfile}')
+
+
 def _command_line_interface():
     """Command line interface"""
     # pylint: disable=import-outside-toplevel
     from obspy import read, Stream
     args = _parse_arguments()
+    if args.command == 'batch':
+        _run_batch(args)
+        return
     st = Stream()
     for file in args.infile:
         try:
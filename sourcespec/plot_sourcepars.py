@@ -18,7 +18,8 @@ import os
 import sqlite3
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
+from sourcespec.ssp_db_definitions import SUMMARY_BIN_WIDTH
+from sourcespec.ssp_db_summary import SUMMARY_TABLES, rebuild_summary_tables
 
 valid_plot_types = [
     'fc', 'Er', 'ssd', 'ra', 'Mo', 't_star', 'Qo', 'sigma_a',
@@ -98,13 +99,29 @@ def fc_mw_function(mw, a, b):
     return a / 3. + b * mw
 
 
-def calc_r2(x, y, yerr, a, b):
-    """Coefficient of determination."""
-    y_mean = np.mean(y)
-    y_calc = fc_mw_function(x, a, b)
-    SS_tot = np.sum(((y - y_mean) / yerr)**2.)
-    SS_res = np.sum(((y - y_calc) / yerr)**2.)
-    return 1 - SS_res / SS_tot
+def fit_fc_mw_function(sums, slope=False):
+    """
+    Least-squares fit of fc_mw_function() to (mw, y) points.
+
+    The fit is computed from the sufficient statistics of the points:
+    (n, sum(mw), sum(y), sum(mw**2), sum(mw*y), sum(y**2)).
+    If slope is False, b is fixed to -0.5.
+
+    Returns a, b and the coefficient of determination.
+    """
+    n, sum_x, sum_y, sum_xx, sum_xy, sum_yy = sums
+    if slope:
+        b = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x**2)
+    else:
+        b = -0.5
+    # intercept of the linear function: a / 3
+    c = (sum_y - b * sum_x) / n
+    SS_tot = sum_yy - sum_y**2 / n
+    SS_res = (
+        sum_yy + n * c**2 + b**2 * sum_xx
+        - 2 * c * sum_y - 2 * b * sum_xy + 2 * c * b * sum_x
+    )
+    return 3 * c, b, 1 - SS_res / SS_tot
 
 
 def parse_args():
@@ -169,6 +186,18 @@ def parse_args():
         '-w', '--wave_type', default='S',
         help='Wave type. Only used for plots involving "fc". '
              'One of "P", "S", "SV" or "SH". Default is "S".')
+    parser.add_argument(
+        '--no_summaries', default=False, action='store_true',
+        help='Do not use the summary tables of the sqlite file for '
+             '2D histograms: always read all the events. '
+             'Summary tables store event counts in bins of '
+             f'{SUMMARY_BIN_WIDTH} in Mw and in the log10 of the parameter: '
+             'each summary bin is counted in the histogram bin containing '
+             'its center, so histograms are approximated when histogram '
+             f'bin edges are not multiples of {SUMMARY_BIN_WIDTH}')
+    parser.add_argument(
+        '--rebuild_summaries', default=False, action='store_true',
+        help='Rebuild the summary tables of the sqlite file and exit')
     args = parser.parse_args()
     if args.plot_type not in valid_plot_types:
         msg = f'Plot type must be one of {valid_plot_types_str}'
@@ -182,21 +211,59 @@ def parse_args():
     return args
 
 
-def query_event_params_into_numpy(cursor, param, param_type, query_condition):
+# Parameters loaded from the Events table: (attribute, column, dtype).
+# "{stat}" in column names is replaced by the chosen statistics.
+EVENT_PARAMS = [
+    ('evids', 'evid', object),
+    ('vp', 'vp', np.float64),
+    ('vs', 'vs', np.float64),
+    ('rho', 'rho', np.float64),
+    ('wave_type', 'wave_type', object),
+    ('nsta', 'nobs', np.int32),
+    ('Mo', 'Mo_{stat}', np.float64),
+] + [
+    (f'{attr}{suffix}', f'{param}_{{stat}}{suffix}', np.float64)
+    for attr, param in [
+        ('mw', 'Mw'), ('fc', 'fc'), ('Er', 'Er'), ('ssd', 'ssd'),
+        ('ra', 'ra'), ('sigma_a', 'sigma_a'), ('t_star', 't_star'),
+        ('Qo', 'Qo')
+    ]
+    for suffix in ['', '_err_minus', '_err_plus']
+]
+
+
+def query_event_params_into_numpy(cursor, stat, runid=None):
     """
-    Query a parameter from the Events table and return it as a numpy array.
+    Query all the event parameters from the Events table, using a single
+    query, and return them as a numpy structured array.
+
+    Fields of the structured array are named after the attributes of
+    :class:`Params`. NULL values are converted to NaN for float fields.
     """
-    query = f'select {param} from Events {query_condition} order by evid,runid'
-    cursor.execute(query)
-    result = np.array(cursor.fetchall())
+    columns = ', '.join(
+        f'{column.format(stat=stat)} AS {attr}'
+        for attr, column, _ in EVENT_PARAMS
+    )
+    query = f'SELECT {columns} FROM Events'
+    query_params = ()
+    if runid is not None:
+        query += ' WHERE runid = ?'
+        query_params = (runid,)
+    query += ' ORDER BY evid, runid'
+    cursor.execute(query, query_params)
+    dtype = [(attr, dtype) for attr, _, dtype in EVENT_PARAMS]
+    result = np.fromiter(cursor, dtype=dtype)
     if len(result) == 0:
         raise ValueError('No events found')
-    return result[:, 0].astype(param_type)
+    return result
 
 
 class Params():
     """
     Class to handle the parameters from a sqlite file.
+
+    Event parameters are stored in a numpy structured array and are
+    accessible as attributes (e.g., ``params.mw``).
     """
     def __init__(self, args):
         """
@@ -204,77 +271,25 @@ class Params():
         """
         self.args = args
         self.sqlite_file = args.sqlite_file
-        self.runid = runid = args.runid
-        self.stat = stat = args.statistics
+        self.runid = args.runid
+        self.stat = args.statistics
         self._open_db(self.sqlite_file)
-        query_condition = f'where runid="{runid}"' if runid is not None else ''
-        self.evids = query_event_params_into_numpy(
-            self.cur, 'evid', str, query_condition)
-        self.vp = query_event_params_into_numpy(
-            self.cur, 'vp', np.float64, query_condition)
-        self.vs = query_event_params_into_numpy(
-            self.cur, 'vs', np.float64, query_condition)
-        self.rho = query_event_params_into_numpy(
-            self.cur, 'rho', np.float64, query_condition)
-        self.wave_type = query_event_params_into_numpy(
-            self.cur, 'wave_type', str, query_condition)
-        self.nsta = query_event_params_into_numpy(
-            self.cur, 'nobs', np.int32, query_condition)
-        self.Mo = query_event_params_into_numpy(
-            self.cur, f'Mo_{stat}', np.float64, query_condition)
-        self.mw = query_event_params_into_numpy(
-            self.cur, f'Mw_{stat}', np.float64, query_condition)
-        self.mw_err_minus = query_event_params_into_numpy(
-            self.cur, f'Mw_{stat}_err_minus', np.float64, query_condition)
-        self.mw_err_plus = query_event_params_into_numpy(
-            self.cur, f'Mw_{stat}_err_plus', np.float64, query_condition)
-        self.fc = query_event_params_into_numpy(
-            self.cur, f'fc_{stat}', np.float64, query_condition)
-        self.fc_err_minus = query_event_params_into_numpy(
-            self.cur, f'fc_{stat}_err_minus', np.float64, query_condition)
-        self.fc_err_plus = query_event_params_into_numpy(
-            self.cur, f'fc_{stat}_err_plus', np.float64, query_condition)
-        self.Er = query_event_params_into_numpy(
-            self.cur, f'Er_{stat}', np.float64, query_condition)
-        self.Er_err_minus = query_event_params_into_numpy(
-            self.cur, f'Er_{stat}_err_minus', np.float64, query_condition)
-        self.Er_err_plus = query_event_params_into_numpy(
-            self.cur, f'Er_{stat}_err_plus', np.float64, query_condition)
-        self.ssd = query_event_params_into_numpy(
-            self.cur, f'ssd_{stat}', np.float64, query_condition)
-        self.ssd_err_minus = query_event_params_into_numpy(
-            self.cur, f'ssd_{stat}_err_minus', np.float64, query_condition)
-        self.ssd_err_plus = query_event_params_into_numpy(
-            self.cur, f'ssd_{stat}_err_plus', np.float64, query_condition)
-        self.ra = query_event_params_into_numpy(
-            self.cur, f'ra_{stat}', np.float64, query_condition)
-        self.ra_err_minus = query_event_params_into_numpy(
-            self.cur, f'ra_{stat}_err_minus', np.float64, query_condition)
-        self.ra_err_plus = query_event_params_into_numpy(
-            self.cur, f'ra_{stat}_err_plus', np.float64, query_condition)
-        self.sigma_a = query_event_params_into_numpy(
-            self.cur, f'sigma_a_{stat}', np.float64, query_condition)
-        self.sigma_a_err_minus = query_event_params_into_numpy(
-            self.cur, f'sigma_a_{stat}_err_minus', np.float64, query_condition)
-        self.sigma_a_err_plus = query_event_params_into_numpy(
-            self.cur, f'sigma_a_{stat}_err_plus', np.float64, query_condition)
-        self.t_star = query_event_params_into_numpy(
-            self.cur, f't_star_{stat}', np.float64, query_condition)
-        self.t_star_err_minus = query_event_params_into_numpy(
-            self.cur, f't_star_{stat}_err_minus', np.float64, query_condition)
-        self.t_star_err_plus = query_event_params_into_numpy(
-            self.cur, f't_star_{stat}_err_plus', np.float64, query_condition)
-        self.Qo = query_event_params_into_numpy(
-            self.cur, f'Qo_{stat}', np.float64, query_condition)
-        self.Qo_err_minus = query_event_params_into_numpy(
-            self.cur, f'Qo_{stat}_err_minus', np.float64, query_condition)
-        self.Qo_err_plus = query_event_params_into_numpy(
-            self.cur, f'Qo_{stat}_err_plus', np.float64, query_condition)
+        self.data = query_event_params_into_numpy(
+            self.cur, self.stat, self.runid)
         self.cur.close()
         # other attributes
         self.nbins_x = None
         self.nbins_y = None
 
+    def __getattr__(self, name):
+        """Return event parameters as attributes."""
+        # only called when the attribute is not found by normal lookup
+        data = self.__dict__.get('data')
+        if data is not None and name in data.dtype.names:
+            return data[name]
+        raise AttributeError(
+            f'{type(self).__name__!r} object has no attribute {name!r}')
+
     def _open_db(self, sqlite_file):
         """
         Open the sqlite file and check that it contains the required tables.
@@ -300,42 +315,14 @@ class Params():
 
     def skip_events(self, idx):
         """Skip events with index idx."""
-        self.evids = np.delete(self.evids, idx)
-        self.vp = np.delete(self.vp, idx)
-        self.vs = np.delete(self.vs, idx)
-        self.rho = np.delete(self.rho, idx)
-        self.wave_type = np.delete(self.wave_type, idx)
-        self.nsta = np.delete(self.nsta, idx)
-        self.Mo = np.delete(self.Mo, idx)
-        self.mw = np.delete(self.mw, idx)
-        self.mw_err_minus = np.delete(self.mw_err_minus, idx)
-        self.mw_err_plus = np.delete(self.mw_err_plus, idx)
-        self.fc = np.delete(self.fc, idx)
-        self.fc_err_minus = np.delete(self.fc_err_minus, idx)
-        self.fc_err_plus = np.delete(self.fc_err_plus, idx)
-        self.Er = np.delete(self.Er, idx)
-        self.Er_err_minus = np.delete(self.Er_err_minus, idx)
-        self.Er_err_plus = np.delete(self.Er_err_plus, idx)
-        self.ssd = np.delete(self.ssd, idx)
-        self.ssd_err_minus = np.delete(self.ssd_err_minus, idx)
-        self.ssd_err_plus = np.delete(self.ssd_err_plus, idx)
-        self.ra = np.delete(self.ra, idx)
-        self.ra_err_minus = np.delete(self.ra_err_minus, idx)
-        self.ra_err_plus = np.delete(self.ra_err_plus, idx)
-        self.sigma_a = np.delete(self.sigma_a, idx)
-        self.sigma_a_err_minus = np.delete(self.sigma_a_err_minus, idx)
-        self.sigma_a_err_plus = np.delete(self.sigma_a_err_plus, idx)
-        self.t_star = np.delete(self.t_star, idx)
-        self.t_star_err_minus = np.delete(self.t_star_err_minus, idx)
-        self.t_star_err_plus = np.delete(self.t_star_err_plus, idx)
-        self.Qo = np.delete(self.Qo, idx)
-        self.Qo_err_minus = np.delete(self.Qo_err_minus, idx)
-        self.Qo_err_plus = np.delete(self.Qo_err_plus, idx)
+        keep = np.ones(len(self.data), dtype=bool)
+        keep[idx] = False
+        self.data = self.data[keep]
 
     def filter(self, stamin=None, stamax=None, magmin=None, magmax=None,
                ssdmin=None, ssdmax=None, sigmaamin=None, sigmaamax=None):
         """Filter the parameters based on one or more conditions."""
-        cond = np.ones(len(self.nsta)).astype(bool)
+        cond = np.ones(len(self.data), dtype=bool)
         if stamin is not None:
             cond = np.logical_and(cond, self.nsta >= stamin)
         if stamax is not None:
@@ -352,18 +339,87 @@ class Params():
             cond = np.logical_and(cond, self.sigma_a >= sigmaamin)
         if sigmaamax is not None:
             cond = np.logical_and(cond, self.sigma_a <= sigmaamax)
-        self.skip_events(np.where(~cond)[0])
+        self.data = self.data[cond]
+
+    @property
+    def nevents(self):
+        """Number of events."""
+        return len(self.data)
+
+    def _mw_limits(self):
+        """Minimum and maximum magnitude, including errors."""
+        return (
+            np.min(self.mw - self.mw_err_minus),
+            np.max(self.mw + self.mw_err_plus)
+        )
+
+    def _param_limits(self, param):
+        """Minimum and maximum value of a parameter, including errors."""
+        values = getattr(self, param)
+        return (
+            np.min(values - getattr(self, f'{param}_err_minus')),
+            np.max(values + getattr(self, f'{param}_err_plus'))
+        )
+
+    def _mean_velocity(self, wave_type):
+        """Mean velocity (km/s) for the given wave type."""
+        if wave_type == 'P':
+            return np.nanmean(self.vp)
+        if wave_type in ('S', 'SV', 'SH'):
+            return np.nanmean(self.vs)
+        raise ValueError('Wave type must be "P", "S", "SV" or "SH"')
+
+    def _mean_rigidity(self):
+        """Mean rigidity (Pa)."""
+        return np.nanmean((self.vs * 1e3)**2 * self.rho)
+
+    def _param_mw_selection(self, param, wave_type=None):
+        """Mw and param values, for valid values and the given wave type."""
+        mw = self.mw
+        values = getattr(self, param)
+        cond = np.logical_and(np.isfinite(mw), np.isfinite(values))
+        if wave_type is not None:
+            cond = np.logical_and(cond, self.wave_type == wave_type)
+        return mw[cond], values[cond]
+
+    def _histogram2d(self, param, mw_bins, param_bins, wave_type=None):
+        """
+        2D histogram of param vs Mw.
+
+        Returns the counts and the number of values.
+        """
+        mw, values = self._param_mw_selection(param, wave_type)
+        counts, _, _ = np.histogram2d(
+            mw, values, bins=(mw_bins, param_bins))
+        return counts, len(values)
+
+    def _fit_sums(self, param, wave_type=None):
+        """
+        Sufficient statistics for a linear fit of log10(param) vs Mw.
+
+        See fit_fc_mw_function().
+        """
+        mw, values = self._param_mw_selection(param, wave_type)
+        cond = values > 0
+        x = mw[cond]
+        y = np.log10(values[cond])
+        return (
+            len(x), np.sum(x), np.sum(y),
+            np.sum(x**2), np.sum(x * y), np.sum(y**2)
+        )
 
     def _make_mw_axis(self):
         """Make the magnitude axis."""
+        if None in (self.args.magmin, self.args.magmax):
+            mw_min, mw_max = self._mw_limits()
         if self.args.magmin is not None:
             mag_min = self.args.magmin
         else:
-            mag_min = np.floor(np.min(self.mw - self.mw_err_minus))
+            mag_min = np.floor(mw_min)
         if self.args.magmax is not None:
             mag_max = self.args.magmax
         else:
-            mag_max = np.ceil(np.max(self.mw + self.mw_err_plus))
+            mag_max = np.ceil(mw_max)
         xlim_mag = (mag_min, mag_max)
         fig = plt.figure(figsize=(10, 6))
         ax_Mo = fig.add_subplot(111)
@@ -387,7 +443,7 @@ class Params():
     def _set_plot_title(self, ax, nevs=None, extra_text=None):
         """Set the plot title."""
         if nevs is None:
-            nevs = len(self.evids)
+            nevs = self.nevents
         stat_descr = {
             'mean': 'mean',
             'wmean': 'weighted mean',
@@ -485,18 +541,16 @@ class Params():
         self.nbins_y = fc_nbins
         mw_bins = np.linspace(mw_min, mw_max + 0.1, mw_nbins)
         fc_bins = 10**np.linspace(log_fc_min, log_fc_max + 0.1, fc_nbins)
-        cond = self.wave_type == wave_type
-        mw = self.mw[cond]
-        if len(mw) == 0:
+        counts, npoints = self._histogram2d(
+            'fc', mw_bins, fc_bins, wave_type)
+        if npoints == 0:
             raise ValueError(f'No events found for wave type "{wave_type}"')
-        fc = self.fc[cond]
-        counts, _, _ = np.histogram2d(mw, fc, bins=(mw_bins, fc_bins))
         cm = ax.pcolormesh(
             mw_bins[:-1], fc_bins[:-1], counts.T,
             cmap='magma_r', shading='auto')
         cbaxes = fig.add_axes([0.15, 0.15, 0.02, 0.2])
         plt.colorbar(cm, cax=cbaxes, orientation='vertical', label='counts')
-        return len(fc)
+        return npoints
 
     def _2d_hist_Er_mw(self, fig, ax, nbins=None):
         """Plot a 2d histogram of Er vs mw."""
@@ -514,17 +568,14 @@ class Params():
         Er_bins = 10**np.linspace(log_Er_min, log_Er_max + 0.1, Er_nbins)
         self.nbins_x = mw_nbins
         self.nbins_y = Er_nbins
-        # Er can be NaN
-        cond = ~np.isnan(self.Er)
-        mw = self.mw[cond]
-        Er = self.Er[cond]
-        counts, _, _ = np.histogram2d(mw, Er, bins=(mw_bins, Er_bins))
+        # Er can be NaN: NaN values are excluded
+        counts, npoints = self._histogram2d('Er', mw_bins, Er_bins)
         cm = ax.pcolormesh(
             mw_bins[:-1], Er_bins[:-1], counts.T,
             cmap='magma_r', shading='auto')
         cbaxes = fig.add_axes([0.15, 0.15, 0.02, 0.2])
         plt.colorbar(cm, cax=cbaxes, orientation='vertical', label='counts')
-        return len(Er)
+        return npoints
 
     def _2d_hist_ssd_mw(self, fig, ax, nbins=None):
         """Plot a 2d histogram of ssd vs mw."""
@@ -542,8 +593,7 @@ class Params():
         ssd_bins = 10**np.linspace(log_ssd_min, log_ssd_max + 0.1, ssd_nbins)
         self.nbins_x = mw_nbins
         self.nbins_y = ssd_nbins
-        counts, _, _ = np.histogram2d(
-            self.mw, self.ssd, bins=(mw_bins, ssd_bins))
+        counts, _ = self._histogram2d('ssd', mw_bins, ssd_bins)
         cm = ax.pcolormesh(
             mw_bins[:-1], ssd_bins[:-1], counts.T,
             cmap='magma_r', shading='auto')
@@ -613,28 +663,16 @@ class Params():
         annot = Annot(self.mw, self.ssd, self.evids, yformat)
         fig.canvas.mpl_connect('pick_event', annot)
 
-    def _fit_fc_mw(self, vel, ax, slope=False):
+    def _fit_fc_mw(self, vel, ax, slope=False, wave_type='S'):
         """Plot a linear regression of fc vs mw."""
         mag_min, mag_max = ax.get_xlim()
         mw_step = 0.1
         mw_test = np.arange(mag_min, mag_max - 2 * mw_step, mw_step)
-        if slope:
-            f = fc_mw_function
-        else:
-            def f(mw, a):
-                return fc_mw_function(mw, a, -0.5)
-        y = np.log10(self.fc)
-        # pylint: disable=unbalanced-tuple-unpacking
-        popt, _pcov = curve_fit(f, self.mw, y)
-        try:
-            a, b = popt
-        except Exception:
-            a, = popt
-            b = -0.5
+        a, b, r2 = fit_fc_mw_function(
+            self._fit_sums('fc', wave_type), slope)
         print(f'a: {a:.1f} b {b:.1f}:')
         slope = (3 / 2) / b
         print(f'slope: {slope:.1f}')
-        r2 = calc_r2(self.mw, y, np.ones_like(y), a, b)
         print('r2:', r2)
         # print('r2_err:', r2_err)
         delta_sigma = 1. / ((vel * 1000.)**3.) * 10**(a + 9.1 + 0.935)
@@ -666,12 +704,7 @@ class Params():
         fig, ax, ax_Mo = self._make_mw_axis()
         ax_Mo.set_yscale('log')
 
-        if wave_type == 'P':
-            vel = np.nanmean(self.vp)
-        elif wave_type in ('S', 'SV', 'SH'):
-            vel = np.nanmean(self.vs)
-        else:
-            raise ValueError('Wave type must be "P", "S", "SV" or "SH"')
+        vel = self._mean_velocity(wave_type)
         self._stress_drop_curves_fc_mw(vel, ax)
 
         if hist:
@@ -679,7 +712,7 @@ class Params():
         else:
             npoints = self._scatter_fc_mw(fig, ax, wave_type)
         if fit:
-            self._fit_fc_mw(vel, ax, slope=slope)
+            self._fit_fc_mw(vel, ax, slope=slope, wave_type=wave_type)
         extra_text = 'Stress drop curves'
         self._set_plot_title(ax, npoints, extra_text)
         self._add_grid(ax_Mo)
@@ -702,7 +735,7 @@ class Params():
         fig, ax, ax_Mo = self._make_mw_axis()
         ax_Mo.set_yscale('log')
 
-        mu = np.nanmean((self.vs * 1e3)**2 * self.rho)
+        mu = self._mean_rigidity()
         self._apparent_stress_curves_Er_mw(mu, ax)
 
         if hist:
@@ -734,8 +767,7 @@ class Params():
         fig, ax, ax_Mo = self._make_mw_axis()
         ax_Mo.set_yscale('log')
 
-        ssd_min = np.min(self.ssd - self.ssd_err_minus)
-        ssd_max = np.max(self.ssd + self.ssd_err_plus)
+        ssd_min, ssd_max = self._param_limits('ssd')
         ssd_min = 10**(np.floor(np.log10(ssd_min)))
         ssd_max = 10**(np.ceil(np.log10(ssd_max)))
         ax.set_ylim(ssd_min, ssd_max)
@@ -820,20 +852,203 @@ class Params():
         plt.show()
 
 
+class SummaryParams(Params):
+    """
+    Class to handle aggregate parameters from the summary tables
+    of a sqlite file.
+
+    Only 2D histograms and fits of fc, Er and ssd vs Mw can be plotted.
+    Values are binned in steps of SUMMARY_BIN_WIDTH, in Mw and in log10 of
+    the parameter.
+    """
+    def __init__(self, args):
+        """
+        Initialize the class from the summary tables of a sqlite file.
+        """
+        # pylint: disable=super-init-not-called
+        self.args = args
+        self.sqlite_file = args.sqlite_file
+        self.runid = args.runid
+        self.stat = args.statistics
+        self._open_db(self.sqlite_file)
+        runid_condition = ''
+        runid_params = []
+        if self.runid is not None:
+            runid_condition = ' AND runid = ?'
+            runid_params = [self.runid]
+        query_params = [self.stat, *runid_params]
+        self.cur.execute(
+            'SELECT wave_type, SUM(nevents), '
+            'SUM(vp_count), SUM(vp_sum), SUM(vs_count), SUM(vs_sum), '
+            'SUM(mu_count), SUM(mu_sum) '
+            f'FROM SummaryEvents WHERE nevents > 0{runid_condition} '
+            'GROUP BY wave_type', runid_params)
+        self.event_sums = np.array(
+            [row[1:] for row in self.cur.fetchall()], dtype=np.float64
+        ).reshape(-1, 7)
+        if self.nevents == 0:
+            raise ValueError('No events found')
+        self.cur.execute(
+            'SELECT wave_type, param, mw_bin, value_bin, SUM(count) '
+            'FROM SummaryBins '
+            f'WHERE stat = ?{runid_condition} '
+            'GROUP BY wave_type, param, mw_bin, value_bin', query_params)
+        self.bins = np.fromiter(self.cur, dtype=[
+            ('wave_type', object), ('param', object),
+            ('mw_bin', np.int64), ('value_bin', np.int64),
+            ('count', np.int64)])
+        self.cur.execute(
+            'SELECT wave_type, param, SUM(n), SUM(sum_x), SUM(sum_y), '
+            'SUM(sum_xx), SUM(sum_xy), SUM(sum_yy) '
+            'FROM SummaryFits '
+            f'WHERE stat = ?{runid_condition} '
+            'GROUP BY wave_type, param', query_params)
+        self.fit_sums = {
+            (wave_type, param): sums
+            for wave_type, param, *sums in self.cur.fetchall()
+        }
+        self.cur.close()
+        # other attributes
+        self.nbins_x = None
+        self.nbins_y = None
+
+    @property
+    def nevents(self):
+        """Number of events."""
+        return int(np.sum(self.event_sums[:, 0]))
+
+    def _select_bins(self, param, wave_type=None):
+        """Bins for the given parameter and wave type."""
+        cond = self.bins['param'] == param
+        if wave_type is not None:
+            cond = np.logical_and(cond, self.bins['wave_type'] == wave_type)
+        return self.bins[cond]
+
+    def _mw_limits(self):
+        """Minimum and maximum magnitude (bin edges)."""
+        mw_bin = self.bins['mw_bin']
+        return (
+            np.min(mw_bin) * SUMMARY_BIN_WIDTH,
+            (np.max(mw_bin) + 1) * SUMMARY_BIN_WIDTH
+        )
+
+    def _param_limits(self, param):
+        """Minimum and maximum value of a parameter (bin edges)."""
+        value_bin = self._select_bins(param)['value_bin']
+        return (
+            10**(np.min(value_bin) * SUMMARY_BIN_WIDTH),
+            10**((np.max(value_bin) + 1) * SUMMARY_BIN_WIDTH)
+        )
+
+    def _mean_velocity(self, wave_type):
+        """Mean velocity (km/s) for the given wave type."""
+        if wave_type == 'P':
+            count, total = np.sum(self.event_sums[:, 1:3], axis=0)
+        elif wave_type in ('S', 'SV', 'SH'):
+            count, total = np.sum(self.event_sums[:, 3:5], axis=0)
+        else:
+            raise ValueError('Wave type must be "P", "S", "SV" or "SH"')
+        return total / count if count > 0 else np.nan
+
+    def _mean_rigidity(self):
+        """Mean rigidity (Pa)."""
+        count, total = np.sum(self.event_sums[:, 5:7], axis=0)
+        return total / count if count > 0 else np.nan
+
+    def _histogram2d(self, param, mw_bins, param_bins, wave_type=None):
+        """
+        2D histogram of param vs Mw, from the summary bins.
+
+        Each summary bin is assigned to the histogram bin containing its
+        center: this is an approximation of the histogram of the events,
+        unless the histogram bin edges are multiples of SUMMARY_BIN_WIDTH.
+        Returns the counts and the number of values.
+        """
+        bins = self._select_bins(param, wave_type)
+        mw = (bins['mw_bin'] + 0.5) * SUMMARY_BIN_WIDTH
+        values = 10**((bins['value_bin'] + 0.5) * SUMMARY_BIN_WIDTH)
+        counts, _, _ = np.histogram2d(
+            mw, values, bins=(mw_bins, param_bins), weights=bins['count'])
+        return counts, int(np.sum(bins['count']))
+
+    def _fit_sums(self, param, wave_type=None):
+        """
+        Sufficient statistics for a linear fit of log10(param) vs Mw.
+
+        See fit_fc_mw_function().
+        """
+        sums = np.zeros(6)
+        for (_wave_type, _param), _sums in self.fit_sums.items():
+            if _param == param and wave_type in (None, _wave_type):
+                sums += _sums
+        return sums
+
+
+def _use_summary_tables(args):
+    """Check whether the plot can be made from the summary tables."""
+    if args.no_summaries or not args.hist:
+        return False
+    if args.plot_type not in ('fc_mw', 'Er_mw', 'ssd_mw'):
+        return False
+    # summary tables cannot be filtered by event
+    filters = (
+        args.stamin, args.stamax, args.magmin, args.magmax,
+        args.ssdmin, args.ssdmax, args.sigmaamin, args.sigmaamax)
+    if any(f is not None for f in filters) or os.path.exists('problems.txt'):
+        return False
+    if not os.path.isfile(args.sqlite_file):
+        return False
+    try:
+        conn = sqlite3.connect(args.sqlite_file)
+        tables = [t[0] for t in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table';")]
+        conn.close()
+    except sqlite3.DatabaseError:
+        return False
+    if not set(SUMMARY_TABLES).issubset(tables):
+        print(
+            'Summary tables not found: reading all the events. '
+            'Use "--rebuild_summaries" to create them.')
+        return False
+    return True
+
+
+def rebuild_summaries(sqlite_file):
+    """Rebuild the summary tables of a sqlite file."""
+    if not os.path.isfile(sqlite_file):
+        raise FileNotFoundError(f'File "{sqlite_file}" not found')
+    conn = sqlite3.connect(sqlite_file, timeout=60)
+    try:
+        with conn:
+            nevents = rebuild_summary_tables(conn.cursor())
+    except sqlite3.DatabaseError as e:
+        raise ValueError(
+            f'Unable to rebuild summary tables in "{sqlite_file}": {e}'
+        ) from e
+    finally:
+        conn.close()
+    print(f'Summary tables rebuilt from {nevents} events')
+
+
 def run():
     """Run the script."""
     args = parse_args()
-    params = Params(args)
-
-    if os.path.exists('problems.txt'):
-        _skip_events(params)
-    params.filter(
-        stamin=args.stamin, stamax=args.stamax,
-        magmin=args.magmin, magmax=args.magmax,
-        ssdmin=args.ssdmin, ssdmax=args.ssdmax,
-        sigmaamin=args.sigmaamin, sigmaamax=args.sigmaamax,
-    )
-    if len(params.evids) == 0:
+    if args.rebuild_summaries:
+        rebuild_summaries(args.sqlite_file)
+        return
+    if _use_summary_tables(args):
+        params = SummaryParams(args)
+    else:
+        params = Params(args)
+        if os.path.exists('problems.txt'):
+            _skip_events(params)
+        params.filter(
+            stamin=args.stamin, stamax=args.stamax,
+            magmin=args.magmin, magmax=args.magmax,
+            ssdmin=args.ssdmin, ssdmax=args.ssdmax,
+            sigmaamin=args.sigmaamin, sigmaamax=args.sigmaamax,
+        )
+    if params.nevents == 0:
         raise ValueError('No events found')
 
     if args.plot_type == 'fc_mw':
@@ -3,6 +3,10 @@
 """
 Save Matplotlib figure. Optimize PNG format using PIL.
 
+PNG optimization (color quantization) and writing are performed in
+background threads, so that plotting can go on. Call flush_figures() to
+make sure that all the figures are written to disk.
+
 :copyright:
     2022-2023 Claudio Satriano <satriano@ipgp.fr>
 :license:
@@ -10,9 +14,14 @@ Save Matplotlib figure. Optimize PNG format using PIL.
     (http://www.cecill.info/licences.en.html)
 """
 import io
+import os
+import atexit
 import logging
 import warnings
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 # Reduce logging level for PIL to avoid DEBUG messages
 pil_logger = logging.getLogger('PIL')
 pil_logger.setLevel(logging.WARNING)
@@ -23,13 +32,45 @@ mpl_logger.setLevel(logging.WARNING)
 # alpha channel anyway (see below)
 warnings.filterwarnings('ignore', message='Palette images with Transparency')
 
+# Number of background threads for PNG optimization and writing
+WRITER_THREADS = 2
+# Maximum number of rendered figures waiting to be written:
+# savefig() blocks when this number is reached, to cap memory usage
+MAX_PENDING_FIGURES = 8
 
-def savefig(fig, figfile, fmt, quantize_colors=True, **kwargs):
-    """Save Matplotlib figure. Optimize PNG format using PIL."""
-    if fmt == 'png':
-        buf = io.BytesIO()
-        fig.savefig(buf, format='png', **kwargs)
-        buf.seek(0)
+_WRITER = None
+# Figures being written: (future, figure file) tuples
+_PENDING = []
+_SLOTS = threading.BoundedSemaphore(MAX_PENDING_FIGURES)
+
+
+def _reset_writer():
+    """Forget the writer threads of the parent, after a fork."""
+    # pylint: disable=global-statement
+    global _WRITER
+    global _SLOTS
+    _WRITER = None
+    _PENDING.clear()
+    _SLOTS = threading.BoundedSemaphore(MAX_PENDING_FIGURES)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_writer)
+
+
+def _get_writer():
+    """Return the writer thread pool, creating it at the first call."""
+    # pylint: disable=global-statement
+    global _WRITER
+    if _WRITER is None:
+        _WRITER = ThreadPoolExecutor(
+            max_workers=WRITER_THREADS, thread_name_prefix='savefig')
+    return _WRITER
+
+
+def _write_png(buf, figfile, quantize_colors, slots):
+    """Optimize a PNG image and write it to disk."""
+    try:
         img = Image.open(buf)
         if quantize_colors:
             # pylint: disable=maybe-no-member
@@ -39,5 +80,42 @@ def savefig(fig, figfile, fmt, quantize_colors=True, **kwargs):
             img = img.convert('RGB')
         img.save(figfile, optimize=True)
         img.close()
+    finally:
+        slots.release()
+
+
+def savefig(fig, figfile, fmt, quantize_colors=True, **kwargs):
+    """
+    Save Matplotlib figure. Optimize PNG format using PIL.
+
+    PNG figures are rendered immediately, but optimized and written in
+    background. Call :func:`flush_figures()` before using the figure file.
+    """
+    if fmt == 'png':
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', **kwargs)
+        buf.seek(0)
+        slots = _SLOTS
+        slots.acquire()
+        try:
+            future = _get_writer().submit(
+                _write_png, buf, figfile, quantize_colors, slots)
+        except Exception:
+            slots.release()
+            raise
+        _PENDING.append((future, figfile))
     else:
         fig.savefig(figfile, **kwargs)
+
+
+def flush_figures():
+    """Wait for all the figures to be written to disk."""
+    while _PENDING:
+        future, figfile = _PENDING.pop(0)
+        try:
+            future.result()
+        except Exception as msg:
+            logger.error(f'Unable to write figure {figfile}: {msg}')
+
+
+atexit.register(flush_figures)
@@ -0,0 +1,532 @@
+# -*- coding: utf8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Benchmark SourceSpec processing stages on synthetic events.
+
+Synthetic multi-station events are built in the spectral domain, using the
+same spectral model as ``source_model``, and then processed by the actual
+SourceSpec functions (spectral smoothing, weighting, inversion, radiated
+energy and summary statistics). Each stage is timed, for each inversion
+algorithm, and the inverted parameters are compared to the known truth.
+
+Results are written to a JSON file, which can be used as a baseline
+for a later run, to prove that speedups do not change the results.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import sys
+import os
+import json
+import time
+import logging
+import platform
+from argparse import ArgumentParser, Namespace
+from copy import deepcopy
+from datetime import datetime
+import numpy as np
+import scipy
+from obspy.core import Stream
+from obspy.core.util import AttribDict
+from obspy.geodetics import kilometers2degrees
+from sourcespec._version import get_versions
+from sourcespec.spectrum import Spectrum
+from sourcespec.ssp_setup import configure
+from sourcespec.ssp_event import SSPEvent, SSPHypocenter
+from sourcespec.ssp_util import MediumProperties, mag_to_moment, moment_to_mag
+from sourcespec.ssp_spectral_model import spectral_model
+from sourcespec.ssp_build_spectra import (
+    _cut_spectrum, _displacement_to_moment, _smooth_spectrum,
+    _check_spectral_sn_ratio, _ignore_spectrum,
+    _build_weight_spectral_stream, SpectrumIgnored)
+from sourcespec.ssp_inversion import spectral_inversion
+from sourcespec.ssp_radiated_energy import radiated_energy_and_apparent_stress
+from sourcespec.ssp_summary_statistics import compute_summary_statistics
+
+ALGORITHMS = ('LM', 'TNC', 'BH', 'MS', 'GS', 'IS')
+# Station parameters stored in the output file, for comparison between runs
+COMPARED_PARAMS = ('Mw', 'fc', 't_star', 'Er')
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    """
+    parser = ArgumentParser(
+        description='Benchmark SourceSpec processing stages on synthetic '
+                    'events.')
+    parser.add_argument(
+        '-c', '--configfile', dest='config_file', action='store',
+        default=None,
+        help='config file for the benchmark runs (default: use the '
+             'default SourceSpec configuration)', metavar='FILE')
+    parser.add_argument(
+        '-a', '--algorithms', dest='algorithms', action='store',
+        default=','.join(ALGORITHMS),
+        help='comma-separated list of inversion algorithms to benchmark '
+             f'(default="{",".join(ALGORITHMS)}")')
+    parser.add_argument(
+        '-n', '--nstations', dest='nstations', type=int, action='store',
+        default=10, help='number of synthetic stations (default=10)',
+        metavar='NUMBER')
+    parser.add_argument(
+        '-s', '--sampling_rate', dest='sampling_rate', type=float,
+        action='store', default=100.,
+        help='sampling rate of the synthetic records, in Hz (default=100)',
+        metavar='FLOAT')
+    parser.add_argument(
+        '-w', '--win_length', dest='win_length', type=float, action='store',
+        default=10., help='length of the signal window, in seconds '
+        '(default=10)', metavar='FLOAT')
+    parser.add_argument(
+        '-N', '--noise_level', dest='noise_level', type=float,
+        action='store', default=1e-3,
+        help='amplitude of the (white) noise spectrum, relative to the '
+             'low-frequency spectral plateau (default=1e-3)',
+        metavar='FLOAT')
+    parser.add_argument(
+        '-m', '--mag', dest='mag', type=float, action='store', default=3.,
+        help='moment magnitude of the synthetic event (default=3)',
+        metavar='FLOAT')
+    parser.add_argument(
+        '-k', '--fc', dest='fc', type=float, action='store', default=5.,
+        help='corner frequency of the synthetic event, in Hz (default=5)',
+        metavar='FLOAT')
+    parser.add_argument(
+        '-Q', '--Qo', dest='Qo', type=float, action='store', default=300.,
+        help='quality factor used to compute station t_star values '
+             '(default=300)', metavar='FLOAT')
+    parser.add_argument(
+        '-d', '--dist_range', dest='dist_range', action='store',
+        default='10,100',
+        help='comma-separated min and max hypocentral distance, in km '
+             '(default="10,100")')
+    parser.add_argument(
+        '-r', '--repeat', dest='repeat', type=int, action='store',
+        default=1, help='number of times each stage is timed; the best time '
+        'is retained (default=1)', metavar='NUMBER')
+    parser.add_argument(
+        '-S', '--seed', dest='seed', type=int, action='store', default=42,
+        help='seed for the random number generator (default=42)',
+        metavar='NUMBER')
+    parser.add_argument(
+        '-o', '--outfile', dest='outfile', action='store',
+        default='sourcespec_benchmark.json',
+        help='output JSON file (default="sourcespec_benchmark.json")',
+        metavar='FILE')
+    parser.add_argument(
+        '-b', '--baseline', dest='baseline', action='store', default=None,
+        help='JSON file from a previous benchmark run, to compare timings '
+             'and results with', metavar='FILE')
+    parser.add_argument(
+        '-v', '--verbose', dest='verbose', action='store_true',
+        default=False, help='show SourceSpec log messages')
+    args = parser.parse_args()
+    args.algorithms = [a.strip().upper() for a in args.algorithms.split(',')]
+    for algorithm in args.algorithms:
+        if algorithm not in ALGORITHMS:
+            sys.exit(f'Error: unknown inversion algorithm: {algorithm}')
+    try:
+        args.dist_range = tuple(map(float, args.dist_range.split(',')))
+        assert len(args.dist_range) == 2
+    except (ValueError, AssertionError):
+        sys.exit(f'Error: invalid distance range: {args.dist_range}')
+    if args.nstations < 1:
+        sys.exit('Error: at least one station is required')
+    if args.repeat < 1:
+        sys.exit('Error: "repeat" must be at least 1')
+    return args
+
+
+def _configure(args):
+    """Build a SourceSpec config object for the benchmark runs."""
+    options = Namespace(
+        sampleconf=False, updateconf=None, updatedb=None,
+        samplesspevent=False, config_file=args.config_file,
+        outdir='sspec_out', trace_path=None, qml_file=None, hypo_file=None,
+        pick_file=None, station_metadata=None, evid=None, evname=None,
+        station=None, run_id=None, run_id_subdir=False)
+    # No plot is produced during benchmarks
+    conf_overrides = {
+        'plot_show': False,
+        'plot_save': False,
+        'plot_station_map': False,
+        'html_report': False
+    }
+    return configure(
+        options, progname='source_benchmark',
+        config_overrides=conf_overrides)
+
+
+def _synth_event(config):
+    """Create the synthetic event and attach it to config."""
+    event = SSPEvent()
+    event.event_id = 'synth'
+    event.name = 'SourceSpec benchmark'
+    event.hypocenter = SSPHypocenter(
+        longitude={'value': 0., 'units': 'deg'},
+        latitude={'value': 0., 'units': 'deg'},
+        depth={'value': 10., 'units': 'km'},
+        origin_time='2023-01-01T00:00:00')
+    hypo = event.hypocenter
+    medium_properties = MediumProperties(
+        hypo.longitude.value_in_deg, hypo.latitude.value_in_deg,
+        hypo.depth.value_in_km, config)
+    hypo.vp = medium_properties.get(mproperty='vp', where='source')
+    hypo.vs = medium_properties.get(mproperty='vs', where='source')
+    hypo.rho = medium_properties.get(mproperty='rho', where='source')
+    config.event = event
+    return event
+
+
+def _synth_spectra(config, args, rng):
+    """
+    Build signal and noise spectra for a synthetic multi-station event.
+
+    Returns the signal and noise spectral streams, and a dictionary with
+    the true parameters of each station.
+    """
+    event = config.event
+    hypo = event.hypocenter
+    depth = hypo.depth.value_in_km
+    phase = config.wave_type[0]
+    velocity = hypo[f'v{phase.lower()}']
+    npts = int(round(args.win_length * args.sampling_rate))
+    fdelta = 1. / args.win_length
+    freq = np.arange(npts // 2 + 1) * fdelta
+    Mo = mag_to_moment(args.mag)
+    dist_min = max(args.dist_range[0], depth)
+    dist_max = max(args.dist_range[1], dist_min)
+    spec_st = Stream()
+    specnoise_st = Stream()
+    truth = {}
+    for n in range(args.nstations):
+        hypo_dist = rng.uniform(dist_min, dist_max)
+        epi_dist = np.sqrt(hypo_dist**2 - depth**2)
+        azimuth = rng.uniform(0, 360)
+        travel_time = hypo_dist / velocity
+        t_star = travel_time / args.Qo
+        model = mag_to_moment(
+            spectral_model(freq, args.mag, args.fc, t_star))
+        noise_amplitude = args.noise_level * Mo / np.sqrt(2)
+        noise = noise_amplitude * (
+            rng.standard_normal(len(freq)) +
+            1j * rng.standard_normal(len(freq)))
+        noise_window = noise_amplitude * (
+            rng.standard_normal(len(freq)) +
+            1j * rng.standard_normal(len(freq)))
+        spec = Spectrum()
+        spec.stats.network = 'SY'
+        spec.stats.station = f'S{n:03d}'
+        spec.stats.channel = 'HHH'
+        spec.stats.begin = freq[0]
+        spec.stats.delta = fdelta
+        spec.stats.instrtype = 'broadb'
+        azimuth_rad = np.radians(azimuth)
+        epi_dist_deg = kilometers2degrees(epi_dist)
+        spec.stats.coords = AttribDict(
+            latitude=epi_dist_deg * np.cos(azimuth_rad),
+            longitude=epi_dist_deg * np.sin(azimuth_rad),
+            elevation=0., local_depth=0.)
+        spec.stats.event = event
+        spec.stats.hypo_dist = hypo_dist
+        spec.stats.epi_dist = epi_dist
+        spec.stats.gcarc = epi_dist_deg
+        spec.stats.azimuth = azimuth
+        spec.stats.travel_times = {phase: travel_time}
+        spec.stats.takeoff_angles = {}
+        spec.stats.radiation_pattern = config[f'rp{phase.lower()}']
+        spec.stats.ignore = False
+        specnoise = spec.copy()
+        spec.data = np.abs(model + noise)
+        specnoise.data = np.abs(noise_window)
+        spec_st.append(spec)
+        specnoise_st.append(specnoise)
+        truth[spec.id] = {
+            'Mw': args.mag, 'fc': args.fc, 't_star': t_star,
+            'hypo_dist': hypo_dist}
+    return spec_st, specnoise_st, truth
+
+
+def _build_spectra(config, spec_st, specnoise_st):
+    """
+    Cut, smooth and weight synthetic spectra, as done by ``build_spectra()``.
+    """
+    for n, (spec, specnoise) in enumerate(zip(spec_st, specnoise_st)):
+        spec = spec_st[n] = _cut_spectrum(config, spec)
+        specnoise = specnoise_st[n] = _cut_spectrum(config, specnoise)
+        for sp in spec, specnoise:
+            # store coeff to correct back data in displacement units
+            # for radiated_energy()
+            sp.stats.coeff = _displacement_to_moment(sp.stats, config)
+            _smooth_spectrum(sp, config.spectral_smooth_width_decades)
+        try:
+            _check_spectral_sn_ratio(config, spec, specnoise)
+        except SpectrumIgnored as msg:
+            _ignore_spectrum(msg, spec, specnoise)
+    for spec in spec_st:
+        spec.data_mag = moment_to_mag(spec.data)
+        spec.data_mag_logspaced = moment_to_mag(spec.data_logspaced)
+    for specnoise in specnoise_st:
+        specnoise.data_mag = moment_to_mag(specnoise.data)
+    return _build_weight_spectral_stream(config, spec_st, specnoise_st)
+
+
+def _time_call(repeat, func, make_args):
+    """
+    Call ``func(*make_args())`` ``repeat`` times.
+
+    ``make_args()`` must return fresh copies of the arguments that ``func()``
+    modifies in place.
+
+    Return the result and the arguments of the last call,
+    and the best elapsed time.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        args = make_args()
+        t0 = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - t0)
+    return result, args, best
+
+
+def _run_algorithm(config, algorithm, spec_st, specnoise_st, weight_st,
+                   repeat):
+    """Time the inversion stages for one algorithm."""
+    config.inv_algorithm = algorithm
+    timings = {}
+    # spectral_inversion() adds synthetic spectra to spec_st
+    sspec_output, (_, spec_st, _), timings['spectral_inversion'] =\
+        _time_call(
+            repeat, spectral_inversion,
+            lambda: (config, spec_st.copy(), weight_st))
+    if not sspec_output.station_parameters:
+        return sspec_output, timings
+    # the following stages overwrite their results at each call
+    _, _, timings['radiated_energy'] = _time_call(
+        repeat, radiated_energy_and_apparent_stress,
+        lambda: (config, spec_st, specnoise_st, sspec_output))
+    _, _, timings['summary_statistics'] = _time_call(
+        repeat, compute_summary_statistics,
+        lambda: (config, sspec_output))
+    return sspec_output, timings
+
+
+def _float_or_none(value):
+    """Convert a value to float, using None for NaN and infinite values."""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if np.isfinite(value) else None
+
+
+def _recovery(sspec_output, truth, args):
+    """Compare inverted parameters with the known truth."""
+    stations = {}
+    t_star_errors = []
+    for stat_id, station_pars in sspec_output.station_parameters.items():
+        params = station_pars.params_dict
+        stations[stat_id] = {
+            par: _float_or_none(params.get(par)) for par in COMPARED_PARAMS}
+        true_t_star = truth[stat_id]['t_star']
+        t_star_errors.append(params['t_star'] - true_t_star)
+    recovery = {
+        'nstations': len(truth),
+        'nstations_inverted': len(stations),
+    }
+    if stations:
+        ref_values = sspec_output.reference_values()
+        Mw = ref_values['Mw']
+        fc = ref_values['fc']
+        recovery.update({
+            'Mw': _float_or_none(Mw),
+            'fc': _float_or_none(fc),
+            'Mw_error': _float_or_none(Mw - args.mag),
+            'fc_relative_error': _float_or_none((fc - args.fc) / args.fc),
+            't_star_rms_error': _float_or_none(
+                np.sqrt(np.mean(np.power(t_star_errors, 2)))),
+        })
+    return recovery, stations
+
+
+def _compare_with_baseline(results, baseline_file):
+    """Print speedups and result changes with respect to a baseline run."""
+    try:
+        with open(baseline_file, 'r', encoding='utf-8') as fp:
+            baseline = json.load(fp)
+    except (OSError, json.JSONDecodeError) as msg:
+        sys.exit(f'Error reading baseline file: {msg}')
+    if baseline.get('setup') != results['setup']:
+        print(
+            'Warning: benchmark setup differs from baseline: '
+            'results are not comparable')
+    print(f'\nComparison with baseline: {baseline_file}')
+
+    def _speedup(old, new):
+        if old is None or new is None or new == 0:
+            return 'n/a'
+        return f'{old / new:.2f}x'
+
+    for stage, new_time in results['stages'].items():
+        old_time = baseline['stages'].get(stage)
+        print(f'  {stage:>28}: speedup {_speedup(old_time, new_time)}')
+    for algorithm, alg_results in results['algorithms'].items():
+        try:
+            alg_baseline = baseline['algorithms'][algorithm]
+        except KeyError:
+            print(f'  {algorithm}: not in baseline')
+            continue
+        for stage, new_time in alg_results['stages'].items():
+            old_time = alg_baseline['stages'].get(stage)
+            label = f'{algorithm} {stage}'
+            print(f'  {label:>28}: speedup {_speedup(old_time, new_time)}')
+        max_diff = {}
+        changed = set(alg_results['stations']) ^\
+            set(alg_baseline['stations'])
+        for stat_id in set(alg_results['stations']) &\
+                set(alg_baseline['stations']):
+            new_pars = alg_results['stations'][stat_id]
+            old_pars = alg_baseline['stations'][stat_id]
+            for par in COMPARED_PARAMS:
+                new_val, old_val = new_pars.get(par), old_pars.get(par)
+                if new_val is None or old_val is None:
+                    if new_val != old_val:
+                        changed.add(stat_id)
+                    continue
+                diff = abs(new_val - old_val) / max(abs(old_val), 1e-99)
+                max_diff[par] = max(max_diff.get(par, 0), diff)
+                if not np.isclose(new_val, old_val, rtol=1e-6, atol=0):
+                    changed.add(stat_id)
+        diff_str = ', '.join(
+            f'{par}: {diff:.1e}' for par, diff in max_diff.items())
+        status = 'changed' if changed else 'unchanged'
+        print(
+            f'  {algorithm} results {status} '
+            f'(max relative difference: {diff_str or "n/a"})')
+        if changed:
+            print(f'      stations changed: {", ".join(sorted(changed))}')
+
+
+def _print_results(results):
+    """Print a summary of benchmark results."""
+    print('\nStage timings (seconds):')
+    for stage, elapsed in results['stages'].items():
+        print(f'  {stage:>20}: {elapsed:.4f}')
+    for algorithm, alg_results in results['algorithms'].items():
+        recovery = alg_results['recovery']
+        print(f'\n{algorithm}:')
+        for stage, elapsed in alg_results['stages'].items():
+            print(f'  {stage:>20}: {elapsed:.4f}')
+        print(
+            f'  {"inverted stations":>20}: '
+            f'{recovery["nstations_inverted"]}/{recovery["nstations"]}')
+        if recovery['nstations_inverted'] == 0 or None in recovery.values():
+            continue
+        print(
+            f'  {"Mw":>20}: {recovery["Mw"]:.3f} '
+            f'(error: {recovery["Mw_error"]:+.3f})')
+        print(
+            f'  {"fc":>20}: {recovery["fc"]:.3f} '
+            f'(relative error: {recovery["fc_relative_error"]:+.2%})')
+        print(
+            f'  {"t_star rms error":>20}: '
+            f'{recovery["t_star_rms_error"]:.4f}')
+
+
+def run_benchmark(config, args):
+    """
+    Run the benchmark on a synthetic event.
+
+    Parameters
+    ----------
+    config : :class:`~sourcespec.config.Config`
+        SourceSpec config object.
+    args : :class:`argparse.Namespace`
+        Benchmark options (see :func:`parse_args`).
+
+    Returns
+    -------
+    results : dict
+        Benchmark results, ready to be serialized to JSON.
+    """
+    rng = np.random.default_rng(args.seed)
+    _synth_event(config)
+    setup = {
+        'nstations': args.nstations,
+        'sampling_rate': args.sampling_rate,
+        'win_length': args.win_length,
+        'noise_level': args.noise_level,
+        'Mw': args.mag,
+        'fc': args.fc,
+        'Qo': args.Qo,
+        'dist_range': list(args.dist_range),
+        'seed': args.seed,
+        'wave_type': config.wave_type,
+        'weighting': config.weighting,
+    }
+    results = {
+        'sourcespec_version': get_versions()['version'],
+        'python_version': platform.python_version(),
+        'numpy_version': np.__version__,
+        'scipy_version': scipy.__version__,
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'repeat': args.repeat,
+        'setup': setup,
+        'stages': {},
+        'algorithms': {},
+    }
+    (spec_st, specnoise_st, truth), _, results['stages']['synthesis'] =\
+        _time_call(
+            args.repeat, _synth_spectra,
+            lambda: (config, args, deepcopy(rng)))
+    # _build_spectra() modifies spectra in place
+    weight_st, (_, spec_st, specnoise_st), elapsed = _time_call(
+        args.repeat, _build_spectra,
+        lambda: (config, spec_st.copy(), specnoise_st.copy()))
+    results['stages']['build_spectra'] = elapsed
+    results['truth'] = {
+        stat_id: {'t_star': pars['t_star'], 'hypo_dist': pars['hypo_dist']}
+        for stat_id, pars in truth.items()}
+    for algorithm in args.algorithms:
+        print(f'Benchmarking inversion algorithm: {algorithm}')
+        sspec_output, timings = _run_algorithm(
+            config, algorithm, spec_st, specnoise_st, weight_st, args.repeat)
+        recovery, stations = _recovery(sspec_output, truth, args)
+        results['algorithms'][algorithm] = {
+            'stages': timings,
+            'recovery': recovery,
+            'stations': stations,
+        }
+    return results
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    if args.verbose:
+        logging.basicConfig(
+            level=logging.INFO, format='%(name)-20s %(levelname)-8s '
+                                       '%(message)s')
+    else:
+        logging.basicConfig(level=logging.ERROR)
+    config = _configure(args)
+    results = run_benchmark(config, args)
+    _print_results(results)
+    outdir = os.path.dirname(args.outfile)
+    if outdir and not os.path.exists(outdir):
+        os.makedirs(outdir)
+    with open(args.outfile, 'w', encoding='utf-8') as fp:
+        json.dump(results, fp, indent=2)
+    print(f'\nBenchmark results saved to: {args.outfile}')
+    if args.baseline is not None:
+        _compare_with_baseline(results, args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,686 @@
+# -*- coding: utf8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Generalized spectral inversion of source_spec station residuals.
+
+Station residuals (observed spectrum minus the spectral model computed with
+the event summary parameters, in magnitude units) are separated into a source,
+a path and a site contribution. For each frequency f, the residual of event i
+at station j is modelled as:
+
+    r_ij(f) = E_i(f) + P(R_ij, f) + S_j(f)
+
+where E_i is the source term, S_j is the site term and P is the path term, a
+piecewise linear function of the logarithm of the hypocentral distance R_ij,
+defined on a set of distance nodes.
+
+The trade-offs between the three terms are removed by two constraints:
+the path term is zero at the first distance node and the mean site term of
+the reference stations (by default, all the stations) is zero.
+
+Residuals are interpolated on logarithmically spaced frequencies and one
+sparse least-squares problem is solved for each frequency, using the
+iterative LSQR solver. Frequencies are processed in parallel.
+
+Site terms are saved to a residual store file (``gsi_site_terms.sspres``),
+which can be used for station correction (``residuals_filepath`` config
+parameter). All the terms are saved to a compressed NumPy file
+(``gsi_terms.npz``).
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import sys
+import os
+from fnmatch import fnmatch
+from functools import partial
+from argparse import ArgumentParser
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import lsqr
+import matplotlib
+import matplotlib.pyplot as plt
+from obspy.core import Stream
+from sourcespec.spectrum import Spectrum
+from sourcespec.ssp_util import mag_to_moment
+from sourcespec.ssp_residual_store import (
+    open_residual_store, write_residual_store, RESIDUAL_STORE_EXTENSION)
+from sourcespec.source_residuals import (
+    find_residual_files, iter_residual_files)
+matplotlib.use('Agg')  # NOQA
+
+# Weight of the constraint equations, relative to the data equations.
+# Constraints only act on the null space of the data equations, so their
+# weight does not bias the solution; it only affects LSQR convergence.
+CONSTRAINT_WEIGHT = 10.
+# LSQR stopping tolerances
+LSQR_TOL = 1e-8
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    """
+    parser = ArgumentParser(
+        description='Generalized spectral inversion of source_spec station '
+                    'residuals: separate source, path and site terms.')
+    parser.add_argument(
+        '-m', '--min_spectra', dest='min_spectra', type=int, action='store',
+        default=20, help='minimum number of spectra for a station to be '
+        'used in the inversion (default=20)', metavar='NUMBER')
+    parser.add_argument(
+        '-M', '--min_stations', dest='min_stations', type=int,
+        action='store', default=3, help='minimum number of stations for an '
+        'event to be used in the inversion (default=3)', metavar='NUMBER')
+    parser.add_argument(
+        '-f', '--freq_range', dest='freq_range', type=float, nargs=2,
+        action='store', default=None, help='frequency range for the '
+        'inversion (default: frequency range of the residuals)',
+        metavar=('FMIN', 'FMAX'))
+    parser.add_argument(
+        '-n', '--nfreqs', dest='nfreqs', type=int, action='store',
+        default=40, help='number of logarithmically spaced frequencies '
+        '(default=40)', metavar='NUMBER')
+    parser.add_argument(
+        '-d', '--dist_nodes', dest='dist_nodes', type=int, action='store',
+        default=10, help='number of logarithmically spaced distance nodes '
+        'for the path term (default=10). Use 0 to ignore the path term',
+        metavar='NUMBER')
+    parser.add_argument(
+        '-r', '--reference', dest='reference', action='store', nargs='+',
+        default=None, help='reference stations, whose mean site term is '
+        'zero. Spectrum ids (e.g., "IV.AQU..HHH") or wildcard patterns '
+        '(e.g., "IV.AQU.*") (default: all stations)', metavar='STATION')
+    parser.add_argument(
+        '-o', '--outdir', dest='outdir', action='store',
+        default='sspec_gsi',
+        help='output directory (default="sspec_gsi")')
+    parser.add_argument(
+        '-p', '--plot', dest='plot', action='store_true',
+        default=False, help='save site term and path term plots to file')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', type=int, action='store',
+        default=None, help='number of parallel processes for reading '
+        'residual files and for the inversion (default: number of CPUs)',
+        metavar='NUMBER')
+    parser.add_argument(
+        'residual_files_dir',
+        help='directory containing source_spec residual files. '
+             'Residual files can be in subdirectories '
+             '(e.g., a subdirectory for each event).')
+    args = parser.parse_args()
+    if args.freq_range is not None:
+        fmin, fmax = args.freq_range
+        if not 0 < fmin < fmax:
+            sys.exit(f'Error: invalid frequency range: {args.freq_range}')
+    if args.nfreqs < 1:
+        sys.exit('Error: "nfreqs" must be at least 1')
+    if args.dist_nodes == 1 or args.dist_nodes < 0:
+        sys.exit('Error: "dist_nodes" must be 0 or at least 2')
+    return args
+
+
+def _event_id(store, resfile):
+    """Return the event id of a residual file."""
+    evid = store.metadata.get('evid')
+    if evid is None:
+        evid = os.path.basename(resfile).split('-residuals')[0]
+    return evid
+
+
+def _interpolate_log(freq, data_mag, freqs):
+    """
+    Interpolate a residual spectrum at freqs, in logarithmic frequency.
+    Return NaN outside the spectrum frequency range.
+    """
+    valid = freq > 0
+    return np.interp(
+        np.log(freqs), np.log(freq[valid]), data_mag[valid],
+        left=np.nan, right=np.nan)
+
+
+def _read_residual_file(resfile, freqs):
+    """
+    Read a residual file and interpolate residuals at freqs.
+
+    Return the event id, the spectrum ids, the hypocentral distances (NaN, if
+    unknown), the frequency steps and the interpolated residuals (2D array:
+    spectra x frequencies). Residuals are stored as 32-bit floats, to limit
+    memory usage for large catalogues.
+    """
+    store = open_residual_store(resfile, warn_legacy=False)
+    spec_ids = store.ids
+    dists = np.full(len(spec_ids), np.nan)
+    deltas = np.zeros(len(spec_ids))
+    values = np.zeros((len(spec_ids), len(freqs)), dtype=np.float32)
+    for n, spec_id in enumerate(spec_ids):
+        begin, delta, npts = store.frequency_sampling(spec_id)
+        hypo_dist = store.hypo_dist(spec_id)
+        if hypo_dist is not None:
+            dists[n] = hypo_dist
+        deltas[n] = delta
+        freq = begin + np.arange(npts) * delta
+        values[n] = _interpolate_log(
+            freq, store.column(spec_id, 'data_mag'), freqs)
+    return _event_id(store, resfile), spec_ids, dists, deltas, values
+
+
+class _ResidualTable():
+    """
+    Residuals interpolated on a common set of frequencies.
+
+    Each row is a spectrum, identified by its event index, station index and
+    hypocentral distance. Rows are stored in blocks, one per event.
+    """
+
+    def __init__(self, freqs):
+        self.freqs = freqs
+        self.event_ids = []
+        self.station_ids = []
+        self.station_delta = []
+        self._station_index = {}
+        self._event_idx = []
+        self._station_idx = []
+        self._dist = []
+        self._values = []
+
+    def add_event(self, evid, spec_ids, dists, deltas, values):
+        """Add the residuals of an event."""
+        evidx = len(self.event_ids)
+        self.event_ids.append(evid)
+        station_idx = np.zeros(len(spec_ids), dtype=int)
+        for n, (spec_id, delta) in enumerate(zip(spec_ids, deltas)):
+            if spec_id not in self._station_index:
+                self._station_index[spec_id] = len(self.station_ids)
+                self.station_ids.append(spec_id)
+                self.station_delta.append(delta)
+            stidx = self._station_index[spec_id]
+            self.station_delta[stidx] = min(self.station_delta[stidx], delta)
+            station_idx[n] = stidx
+        self._event_idx.append(np.full(len(spec_ids), evidx))
+        self._station_idx.append(station_idx)
+        self._dist.append(dists)
+        self._values.append(values)
+
+    def arrays(self):
+        """
+        Return event indexes, station indexes, distances and values
+        (2D array: spectra x frequencies).
+        """
+        if not self._values:
+            return (
+                np.empty(0, dtype=int), np.empty(0, dtype=int),
+                np.empty(0), np.empty((0, len(self.freqs)), dtype=np.float32))
+        return (
+            np.concatenate(self._event_idx),
+            np.concatenate(self._station_idx),
+            np.concatenate(self._dist), np.vstack(self._values))
+
+
+def _frequency_range(resfiles):
+    """
+    Return the frequency range spanned by the residual files.
+    Only file headers are read.
+    """
+    fmin = np.inf
+    fmax = -np.inf
+    for resfile in resfiles:
+        store = open_residual_store(resfile, warn_legacy=False)
+        for spec_id in store.ids:
+            begin, delta, npts = store.frequency_sampling(spec_id)
+            fmin = min(fmin, begin if begin > 0 else delta)
+            fmax = max(fmax, begin + (npts - 1) * delta)
+    return fmin, fmax
+
+
+def read_residual_table(resfiles, freqs, n_jobs=None):
+    """
+    Read residual files and interpolate residuals at the given frequencies.
+
+    Parameters
+    ----------
+    resfiles : list
+        Residual files.
+    freqs : numpy.ndarray
+        Frequencies for the inversion.
+    n_jobs : int
+        Number of parallel processes for reading residual files
+        (default: number of CPUs).
+
+    Returns
+    -------
+    table : _ResidualTable
+        Residuals interpolated at freqs.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    table = _ResidualTable(freqs)
+    reader = partial(_read_residual_file, freqs=freqs)
+    for resfile, residuals in iter_residual_files(
+            resfiles, n_jobs, reader=reader):
+        print(f'Found residual file: {resfile}')
+        table.add_event(*residuals)
+    return table
+
+
+def _select_records(event_idx, station_idx, min_spectra, min_stations):
+    """
+    Select records of stations with at least min_spectra spectra and of
+    events with at least min_stations stations. Selection is repeated until
+    it is stable, since removing events can bring stations below the
+    threshold.
+    """
+    keep = np.ones(len(event_idx), dtype=bool)
+    nst = station_idx.max() + 1 if len(station_idx) else 0
+    nev = event_idx.max() + 1 if len(event_idx) else 0
+    while True:
+        nevents = np.bincount(station_idx[keep], minlength=nst)
+        keep_new = keep & (nevents[station_idx] >= min_spectra)
+        nstations = np.bincount(event_idx[keep_new], minlength=nev)
+        keep_new &= nstations[event_idx] >= min_stations
+        if np.array_equal(keep_new, keep):
+            return keep
+        keep = keep_new
+
+
+def _distance_weights(dist, dist_nodes):
+    """
+    Return, for each distance, the indexes of the two enclosing distance
+    nodes and the linear interpolation weights, in logarithmic distance.
+    """
+    log_dist = np.log(dist)
+    log_nodes = np.log(dist_nodes)
+    idx = np.searchsorted(log_nodes, log_dist, side='right') - 1
+    idx = np.clip(idx, 0, len(dist_nodes) - 2)
+    w1 = (log_dist - log_nodes[idx]) / (log_nodes[idx + 1] - log_nodes[idx])
+    w1 = np.clip(w1, 0., 1.)
+    return idx, 1. - w1, w1
+
+
+def _design_matrix_coo(event_idx, station_idx, dist, dist_nodes, nevents,
+                       nstations):
+    """
+    Return rows, columns and values of the non-zero elements of the design
+    matrix (one row per record, without constraints).
+
+    Unknowns are ordered as: source terms, site terms, path terms.
+    """
+    nrecords = len(event_idx)
+    records = np.arange(nrecords)
+    rows = [records, records]
+    cols = [event_idx, nevents + station_idx]
+    vals = [np.ones(nrecords), np.ones(nrecords)]
+    if dist_nodes is not None:
+        node_idx, w0, w1 = _distance_weights(dist, dist_nodes)
+        path_col = nevents + nstations + node_idx
+        rows += [records, records]
+        cols += [path_col, path_col + 1]
+        vals += [w0, w1]
+    return np.hstack(rows), np.hstack(cols), np.hstack(vals)
+
+
+# Inversion problem, shared with worker processes
+_PROBLEM = {}
+
+
+def _init_worker(problem):
+    """Set the inversion problem for a worker process."""
+    _PROBLEM.update(problem)
+
+
+def _solve_frequency(nfreq):
+    """
+    Solve the inversion problem for one frequency.
+
+    Return the solution, its variance, the number of records and the
+    standard deviation of the residuals.
+    """
+    problem = _PROBLEM
+    values = problem['values'][:, nfreq].astype(float)
+    valid = np.isfinite(values)
+    nunknowns = problem['nunknowns']
+    nrecords = np.count_nonzero(valid)
+    if nrecords == 0:
+        return (
+            np.full(nunknowns, np.nan), np.full(nunknowns, np.nan), 0, np.nan)
+    # renumber rows, keeping only records with a value at this frequency
+    row_map = np.cumsum(valid) - 1
+    nz = valid[problem['rows']]
+    rows = row_map[problem['rows'][nz]]
+    cols = problem['cols'][nz]
+    vals = problem['vals'][nz]
+    used = np.bincount(cols, minlength=nunknowns) > 0
+    # constraint equations, only on unknowns determined at this frequency:
+    # mean site term of reference stations (or of all the stations, if no
+    # reference station has data) and path term at the first distance node
+    ref_cols = problem['ref_cols'][used[problem['ref_cols']]]
+    if not len(ref_cols):
+        site_cols = problem['site_cols']
+        ref_cols = site_cols[used[site_cols]]
+    constr_rows = [np.full(len(ref_cols), nrecords)]
+    constr_cols = [ref_cols]
+    constr_vals = [np.full(len(ref_cols), CONSTRAINT_WEIGHT / len(ref_cols))]
+    path_cols = problem['path_cols']
+    path_cols = path_cols[used[path_cols]]
+    if len(path_cols):
+        constr_rows.append(np.array([nrecords + 1]))
+        constr_cols.append(path_cols[:1])
+        constr_vals.append(np.array([CONSTRAINT_WEIGHT]))
+    nconstr = len(constr_rows)
+    matrix = csr_matrix(
+        (np.hstack([vals] + constr_vals),
+         (np.hstack([rows] + constr_rows), np.hstack([cols] + constr_cols))),
+        shape=(nrecords + nconstr, nunknowns))
+    rhs = np.hstack((values[valid], np.zeros(nconstr)))
+    result = lsqr(
+        matrix, rhs, atol=LSQR_TOL, btol=LSQR_TOL, calc_var=True)
+    solution, var = result[0], result[-1]
+    data_residuals = matrix[:nrecords] @ solution - values[valid]
+    dof = max(nrecords - np.count_nonzero(used) + nconstr, 1)
+    sigma = np.sqrt(np.sum(data_residuals**2) / dof)
+    # unknowns without records are undetermined
+    solution[~used] = np.nan
+    var[~used] = np.nan
+    return solution, var, nrecords, sigma
+
+
+def _iter_solutions(problem, nfreqs, n_jobs):
+    """Yield the inversion solution for each frequency, in order."""
+    if n_jobs == 1:
+        _init_worker(problem)
+        for nfreq in range(nfreqs):
+            yield _solve_frequency(nfreq)
+        return
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker,
+            initargs=(problem,)) as executor:
+        yield from executor.map(_solve_frequency, range(nfreqs))
+
+
+def generalized_inversion(table, min_spectra=20, min_stations=3,
+                          ndist_nodes=10, reference=None, n_jobs=None):
+    """
+    Separate source, path and site terms from station residuals.
+
+    Parameters
+    ----------
+    table : _ResidualTable
+        Residuals interpolated on a common set of frequencies.
+    min_spectra : int
+        Minimum number of spectra for a station (default=20).
+    min_stations : int
+        Minimum number of stations for an event (default=3).
+    ndist_nodes : int
+        Number of distance nodes for the path term (default=10).
+        Use 0 to ignore the path term.
+    reference : list of str
+        Reference stations (ids or wildcard patterns), whose mean site term
+        is zero (default: all stations).
+    n_jobs : int
+        Number of parallel processes (default: number of CPUs).
+
+    Returns
+    -------
+    terms : dict
+        Inversion results: frequencies, event and station ids, distance
+        nodes, source, site and path terms (one row per event, station or
+        distance node, one column per frequency), site term standard
+        deviation (approximate, from the LSQR variance estimate) and number
+        of records per station and frequency.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    event_idx, station_idx, dist, values = table.arrays()
+    if ndist_nodes:
+        has_dist = np.isfinite(dist) & (dist > 0)
+        if not np.any(has_dist):
+            print(
+                'Warning: hypocentral distances are not available '
+                '(residual files in legacy format?): ignoring the path term')
+            ndist_nodes = 0
+        elif not np.all(has_dist):
+            print(
+                f'Warning: ignoring {np.count_nonzero(~has_dist)} spectra '
+                'without hypocentral distance')
+            event_idx = event_idx[has_dist]
+            station_idx = station_idx[has_dist]
+            dist = dist[has_dist]
+            values = values[has_dist]
+    keep = _select_records(event_idx, station_idx, min_spectra, min_stations)
+    if not np.any(keep):
+        sys.exit(
+            'No station with enough spectra: try reducing "min_spectra" '
+            'and/or "min_stations"')
+    # renumber events and stations, keeping only selected ones;
+    # stations are sorted by id
+    events, event_idx = np.unique(event_idx[keep], return_inverse=True)
+    stations = sorted(
+        np.unique(station_idx[keep]), key=lambda n: table.station_ids[n])
+    station_lookup = np.zeros(len(table.station_ids), dtype=int)
+    station_lookup[stations] = np.arange(len(stations))
+    station_idx = station_lookup[station_idx[keep]]
+    dist = dist[keep]
+    values = values[keep]
+    event_ids = [table.event_ids[n] for n in events]
+    station_ids = [table.station_ids[n] for n in stations]
+    nevents = len(event_ids)
+    nstations = len(station_ids)
+    print(
+        f'Inverting {len(values)} spectra from {nevents} events and '
+        f'{nstations} stations, at {len(table.freqs)} frequencies')
+    dist_nodes = None
+    if ndist_nodes:
+        dist_min, dist_max = dist.min(), dist.max()
+        if dist_max <= dist_min:
+            dist_max = dist_min * 1.01
+        dist_nodes = np.geomspace(dist_min, dist_max, ndist_nodes)
+    if reference:
+        ref_idx = [
+            n for n, stid in enumerate(station_ids)
+            if any(fnmatch(stid, pattern) for pattern in reference)]
+        if not ref_idx:
+            sys.exit(f'No reference station found: {" ".join(reference)}')
+    else:
+        ref_idx = list(range(nstations))
+    rows, cols, vals = _design_matrix_coo(
+        event_idx, station_idx, dist, dist_nodes, nevents, nstations)
+    problem = {
+        'values': values,
+        'rows': rows,
+        'cols': cols,
+        'vals': vals,
+        'nunknowns': nevents + nstations + ndist_nodes,
+        'ref_cols': nevents + np.array(ref_idx),
+        'site_cols': nevents + np.arange(nstations),
+        'path_cols': nevents + nstations + np.arange(ndist_nodes),
+    }
+    nfreqs = len(table.freqs)
+    solutions = np.full((nfreqs, problem['nunknowns']), np.nan)
+    variances = np.full((nfreqs, problem['nunknowns']), np.nan)
+    sigmas = np.full(nfreqs, np.nan)
+    for nfreq, (solution, var, nrecords, sigma) in enumerate(
+            _iter_solutions(problem, nfreqs, n_jobs)):
+        solutions[nfreq] = solution
+        variances[nfreq] = var
+        sigmas[nfreq] = sigma
+        print(
+            f'Frequency {table.freqs[nfreq]:.3f} Hz: {nrecords} spectra, '
+            f'residual standard deviation: {sigma:.3f}')
+    site_slice = slice(nevents, nevents + nstations)
+    site_count = np.zeros((nstations, nfreqs), dtype=int)
+    for nfreq in range(nfreqs):
+        valid = np.isfinite(values[:, nfreq])
+        site_count[:, nfreq] = np.bincount(
+            station_idx[valid], minlength=nstations)
+    return {
+        'freqs': table.freqs,
+        'event_ids': np.array(event_ids),
+        'station_ids': np.array(station_ids),
+        'station_delta': np.array(
+            [table.station_delta[n] for n in stations]),
+        'reference_stations': np.array(
+            [station_ids[n] for n in ref_idx]),
+        'dist_nodes': (
+            np.empty(0) if dist_nodes is None else dist_nodes),
+        'source_terms': solutions[:, :nevents].T,
+        'site_terms': solutions[:, site_slice].T,
+        'site_terms_std': (
+            np.sqrt(variances[:, site_slice]) * sigmas[:, None]).T,
+        'site_terms_count': site_count,
+        'path_terms': solutions[:, nevents + nstations:].T,
+        'sigma': sigmas,
+    }
+
+
+def site_terms_to_stream(terms):
+    """
+    Convert site terms to a stream of residual spectra, with a linear
+    frequency sampling, which can be used for station correction.
+
+    Parameters
+    ----------
+    terms : dict
+        Inversion results, as returned by generalized_inversion().
+
+    Returns
+    -------
+    site_st : Stream
+        Stream containing site terms for each station. Each spectrum also
+        contains the standard deviation ("data_mag_std" attribute) and the
+        number of spectra ("data_mag_count" attribute) for each frequency.
+    """
+    freqs = terms['freqs']
+    site_st = Stream()
+    for stid, delta, site, std, count in zip(
+            terms['station_ids'], terms['station_delta'],
+            terms['site_terms'], terms['site_terms_std'],
+            terms['site_terms_count']):
+        valid = np.isfinite(site)
+        if not np.any(valid):
+            continue
+        fmin = freqs[valid].min()
+        fmax = freqs[valid].max()
+        kmin = int(np.ceil(fmin / delta - 1e-6))
+        kmax = int(np.floor(fmax / delta + 1e-6))
+        if kmax < kmin:
+            continue
+        freq = np.arange(kmin, kmax + 1) * delta
+        log_freq = np.log(freq)
+        log_freqs = np.log(freqs[valid])
+        spec = Spectrum()
+        spec.id = str(stid)
+        spec.stats.begin = kmin * delta
+        spec.stats.delta = delta
+        spec.data_mag = np.interp(log_freq, log_freqs, site[valid])
+        spec.data = mag_to_moment(spec.data_mag)
+        spec.data_mag_std = np.interp(
+            log_freq, log_freqs, np.nan_to_num(std[valid]))
+        # number of records at the closest inversion frequency
+        closest = np.abs(log_freq[:, None] - log_freqs[None, :]).argmin(axis=1)
+        spec.data_mag_count = count[valid][closest]
+        site_st.append(spec)
+    return site_st
+
+
+def write_terms(terms, outdir):
+    """
+    Write inversion results to outdir.
+
+    Site terms are written to a residual store file, to be used for
+    station correction. All the terms are written to a compressed NumPy file.
+
+    Parameters
+    ----------
+    terms : dict
+        Inversion results, as returned by generalized_inversion().
+    outdir : str
+        Output directory.
+    """
+    terms_file = os.path.join(outdir, 'gsi_terms.npz')
+    np.savez_compressed(terms_file, **terms)
+    print(f'Source, path and site terms saved to: {terms_file}')
+    site_file = os.path.join(
+        outdir, f'gsi_site_terms{RESIDUAL_STORE_EXTENSION}')
+    metadata = {
+        'reference_stations': terms['reference_stations'].tolist(),
+        'freqs': terms['freqs'].tolist(),
+    }
+    write_residual_store(site_terms_to_stream(terms), site_file, metadata)
+    print(f'Site terms saved to: {site_file}')
+
+
+def plot_terms(terms, outdir):
+    """
+    Plot site terms (one figure per station) and path terms.
+
+    Parameters
+    ----------
+    terms : dict
+        Inversion results, as returned by generalized_inversion().
+    outdir : str
+        Output directory.
+    """
+    freqs = terms['freqs']
+    for stid, site, std, count in zip(
+            terms['station_ids'], terms['site_terms'],
+            terms['site_terms_std'], terms['site_terms_count']):
+        figurefile = os.path.join(outdir, f'{stid}-site.png')
+        fig = plt.figure(dpi=160)
+        plt.fill_between(
+            freqs, site - std, site + std, color='b', alpha=0.3, lw=0)
+        plt.semilogx(freqs, site, 'r-')
+        plt.xlabel('frequency (Hz)')
+        plt.ylabel('site term in magnitude units')
+        plt.title(
+            f'site term: {stid} – {count.max()} records (estimate ± std)')
+        fig.savefig(figurefile, bbox_inches='tight')
+        plt.close()
+        print(f'Site term plot saved to: {figurefile}')
+    dist_nodes = terms['dist_nodes']
+    if not len(dist_nodes):
+        return
+    figurefile = os.path.join(outdir, 'path_terms.png')
+    fig = plt.figure(dpi=160)
+    cmap = plt.get_cmap('viridis')
+    # plot at most 8 frequencies
+    step = max(len(freqs) // 8, 1)
+    for nfreq in range(0, len(freqs), step):
+        color = cmap(nfreq / max(len(freqs) - 1, 1))
+        plt.semilogx(
+            dist_nodes, terms['path_terms'][:, nfreq], '-o', color=color,
+            ms=3, label=f'{freqs[nfreq]:.2f} Hz')
+    plt.xlabel('hypocentral distance (km)')
+    plt.ylabel('path term in magnitude units')
+    plt.title('path terms')
+    plt.legend(fontsize=6)
+    fig.savefig(figurefile, bbox_inches='tight')
+    plt.close()
+    print(f'Path term plot saved to: {figurefile}')
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    resfiles = find_residual_files(args.residual_files_dir)
+    if args.freq_range is None:
+        fmin, fmax = _frequency_range(resfiles)
+    else:
+        fmin, fmax = args.freq_range
+    freqs = np.geomspace(fmin, fmax, args.nfreqs)
+    table = read_residual_table(resfiles, freqs, args.jobs)
+    terms = generalized_inversion(
+        table, args.min_spectra, args.min_stations, args.dist_nodes,
+        args.reference, args.jobs)
+    outdir = args.outdir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    write_terms(terms, outdir)
+    if args.plot:
+        plot_terms(terms, outdir)
+
+
+if __name__ == '__main__':
+    main()
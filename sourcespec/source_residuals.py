@@ -14,14 +14,17 @@ Compute mean station residuals from source_spec output.
 """
 import sys
 import os
-from collections import defaultdict
-import pickle
+from collections import defaultdict, deque
 from argparse import ArgumentParser
+import numpy as np
 from obspy.core import Stream
 import matplotlib
 import matplotlib.pyplot as plt
 from sourcespec.ssp_util import moment_to_mag, mag_to_moment
 from sourcespec.spectrum import Spectrum
+from sourcespec.ssp_residual_store import (
+    open_residual_store, write_residual_store, convert_residuals_pickle,
+    is_residual_store, RESIDUAL_STORE_EXTENSION)
 matplotlib.use('Agg')  # NOQA
 
 
@@ -42,47 +45,85 @@ def parse_args():
     parser.add_argument(
         '-p', '--plot', dest='plot', action='store_true',
         default=False, help='save residuals plots to file')
+    parser.add_argument(
+        '-s', '--streaming', dest='streaming', action='store_true',
+        default=False, help='read residual files one at a time and '
+        'accumulate running statistics on a common frequency grid for each '
+        'station: memory usage does not depend on the number of files. '
+        'Mean residuals also store the standard deviation and the number '
+        'of spectra for each frequency. In this mode, residuals plots only '
+        'show mean and standard deviation')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', type=int, action='store',
+        default=None, help='number of parallel processes for reading '
+        'residual files, in streaming mode (default: number of CPUs)',
+        metavar='NUMBER')
+    parser.add_argument(
+        '-c', '--convert', dest='convert', action='store_true',
+        default=False, help='convert residual files in the legacy pickle '
+        'format to the new residual store format and exit. The argument '
+        'can be a directory or a single file (e.g., a '
+        '"residual_mean.pickle" file)')
     parser.add_argument(
         'residual_files_dir',
-        help='directory containing source_spec residual files '
-             'in pickle format. Residual files can be in subdirectories '
+        help='directory containing source_spec residual files. '
+             'Residual files can be in subdirectories '
              '(e.g., a subdirectory for each event).')
     return parser.parse_args()
 
 
-def read_residuals(resfiles_dir):
+def find_residual_files(resfiles_dir):
     """
-    Read residuals from pickle files in resfiles_dir.
+    Find residual files in resfiles_dir and its subdirectories.
 
     Parameters
     ----------
     resfiles_dir : str
-        Directory containing source_spec residual files in pickle format.
-        Residual files can be in subdirectories (e.g., a subdirectory for
-        each event).
+        Directory containing source_spec residual files.
 
     Returns
     -------
-    residual_dict : dict
-        Dictionary containing residuals for each station.
+    resfiles : list
+        Sorted list of residual files.
     """
     if not os.path.exists(resfiles_dir):
         sys.exit(f'Error: directory "{resfiles_dir}" does not exist.')
-    resfiles = []
+    resfiles = {}
     for root, _dirs, files in os.walk(resfiles_dir):
-        resfiles.extend(
-            os.path.join(root, file)
-            for file in files
-            if file.endswith('residuals.pickle')
-        )
+        for file in files:
+            if file.endswith('residuals.pickle'):
+                resfile = os.path.join(root, file)
+                # a converted file takes precedence over the pickle file
+                resfiles.setdefault(resfile[:-len('.pickle')], resfile)
+            elif file.endswith(f'residuals{RESIDUAL_STORE_EXTENSION}'):
+                resfile = os.path.join(root, file)
+                resfiles[resfile[:-len(RESIDUAL_STORE_EXTENSION)]] = resfile
     if not resfiles:
         sys.exit(f'No residual file found in directory: {resfiles_dir}')
+    return [resfiles[key] for key in sorted(resfiles)]
+
+
+def read_residuals(resfiles_dir):
+    """
+    Read residuals from residual files in resfiles_dir.
+
+    Parameters
+    ----------
+    resfiles_dir : str
+        Directory containing source_spec residual files.
+        Residual files can be in subdirectories (e.g., a subdirectory for
+        each event).
+
+    Returns
+    -------
+    residual_dict : dict
+        Dictionary containing residuals for each station.
+    """
+    resfiles = find_residual_files(resfiles_dir)
     residual_dict = defaultdict(Stream)
     for resfile in resfiles:
         print(f'Found residual file: {resfile}')
-        with open(resfile, 'rb') as fp:
-            residual_st = pickle.load(fp)
-        for spec in residual_st:
+        for spec in open_residual_store(resfile, warn_legacy=False):
             residual_dict[spec.id].append(spec)
     return residual_dict
 
@@ -133,6 +174,10 @@ def compute_mean_residuals(residual_dict, min_spectra=20):
                 try:
                     spec_mean.data_mag += spec_slice.data_mag
                 except ValueError:
+                    print(
+                        f'Warning: {stat_id}: skipping a spectrum with a '
+                        'different frequency sampling (use streaming mode '
+                        'to interpolate it)')
                     continue
                 norm_mean += norm
         spec_mean.data_mag /= norm_mean
@@ -142,6 +187,219 @@ def compute_mean_residuals(residual_dict, min_spectra=20):
     return residual_mean
 
 
+class _StationResiduals():
+    """
+    Running statistics of the residuals of one station.
+
+    Residual spectra are interpolated on a common frequency grid,
+    freq = k * delta, where delta is the frequency step of the first
+    spectrum. The grid is extended when needed. Number of spectra, mean and
+    sum of squared deviations (M2) are updated for each frequency, using
+    Welford's algorithm.
+    """
+
+    def __init__(self, delta):
+        self.delta = delta
+        self.nspectra = 0
+        self.kmin = None
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def _extend(self, kmin, kmax):
+        """Extend the grid to cover indexes kmin to kmax."""
+        if self.kmin is None:
+            self.kmin = kmin
+            size = kmax - kmin + 1
+            self.count = np.zeros(size, dtype=int)
+            self.mean = np.zeros(size)
+            self.m2 = np.zeros(size)
+            return
+        kmax_old = self.kmin + len(self.count) - 1
+        pad_before = max(self.kmin - kmin, 0)
+        pad_after = max(kmax - kmax_old, 0)
+        if pad_before == pad_after == 0:
+            return
+        pad = (pad_before, pad_after)
+        self.count = np.pad(self.count, pad)
+        self.mean = np.pad(self.mean, pad)
+        self.m2 = np.pad(self.m2, pad)
+        self.kmin -= pad_before
+
+    def add(self, begin, delta, data_mag):
+        """Add a residual spectrum, given its frequency sampling."""
+        freq = begin + np.arange(len(data_mag)) * delta
+        # grid indexes within the spectrum frequency range
+        # (with a small tolerance for floating point errors)
+        kmin = int(np.ceil(freq[0] / self.delta - 1e-6))
+        kmax = int(np.floor(freq[-1] / self.delta + 1e-6))
+        if kmax < kmin:
+            return
+        self._extend(kmin, kmax)
+        grid_freq = np.arange(kmin, kmax + 1) * self.delta
+        values = np.interp(grid_freq, freq, data_mag)
+        sl = slice(kmin - self.kmin, kmax - self.kmin + 1)
+        self.count[sl] += 1
+        diff = values - self.mean[sl]
+        self.mean[sl] += diff / self.count[sl]
+        self.m2[sl] += diff * (values - self.mean[sl])
+        self.nspectra += 1
+
+    def to_spectrum(self, stat_id):
+        """
+        Return the mean residual spectrum.
+
+        Standard deviation and number of spectra for each frequency are
+        stored in the "data_mag_std" and "data_mag_count" attributes.
+        Frequencies without data (gaps between spectra) get a zero residual.
+        """
+        spec_mean = Spectrum()
+        spec_mean.id = stat_id
+        spec_mean.stats.begin = self.kmin * self.delta
+        spec_mean.stats.delta = self.delta
+        has_data = self.count > 0
+        data_mag = np.where(has_data, self.mean, 0.)
+        std = np.zeros_like(data_mag)
+        np.divide(self.m2, self.count - 1, out=std, where=self.count > 1)
+        spec_mean.data = mag_to_moment(data_mag)
+        spec_mean.data_mag = data_mag
+        spec_mean.data_mag_std = np.sqrt(std)
+        spec_mean.data_mag_count = self.count.copy()
+        return spec_mean
+
+
+def _read_residual_file(resfile):
+    """
+    Read a residual file.
+
+    Return a list of (id, begin, delta, data_mag) tuples, which are cheaper
+    to transfer between processes than a Stream.
+    """
+    store = open_residual_store(resfile, warn_legacy=False)
+    residuals = []
+    for spec_id in store.ids:
+        begin, delta, _npts = store.frequency_sampling(spec_id)
+        data_mag = np.array(store.column(spec_id, 'data_mag'))
+        residuals.append((spec_id, begin, delta, data_mag))
+    return residuals
+
+
+def iter_residual_files(resfiles, n_jobs, reader=None):
+    """
+    Yield the content of residual files, in order.
+
+    Files are read by n_jobs parallel processes, using the reader function,
+    which must be picklable. Only a limited number of files is read in
+    advance, to bound memory usage.
+
+    Parameters
+    ----------
+    resfiles : list
+        Residual files.
+    n_jobs : int
+        Number of parallel processes for reading residual files.
+    reader : callable
+        Function reading a residual file (default: a function returning a
+        list of (id, begin, delta, data_mag) tuples).
+
+    Yields
+    ------
+    resfile : str
+        Residual file.
+    residuals : object
+        Content of the residual file, as returned by reader.
+    """
+    reader = reader or _read_residual_file
+    if n_jobs == 1:
+        for resfile in resfiles:
+            yield resfile, reader(resfile)
+        return
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        pending = deque()
+        for resfile in resfiles:
+            pending.append(
+                (resfile, executor.submit(reader, resfile)))
+            if len(pending) >= 2 * n_jobs:
+                resfile_done, future = pending.popleft()
+                yield resfile_done, future.result()
+        while pending:
+            resfile_done, future = pending.popleft()
+            yield resfile_done, future.result()
+
+
+def stream_mean_residuals(resfiles, min_spectra=20, n_jobs=None):
+    """
+    Compute mean residuals for each station, reading one file at a time.
+
+    Parameters
+    ----------
+    resfiles : list
+        Residual files.
+    min_spectra : int
+        Minimum number of spectra to compute residuals (default=20).
+    n_jobs : int
+        Number of parallel processes for reading residual files
+        (default: number of CPUs).
+
+    Returns
+    -------
+    residual_mean : Stream
+        Stream containing mean residuals for each station. Each spectrum
+        also contains the standard deviation ("data_mag_std" attribute) and
+        the number of spectra ("data_mag_count" attribute) for each
+        frequency.
+    """
+    n_jobs = n_jobs or os.cpu_count() or 1
+    stations = {}
+    for resfile, residuals in iter_residual_files(resfiles, n_jobs):
+        print(f'Found residual file: {resfile}')
+        for stat_id, begin, delta, data_mag in residuals:
+            if stat_id not in stations:
+                stations[stat_id] = _StationResiduals(delta)
+            stations[stat_id].add(begin, delta, data_mag)
+    residual_mean = Stream()
+    for stat_id in sorted(stations.keys()):
+        if stations[stat_id].nspectra < min_spectra:
+            continue
+        print(f'Processing station: {stat_id}')
+        residual_mean.append(stations[stat_id].to_spectrum(stat_id))
+    return residual_mean
+
+
+def plot_mean_residuals(residual_mean, outdir):
+    """
+    Plot mean residuals, with their standard deviation.
+
+    Parameters
+    ----------
+    residual_mean : Stream
+        Stream containing mean residuals for each station, as returned by
+        stream_mean_residuals().
+    outdir : str
+        Output directory.
+    """
+    for spec_mean in residual_mean:
+        stat_id = spec_mean.id
+        figurefile = os.path.join(outdir, f'{stat_id}-res.png')
+        fig = plt.figure(dpi=160)
+        freq = spec_mean.get_freq()
+        mean = spec_mean.data_mag
+        std = spec_mean.data_mag_std
+        plt.fill_between(
+            freq, mean - std, mean + std, color='b', alpha=0.3, lw=0)
+        plt.semilogx(freq, mean, 'r-')
+        plt.xlabel('frequency (Hz)')
+        plt.ylabel('residual amplitude (obs - synth) in magnitude units')
+        nspectra = spec_mean.data_mag_count.max()
+        plt.title(
+            f'residuals: {stat_id} – {nspectra} records (mean ± std)')
+        fig.savefig(figurefile, bbox_inches='tight')
+        plt.close()
+        print(f'Residual plot saved to: {figurefile}')
+
+
 def plot_residuals(residual_dict, residual_mean, outdir):
     """
     Plot residuals.
@@ -171,25 +429,59 @@ def plot_residuals(residual_dict, residual_mean, outdir):
         print(f'Residual plot saved to: {figurefile}')
 
 
+def convert_residual_files(path):
+    """
+    Convert residual files from the legacy pickle format.
+
+    Parameters
+    ----------
+    path : str
+        A residual file or a directory containing residual files.
+    """
+    if os.path.isfile(path):
+        pickle_files = [path]
+    else:
+        pickle_files = [
+            resfile for resfile in find_residual_files(path)
+            if resfile.endswith('.pickle')]
+    pickle_files = [
+        file for file in pickle_files if not is_residual_store(file)]
+    if not pickle_files:
+        sys.exit(f'No residual file in pickle format found in: {path}')
+    for pickle_file in pickle_files:
+        store_file = convert_residuals_pickle(pickle_file)
+        print(f'Converted: {pickle_file} -> {store_file}')
+
+
 def main():
     """Main function."""
     args = parse_args()
 
-    residual_dict = read_residuals(args.residual_files_dir)
+    if args.convert:
+        convert_residual_files(args.residual_files_dir)
+        return
 
     outdir = args.outdir
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-
     min_spectra = int(args.min_spectra)
-    residual_mean = compute_mean_residuals(residual_dict, min_spectra)
-
-    if args.plot:
-        plot_residuals(residual_dict, residual_mean, outdir)
+    if args.streaming:
+        resfiles = find_residual_files(args.residual_files_dir)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        residual_mean = stream_mean_residuals(
+            resfiles, min_spectra, args.jobs)
+        if args.plot:
+            plot_mean_residuals(residual_mean, outdir)
+    else:
+        residual_dict = read_residuals(args.residual_files_dir)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        residual_mean = compute_mean_residuals(residual_dict, min_spectra)
+        if args.plot:
+            plot_residuals(residual_dict, residual_mean, outdir)
 
     # writes the mean residuals (the stations corrections)
-    res_mean_file = 'residual_mean.pickle'
+    res_mean_file = f'residual_mean{RESIDUAL_STORE_EXTENSION}'
     res_mean_file = os.path.join(outdir, res_mean_file)
-    with open(res_mean_file, 'wb') as fp:
-        pickle.dump(residual_mean, fp)
+    write_residual_store(
+        residual_mean, res_mean_file, metadata={'min_spectra': min_spectra})
     print(f'Mean station residuals saved to: {res_mean_file}')
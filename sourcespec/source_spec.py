@@ -26,13 +26,31 @@ def main():
 
     # Setup stage
     from sourcespec.ssp_setup import (
-        configure, move_outdir, remove_old_outdir, setup_logging,
-        save_config, ssp_exit)
+        configure, event_outdir, move_outdir, remove_outdir,
+        remove_old_outdir, setup_logging, save_config, ssp_exit)
     config = configure(options, progname='source_spec')
     setup_logging(config)
 
+    # Fingerprint of input files and config, to skip unchanged events
+    from sourcespec.ssp_fingerprint import EventFingerprint
+    fingerprint = EventFingerprint(config)
+
+    # Parameter sweep: check the sweep file before doing any work
+    if options.sweep_file:
+        from sourcespec.ssp_sweep import read_sweep_file
+        sweep_variants = read_sweep_file(config)
+
+    # Optional on-disk cache for reading, processing and building spectra
+    from sourcespec.ssp_cache import StageCache
+    stage_cache = StageCache(config)
+
     from sourcespec.ssp_read_traces import read_traces
-    st = read_traces(config)
+    st = stage_cache.run('read_traces', read_traces, config)
+
+    # Now that we have an evid, check if the event must be processed
+    if fingerprint.unchanged(event_outdir(config), st):
+        remove_outdir(config)
+        ssp_exit()
 
     # Now that we have an evid, we can rename the outdir and the log file
     move_outdir(config)
@@ -43,15 +61,28 @@ def main():
     save_config(config)
 
     # Deconvolve, filter, cut traces:
-    from sourcespec.ssp_process_traces import process_traces
-    proc_st = process_traces(config, st)
+    from sourcespec.ssp_process_traces import process_traces, trace_snippets
+    proc_st = stage_cache.run('process_traces', process_traces, config, st)
 
     # Build spectra (amplitude in magnitude units)
     from sourcespec.ssp_build_spectra import build_spectra
-    spec_st, specnoise_st, weight_st = build_spectra(config, proc_st)
-
-    from sourcespec.ssp_plot_traces import plot_traces
-    plot_traces(config, proc_st)
+    spec_st, specnoise_st, weight_st = stage_cache.run(
+        'build_spectra', build_spectra, config, proc_st)
+
+    if options.sweep_file:
+        # Only inversion and summary statistics for each sweep variant
+        from sourcespec.ssp_sweep import run_sweep
+        run_sweep(config, spec_st, specnoise_st, weight_st, sweep_variants)
+        ssp_exit()
+
+    # Figures are rendered in parallel, while computation goes on
+    # (plotting functions are given by name, so that plotting modules are
+    # only imported where figures are rendered)
+    from sourcespec.ssp_render import submit_plot, submit_plots, wait_plots
+    # only the part of the traces shown in the plot is sent for rendering
+    submit_plot(
+        config, 'sourcespec.ssp_plot_traces.plot_traces',
+        trace_snippets(config, proc_st))
 
     # Spectral inversion
     from sourcespec.ssp_inversion import spectral_inversion
@@ -81,21 +112,31 @@ def main():
     spectral_residuals(config, spec_st, sspec_output)
 
     # Plotting
-    from sourcespec.ssp_plot_spectra import plot_spectra
-    plot_spectra(config, spec_st, specnoise_st, plot_type='regular')
-    plot_spectra(config, weight_st, plot_type='weight')
-    from sourcespec.ssp_plot_stacked_spectra import plot_stacked_spectra
-    plot_stacked_spectra(config, spec_st, sspec_output)
-    from sourcespec.ssp_plot_params_stats import box_plots
-    box_plots(config, sspec_output)
+    plot_spectra = 'sourcespec.ssp_plot_spectra.plot_spectra'
+    # regular and weight spectral plots share the same bounding box
+    submit_plots(config, [
+        (plot_spectra, (spec_st, specnoise_st), {'plot_type': 'regular'}),
+        (plot_spectra, (weight_st, ), {'plot_type': 'weight'}),
+    ])
+    submit_plot(
+        config, 'sourcespec.ssp_plot_stacked_spectra.plot_stacked_spectra',
+        spec_st, sspec_output)
+    submit_plot(
+        config, 'sourcespec.ssp_plot_params_stats.box_plots', sspec_output)
     if config.plot_station_map:
-        from sourcespec.ssp_plot_stations import plot_stations
-        plot_stations(config, sspec_output)
-
-    if config.html_report:
+        submit_plot(
+            config, 'sourcespec.ssp_plot_stations.plot_stations',
+            sspec_output)
+    wait_plots(config)
+
+    if config.plot_deferred:
+        from sourcespec.ssp_render import save_plot_data
+        save_plot_data(config, sspec_output)
+    elif config.html_report:
         from sourcespec.ssp_html_report import html_report
         html_report(config, sspec_output)
 
+    fingerprint.save()
     ssp_exit()
 
 
@@ -0,0 +1,513 @@
+# -*- coding: utf8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Compare the results of two SourceSpec runs.
+
+The two runs are either two SQLite databases or two run ids in the same
+database. The second database is attached to the first one, and events
+(and stations) are joined on event id (and station id) with SQL queries
+using the table indexes.
+
+For each parameter, difference statistics are computed in a vectorized
+pass, together with the number of changed values and of station outliers.
+A compact report is printed, followed by the events which changed most.
+
+Differences are computed as B - A for Mw and t_star, and as log10(B/A) for
+the other parameters.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import os
+import sys
+import json
+import sqlite3
+import pathlib
+from argparse import ArgumentParser
+import numpy as np
+
+# Compared parameters: (parameter, Events column prefix, logarithmic)
+COMPARED_PARAMS = [
+    ('Mw', 'Mw', False),
+    ('fc', 'fc', True),
+    ('ssd', 'ssd', True),
+    ('Er', 'Er', True),
+    ('t_star', 't_star', False),
+    ('Qo', 'Qo', True),
+]
+# Number of station rows read at a time
+STATIONS_CHUNK_SIZE = 100000
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    """
+    parser = ArgumentParser(
+        description='Compare the results of two SourceSpec runs, stored in '
+                    'two SQLite databases or in the same database with two '
+                    'different run ids.')
+    parser.add_argument(
+        'sqlite_file_a', help='SQLite database of run A')
+    parser.add_argument(
+        'sqlite_file_b', nargs='?', default=None,
+        help='SQLite database of run B (default: same as run A)')
+    parser.add_argument(
+        '-a', '--runid_a', dest='runid_a', action='store', default=None,
+        help='run id of run A (default: compare events with the same run id '
+             'in the two databases)')
+    parser.add_argument(
+        '-b', '--runid_b', dest='runid_b', action='store', default=None,
+        help='run id of run B (default: compare events with the same run id '
+             'in the two databases)')
+    parser.add_argument(
+        '-s', '--statistics', dest='statistics', action='store',
+        default='wmean', choices=['mean', 'wmean', 'pctl'],
+        help='summary statistics to compare: "mean", "wmean" (weighted '
+             'mean) or "pctl" (percentiles). Default is "wmean"')
+    parser.add_argument(
+        '-t', '--tolerance', dest='tolerance', type=float, action='store',
+        default=1e-3,
+        help='a value has changed if the absolute value of its difference '
+             'is larger than TOLERANCE (default=1e-3)', metavar='TOLERANCE')
+    parser.add_argument(
+        '-n', '--ntop', dest='ntop', type=int, action='store', default=20,
+        help='number of most changed events to list (default=20)',
+        metavar='NUMBER')
+    parser.add_argument(
+        '-S', '--no_stations', dest='no_stations', action='store_true',
+        default=False, help='do not compare station parameters')
+    parser.add_argument(
+        '-j', '--json', dest='json_file', action='store', default=None,
+        help='save the comparison report to a JSON file', metavar='FILE')
+    args = parser.parse_args()
+    if (args.runid_a is None) != (args.runid_b is None):
+        parser.error('--runid_a and --runid_b must be used together')
+    if args.sqlite_file_b is None and args.runid_a is None:
+        parser.error(
+            'two run ids (--runid_a and --runid_b) are required to compare '
+            'runs in the same database')
+    return args
+
+
+def _connect(sqlite_file_a, sqlite_file_b=None):
+    """
+    Open database A, read-only, and attach database B as "b".
+
+    Parameters
+    ----------
+    sqlite_file_a : str
+        SQLite database of run A.
+    sqlite_file_b : str, optional
+        SQLite database of run B. If None, database A is attached.
+
+    Returns
+    -------
+    sqlite3.Connection
+        Database connection.
+    """
+    if sqlite_file_b is None:
+        sqlite_file_b = sqlite_file_a
+    uris = []
+    for sqlite_file in sqlite_file_a, sqlite_file_b:
+        if not os.path.isfile(sqlite_file):
+            raise FileNotFoundError(f'File "{sqlite_file}" not found')
+        uri = pathlib.Path(os.path.abspath(sqlite_file)).as_uri()
+        uris.append(f'{uri}?mode=ro')
+    conn = sqlite3.connect(uris[0], uri=True)
+    conn.execute('ATTACH DATABASE ? AS b;', (uris[1], ))
+    for schema, sqlite_file in ('main', sqlite_file_a), ('b', sqlite_file_b):
+        try:
+            tables = [
+                row[0] for row in conn.execute(
+                    f"SELECT name FROM {schema}.sqlite_master "
+                    "WHERE type='table';")]
+            db_version = conn.execute(
+                f'PRAGMA {schema}.user_version').fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            conn.close()
+            raise ValueError(
+                f'File "{sqlite_file}" is not a valid sqlite file') from e
+        for table in 'Events', 'Stations':
+            if table not in tables:
+                conn.close()
+                raise ValueError(
+                    f'Table "{table}" not found in file "{sqlite_file}"')
+        # column names changed in version 2
+        if db_version < 2:
+            conn.close()
+            raise ValueError(
+                f'"{sqlite_file}" has an old database version: '
+                f'"{db_version}". Update it with:\n\n'
+                f'  source_spec --updatedb {sqlite_file}\n')
+    return conn
+
+
+def _runid_condition(runid_a, runid_b):
+    """
+    Return the SQL condition on run ids for joining tables "ta" and "tb",
+    and its arguments.
+
+    If no run id is given, rows with the same run id are joined.
+    """
+    if runid_a is None:
+        return 'ta.runid IS tb.runid', ()
+    return 'ta.runid = ? AND tb.runid = ?', (runid_a, runid_b)
+
+
+def _count_events(conn, runid_a, runid_b):
+    """
+    Count events in A, in B and in both.
+
+    Returns
+    -------
+    dict
+        Event counts.
+    """
+    where_a = '' if runid_a is None else ' WHERE runid = ?'
+    where_b = '' if runid_b is None else ' WHERE runid = ?'
+    n_a = conn.execute(
+        f'SELECT COUNT(*) FROM main.Events{where_a};',
+        () if runid_a is None else (runid_a, )).fetchone()[0]
+    n_b = conn.execute(
+        f'SELECT COUNT(*) FROM b.Events{where_b};',
+        () if runid_b is None else (runid_b, )).fetchone()[0]
+    condition, condition_args = _runid_condition(runid_a, runid_b)
+    n_common = conn.execute(
+        'SELECT COUNT(*) FROM main.Events ta JOIN b.Events tb '
+        f'ON ta.evid = tb.evid AND {condition};',
+        condition_args).fetchone()[0]
+    return {
+        'A': n_a, 'B': n_b, 'common': n_common,
+        'only_A': n_a - n_common, 'only_B': n_b - n_common,
+    }
+
+
+def _differences(values_a, values_b, logarithmic):
+    """
+    Compute differences between two arrays of values.
+
+    Differences are B - A, or log10(B/A) if logarithmic is True.
+    Values which are not finite (or not positive, for logarithmic
+    differences) are NaN.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if logarithmic:
+            values_a = np.where(values_a > 0, values_a, np.nan)
+            values_b = np.where(values_b > 0, values_b, np.nan)
+            return np.log10(values_b / values_a)
+        return values_b - values_a
+
+
+class _DiffStats():
+    """
+    Running statistics of differences, accumulated over chunks of values.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.missing = 0
+        self.changed = 0
+        self.sum = 0.
+        self.sum_sq = 0.
+        self.max_abs = 0.
+        # only kept when all the differences are accumulated at once
+        self.abs_percentile_95 = None
+        self.median = None
+
+    def add(self, values_a, values_b, logarithmic, tolerance):
+        """Add differences between two arrays of values."""
+        diff = _differences(values_a, values_b, logarithmic)
+        valid = np.isfinite(diff)
+        # values missing (or not valid) in only one of the two runs
+        self.missing += int(np.sum(
+            np.isfinite(values_a) != np.isfinite(values_b)))
+        diff = diff[valid]
+        if diff.size == 0:
+            return diff
+        abs_diff = np.abs(diff)
+        self.n += diff.size
+        self.changed += int(np.sum(abs_diff > tolerance))
+        self.sum += float(np.sum(diff))
+        self.sum_sq += float(np.sum(diff**2))
+        self.max_abs = max(self.max_abs, float(np.max(abs_diff)))
+        return diff
+
+    def as_dict(self):
+        """Return the statistics as a dictionary."""
+        mean = self.sum / self.n if self.n else None
+        std = (
+            float(np.sqrt(max(self.sum_sq / self.n - mean**2, 0.)))
+            if self.n else None)
+        stats = {
+            'n': self.n, 'missing': self.missing, 'changed': self.changed,
+            'mean': mean, 'std': std,
+            'max_abs': self.max_abs if self.n else None,
+        }
+        if self.median is not None:
+            stats['median'] = self.median
+            stats['abs_percentile_95'] = self.abs_percentile_95
+        return stats
+
+
+def compare_events(conn, stat, runid_a=None, runid_b=None, tolerance=1e-3,
+                   ntop=20):
+    """
+    Compare event parameters.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to database A, with database B attached as "b".
+    stat : str
+        Summary statistics: "mean", "wmean" or "pctl".
+    runid_a : str, optional
+        Run id of run A.
+    runid_b : str, optional
+        Run id of run B.
+    tolerance : float, optional
+        Differences larger than tolerance are counted as changes.
+    ntop : int, optional
+        Number of most changed events to return.
+
+    Returns
+    -------
+    params : dict
+        Difference statistics, for each parameter.
+    top_events : list of dict
+        Most changed events, sorted by decreasing largest difference.
+    """
+    condition, condition_args = _runid_condition(runid_a, runid_b)
+    columns = ', '.join(
+        f'ta.{col}_{stat}, tb.{col}_{stat}' for _, col, _ in COMPARED_PARAMS)
+    rows = conn.execute(
+        f'SELECT ta.evid, ta.runid, tb.runid, {columns} '
+        'FROM main.Events ta JOIN b.Events tb '
+        f'ON ta.evid = tb.evid AND {condition} ORDER BY ta.evid;',
+        condition_args).fetchall()
+    ids = [row[:3] for row in rows]
+    values = np.array(
+        [row[3:] for row in rows], dtype=float
+    ).reshape(-1, 2 * len(COMPARED_PARAMS))
+    params = {}
+    diffs = np.full((len(rows), len(COMPARED_PARAMS)), np.nan)
+    for n, (param, _, logarithmic) in enumerate(COMPARED_PARAMS):
+        values_a = values[:, 2 * n]
+        values_b = values[:, 2 * n + 1]
+        diffs[:, n] = _differences(values_a, values_b, logarithmic)
+        stats = _DiffStats()
+        diff = stats.add(values_a, values_b, logarithmic, tolerance)
+        if diff.size:
+            stats.median = float(np.median(diff))
+            stats.abs_percentile_95 = float(np.percentile(np.abs(diff), 95))
+        params[param] = stats.as_dict()
+    # events are ranked by their largest absolute difference
+    abs_diffs = np.nan_to_num(np.abs(diffs), nan=-1.)
+    if not len(rows):
+        return params, []
+    max_idx = np.argmax(abs_diffs, axis=1)
+    max_abs = abs_diffs[np.arange(len(rows)), max_idx]
+    order = np.argsort(-max_abs, kind='stable')
+    top_events = []
+    for idx in order[:ntop]:
+        if max_abs[idx] <= tolerance:
+            break
+        n = max_idx[idx]
+        top_events.append({
+            'evid': ids[idx][0],
+            'runid_A': ids[idx][1],
+            'runid_B': ids[idx][2],
+            'param': COMPARED_PARAMS[n][0],
+            'A': float(values[idx, 2 * n]),
+            'B': float(values[idx, 2 * n + 1]),
+            'diff': float(diffs[idx, n]),
+            'nchanged': int(np.sum(abs_diffs[idx] > tolerance)),
+        })
+    return params, top_events
+
+
+def compare_stations(conn, runid_a=None, runid_b=None, tolerance=1e-3):
+    """
+    Compare station parameters and outliers.
+
+    Station rows are read in chunks, so that memory usage does not depend
+    on the size of the databases.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to database A, with database B attached as "b".
+    runid_a : str, optional
+        Run id of run A.
+    runid_b : str, optional
+        Run id of run B.
+    tolerance : float, optional
+        Differences larger than tolerance are counted as changes.
+
+    Returns
+    -------
+    counts : dict
+        Number of stations in common.
+    params : dict
+        Difference statistics and outlier counts, for each parameter.
+    """
+    condition, condition_args = _runid_condition(runid_a, runid_b)
+    columns = ', '.join(
+        f'ta.{col}, tb.{col}, ta.{col}_is_outlier, tb.{col}_is_outlier'
+        for _, col, _ in COMPARED_PARAMS)
+    # Stations primary key is (stid, evid, runid)
+    cursor = conn.execute(
+        f'SELECT {columns} FROM main.Stations ta JOIN b.Stations tb '
+        f'ON ta.stid = tb.stid AND ta.evid = tb.evid AND {condition};',
+        condition_args)
+    nparams = len(COMPARED_PARAMS)
+    stats = [_DiffStats() for _ in COMPARED_PARAMS]
+    outliers = np.zeros((nparams, 3), dtype=int)
+    ncommon = 0
+    while True:
+        rows = cursor.fetchmany(STATIONS_CHUNK_SIZE)
+        if not rows:
+            break
+        ncommon += len(rows)
+        values = np.array(rows, dtype=float).reshape(-1, 4 * nparams)
+        for n, (_, _, logarithmic) in enumerate(COMPARED_PARAMS):
+            stats[n].add(
+                values[:, 4 * n], values[:, 4 * n + 1], logarithmic,
+                tolerance)
+            outlier_a = values[:, 4 * n + 2] == 1
+            outlier_b = values[:, 4 * n + 3] == 1
+            outliers[n] += (
+                np.sum(outlier_a), np.sum(outlier_b),
+                np.sum(outlier_a != outlier_b))
+    params = {}
+    for n, (param, _, _) in enumerate(COMPARED_PARAMS):
+        params[param] = stats[n].as_dict()
+        params[param].update({
+            'outliers_A': int(outliers[n, 0]),
+            'outliers_B': int(outliers[n, 1]),
+            'outliers_changed': int(outliers[n, 2]),
+        })
+    return {'common': ncommon}, params
+
+
+def _format(value, fmt='.3g'):
+    """Format a value for the report, or "-" if it is None."""
+    return '-' if value is None else f'{value:{fmt}}'
+
+
+def _print_report(report):
+    """Print the comparison report."""
+    runs = report['runs']
+    for run in 'A', 'B':
+        runid = runs[run]['runid']
+        runid_str = '' if runid is None else f' (runid: {runid})'
+        print(f'Run {run}: {runs[run]["sqlite_file"]}{runid_str}')
+    print(
+        f'Statistics: {report["statistics"]}, '
+        f'tolerance: {report["tolerance"]:g}')
+    print('Differences are B - A for Mw and t_star, log10(B/A) for the '
+          'other parameters\n')
+    events = report['events']
+    print(
+        f'Events: {events["A"]} in A, {events["B"]} in B, '
+        f'{events["common"]} in common, {events["only_A"]} only in A, '
+        f'{events["only_B"]} only in B')
+    header = (
+        f'{"param":<8}{"n":>9}{"missing":>9}{"changed":>9}{"mean":>11}'
+        f'{"std":>11}{"median":>11}{"p95|d|":>11}{"max|d|":>11}')
+    print(header)
+    for param, stats in report['event_params'].items():
+        print(
+            f'{param:<8}{stats["n"]:>9}{stats["missing"]:>9}'
+            f'{stats["changed"]:>9}{_format(stats["mean"]):>11}'
+            f'{_format(stats["std"]):>11}'
+            f'{_format(stats.get("median")):>11}'
+            f'{_format(stats.get("abs_percentile_95")):>11}'
+            f'{_format(stats["max_abs"]):>11}')
+    if 'station_params' in report:
+        print(f'\nStations in common: {report["stations"]["common"]}')
+        print(
+            f'{"param":<8}{"n":>9}{"missing":>9}{"changed":>9}{"mean":>11}'
+            f'{"std":>11}{"max|d|":>11}{"outl. A":>9}{"outl. B":>9}'
+            f'{"outl. chg":>10}')
+        for param, stats in report['station_params'].items():
+            print(
+                f'{param:<8}{stats["n"]:>9}{stats["missing"]:>9}'
+                f'{stats["changed"]:>9}{_format(stats["mean"]):>11}'
+                f'{_format(stats["std"]):>11}'
+                f'{_format(stats["max_abs"]):>11}'
+                f'{stats["outliers_A"]:>9}{stats["outliers_B"]:>9}'
+                f'{stats["outliers_changed"]:>10}')
+    top_events = report['top_events']
+    if not top_events:
+        print('\nNo event changed more than the tolerance')
+        return
+    print('\nMost changed events (largest difference):')
+    print(
+        f'{"evid":<24}{"param":<8}{"A":>12}{"B":>12}{"diff":>11}'
+        f'{"nchanged":>9}')
+    for event in top_events:
+        print(
+            f'{str(event["evid"]):<24}{event["param"]:<8}'
+            f'{_format(event["A"], ".5g"):>12}'
+            f'{_format(event["B"], ".5g"):>12}'
+            f'{_format(event["diff"]):>11}{event["nchanged"]:>9}')
+
+
+def compare_runs(args):
+    """
+    Compare two SourceSpec runs.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments.
+
+    Returns
+    -------
+    dict
+        Comparison report.
+    """
+    conn = _connect(args.sqlite_file_a, args.sqlite_file_b)
+    try:
+        report = {
+            'runs': {
+                'A': {'sqlite_file': args.sqlite_file_a,
+                      'runid': args.runid_a},
+                'B': {'sqlite_file': args.sqlite_file_b or args.sqlite_file_a,
+                      'runid': args.runid_b},
+            },
+            'statistics': args.statistics,
+            'tolerance': args.tolerance,
+            'events': _count_events(conn, args.runid_a, args.runid_b),
+        }
+        report['event_params'], report['top_events'] = compare_events(
+            conn, args.statistics, args.runid_a, args.runid_b,
+            args.tolerance, args.ntop)
+        if not args.no_stations:
+            report['stations'], report['station_params'] = compare_stations(
+                conn, args.runid_a, args.runid_b, args.tolerance)
+    finally:
+        conn.close()
+    return report
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    try:
+        report = compare_runs(args)
+    except (FileNotFoundError, ValueError, sqlite3.Error) as msg:
+        sys.exit(f'Error: {msg}')
+    _print_report(report)
+    if args.json_file is not None:
+        with open(args.json_file, 'w', encoding='utf-8') as fp:
+            json.dump(report, fp, indent=2)
+        print(f'\nComparison report saved to: {args.json_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,764 @@
+# -*- coding: utf8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Export SourceSpec results for a whole catalogue into single files.
+
+Results are read, one event at a time, from a SourceSpec SQLite database
+or from a directory tree of per-event YAML files (``*.ssp.yaml``) and
+streamed to a single QuakeML file, a single multi-document YAML file
+and/or a single JSON Lines file (one JSON object per event).
+
+The QuakeML file is written with an incremental XML writer: memory usage
+does not depend on the size of the catalogue.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import os
+import sys
+import json
+import math
+import sqlite3
+from argparse import ArgumentParser
+from contextlib import contextmanager, ExitStack
+from itertools import takewhile
+import yaml
+from lxml import etree
+from obspy import UTCDateTime
+
+# Statistics, as named in the database and in the YAML files
+EXPORT_STATS = {
+    'mean': 'mean',
+    'wmean': 'weighted_mean',
+    'pctl': 'percentiles',
+}
+# Summary parameters: (output name, database column prefix)
+EXPORT_PARAMS = [
+    ('Mw', 'Mw'),
+    ('Mo', 'Mo'),
+    ('fc', 'fc'),
+    ('t_star', 't_star'),
+    ('radius', 'ra'),
+    ('ssd', 'ssd'),
+    ('Qo', 'Qo'),
+    ('Er', 'Er'),
+    ('sigma_a', 'sigma_a'),
+    ('Ml', 'Ml'),
+]
+# Station parameters: there is no station local magnitude
+STATION_PARAMS = EXPORT_PARAMS[:-1]
+# Run info: (output name, database column)
+RUN_INFO = [
+    ('SourceSpec_version', 'sourcespec_version'),
+    ('run_completed', 'run_completed'),
+    ('author_name', 'author_name'),
+    ('author_email', 'author_email'),
+    ('agency_full_name', 'agency_full_name'),
+    ('agency_short_name', 'agency_short_name'),
+    ('agency_url', 'agency_url'),
+]
+# Event info: (output name, database column)
+EVENT_INFO = [
+    ('longitude', 'lon'),
+    ('latitude', 'lat'),
+    ('depth_in_km', 'depth'),
+    ('origin_time', 'orig_time'),
+    ('vp_in_km_s', 'vp'),
+    ('vs_in_km_s', 'vs'),
+    ('rho_in_kg_m3', 'rho'),
+    ('kp', 'kp'),
+    ('ks', 'ks'),
+]
+
+QML_NS = 'http://quakeml.org/xmlns/quakeml/1.2'
+BED_NS = 'http://quakeml.org/xmlns/bed/1.2'
+SSP_NS = 'https://sourcespec.seismicsource.org'
+# Event summary parameters written as custom tags (same as ssp_qml_output)
+QML_EVENT_TAGS = [
+    ('cornerFrequency', 'fc'),
+    ('tStar', 't_star'),
+    ('sourceRadius', 'radius'),
+    ('staticStressDrop', 'ssd'),
+    ('radiatedEnergy', 'Er'),
+    ('apparentStress', 'sigma_a'),
+]
+# Station parameters written as custom tags (same as ssp_qml_output)
+QML_STATION_TAGS = [
+    ('moment', 'Mo'),
+    ('cornerFrequency', 'fc'),
+    ('tStar', 't_star'),
+]
+
+# Use the LibYAML bindings, if available: they are much faster
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def parse_args():
+    """
+    Parse command line arguments.
+    """
+    parser = ArgumentParser(
+        description='Export SourceSpec results for a whole catalogue to a '
+                    'single QuakeML, YAML and/or JSON Lines file.')
+    parser.add_argument(
+        'input',
+        help='SourceSpec SQLite database, or directory containing '
+             'SourceSpec output directories (with "*.ssp.yaml" files)')
+    parser.add_argument(
+        '-q', '--qml', dest='qml_file', action='store', default=None,
+        help='output QuakeML file', metavar='FILE')
+    parser.add_argument(
+        '-y', '--yaml', dest='yaml_file', action='store', default=None,
+        help='output YAML file (one YAML document per event)',
+        metavar='FILE')
+    parser.add_argument(
+        '-j', '--json', dest='json_file', action='store', default=None,
+        help='output JSON Lines file (one JSON object per line and per '
+             'event)', metavar='FILE')
+    parser.add_argument(
+        '-r', '--runid', dest='runid', action='store', default=None,
+        help='only export a specific runid (default: all)')
+    parser.add_argument(
+        '-s', '--statistics', dest='statistics', action='store',
+        default=None, choices=list(EXPORT_STATS.keys()),
+        help='summary statistics to export: "mean", "wmean" '
+             '(weighted mean) or "pctl" (percentiles). Default is the '
+             'reference statistics of each YAML file or "wmean" for a '
+             'database')
+    parser.add_argument(
+        '--smi_base', dest='smi_base', action='store', default='smi:local',
+        help='base for the QuakeML resource identifiers '
+             '(default="smi:local")')
+    parser.add_argument(
+        '--set_preferred_magnitude', dest='set_preferred_magnitude',
+        action='store_true', default=False,
+        help='set the SourceSpec Mw as the QuakeML preferred magnitude')
+    args = parser.parse_args()
+    if not any((args.qml_file, args.yaml_file, args.json_file)):
+        parser.error(
+            'at least one of --qml, --yaml or --json must be specified')
+    return args
+
+
+def _float_or_none(value):
+    """
+    Convert a value to float.
+
+    Returns None for missing, NaN or non-numeric values.
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def _time_or_none(value):
+    """Convert a time value to an ISO 8601 UTC string, or None."""
+    try:
+        return str(UTCDateTime(value))
+    except Exception:
+        return None
+
+
+def _parameter(value, lower_uncertainty=None, upper_uncertainty=None):
+    """Build a dictionary for a parameter value and its uncertainties."""
+    return {
+        'value': value,
+        'lower_uncertainty': lower_uncertainty,
+        'upper_uncertainty': upper_uncertainty,
+    }
+
+
+def _open_db(sqlite_file):
+    """
+    Open a SourceSpec SQLite database and check its version.
+
+    Parameters
+    ----------
+    sqlite_file : str
+        Path to the SQLite database.
+
+    Returns
+    -------
+    sqlite3.Connection
+        Database connection.
+    """
+    if not os.path.isfile(sqlite_file):
+        raise FileNotFoundError(f'File "{sqlite_file}" not found')
+    conn = sqlite3.connect(sqlite_file)
+    try:
+        tables = [
+            row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table';")]
+        db_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        conn.close()
+        raise ValueError(
+            f'File "{sqlite_file}" is not a valid sqlite file') from e
+    for table in 'Events', 'Stations':
+        if table not in tables:
+            conn.close()
+            raise ValueError(
+                f'Table "{table}" not found in file "{sqlite_file}"')
+    # column names changed in version 2
+    if db_version < 2:
+        conn.close()
+        raise ValueError(
+            f'"{sqlite_file}" has an old database version: '
+            f'"{db_version}". Update it with:\n\n'
+            f'  source_spec --updatedb {sqlite_file}\n')
+    return conn
+
+
+def _sort_key(evid, runid):
+    """
+    Key reproducing the SQLite ordering of (evid, runid).
+
+    NULL values come first in SQLite and cannot be compared in Python.
+    """
+    return evid or '', runid is not None, runid or ''
+
+
+def _db_records(sqlite_file, stat, runid=None):
+    """
+    Read event records from a SourceSpec SQLite database.
+
+    Events and Stations tables are read with two cursors, both ordered by
+    event id and run id, and merged on the fly, so that only one event
+    at a time is held in memory.
+
+    Parameters
+    ----------
+    sqlite_file : str
+        Path to the SQLite database.
+    stat : str
+        Summary statistics: "mean", "wmean" or "pctl".
+    runid : str, optional
+        Only read events with this runid.
+
+    Yields
+    ------
+    dict
+        Event record.
+    """
+    conn = _open_db(sqlite_file)
+    event_columns = (
+        ['evid', 'runid', 'wave_type', 'nsigma', 'mid_pct', 'lower_pct',
+         'upper_pct'] +
+        [col for _, col in RUN_INFO + EVENT_INFO] +
+        [f'{col}_{stat}{suffix}'
+         for _, col in EXPORT_PARAMS
+         for suffix in ('', '_err_minus', '_err_plus', '_nobs')]
+    )
+    station_columns = ['evid', 'runid', 'stid', 'dist', 'azimuth'] + [
+        f'{col}{suffix}'
+        for _, col in STATION_PARAMS
+        for suffix in ('', '_err_minus', '_err_plus', '_is_outlier')
+    ]
+    where = ' WHERE runid = ?' if runid is not None else ''
+    query_args = (runid,) if runid is not None else ()
+    events = conn.execute(
+        f'SELECT {", ".join(event_columns)} FROM Events{where} '
+        'ORDER BY evid, runid;', query_args)
+    stations = conn.execute(
+        f'SELECT {", ".join(station_columns)} FROM Stations{where} '
+        'ORDER BY evid, runid, stid;', query_args)
+    station_row = stations.fetchone()
+    try:
+        for event_row in events:
+            event = dict(zip(event_columns, event_row))
+            key = _sort_key(event['evid'], event['runid'])
+            # skip stations without an event, then collect event stations
+            while (
+                station_row is not None and
+                    _sort_key(*station_row[:2]) < key):
+                station_row = stations.fetchone()
+            station_rows = []
+            while (
+                station_row is not None and
+                    _sort_key(*station_row[:2]) == key):
+                station_rows.append(station_row)
+                station_row = stations.fetchone()
+            yield _db_record(event, station_rows, stat)
+    finally:
+        conn.close()
+
+
+def _db_record(event, station_rows, stat):
+    """
+    Build an event record from database rows.
+
+    Values are used as they are: NaN values are stored as NULL by SQLite.
+    """
+    if stat == 'pctl':
+        # write_sqlite() stores the lower percentage in the "mid_pct"
+        # column and the mid percentage in the "lower_pct" column:
+        # the lower percentage is the smallest of the two
+        pcts = (event['mid_pct'], event['lower_pct'], event['upper_pct'])
+        confidence_level = (
+            None if None in pcts
+            else round(pcts[2] - min(pcts[:2]), 2))
+    else:
+        nsigma = _float_or_none(event['nsigma'])
+        confidence_level = (
+            None if nsigma is None
+            else round(math.erf(nsigma / math.sqrt(2)) * 100, 2))
+    run_info = {name: event[col] for name, col in RUN_INFO}
+    run_info['run_id'] = event['runid'] or None
+    event_info = {'event_id': event['evid']}
+    event_info.update({
+        name: event[col]
+        for name, col in EVENT_INFO if name != 'origin_time'})
+    event_info['origin_time'] = _time_or_none(event['orig_time'])
+    summary = {'reference_statistics': EXPORT_STATS[stat]}
+    for name, col in EXPORT_PARAMS:
+        par = _parameter(
+            event[f'{col}_{stat}'],
+            event[f'{col}_{stat}_err_minus'],
+            event[f'{col}_{stat}_err_plus'])
+        # e.g., local magnitude, when not computed
+        if par['value'] is None:
+            continue
+        par['confidence_level'] = confidence_level
+        par['nobs'] = event[f'{col}_{stat}_nobs']
+        summary[name] = par
+    station_parameters = {}
+    # station rows: evid, runid, stid, dist, azimuth, then value,
+    # err_minus, err_plus and is_outlier for each parameter
+    for row in station_rows:
+        station = {'hypo_dist_in_km': row[3], 'azimuth': row[4]}
+        for n, (name, _) in enumerate(STATION_PARAMS, start=1):
+            par = _parameter(*row[4 * n + 1:4 * n + 4])
+            par['outlier'] = bool(row[4 * n + 4])
+            station[name] = par
+        station_parameters[row[2]] = station
+    return {
+        'run_info': run_info,
+        'event_info': event_info,
+        'inversion_info': {'wave_type': event['wave_type']},
+        'summary_spectral_parameters': summary,
+        'station_parameters': station_parameters,
+    }
+
+
+def _yaml_files(directory):
+    """Find SourceSpec YAML files in a directory tree, in sorted order."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.endswith('.ssp.yaml'):
+                yield os.path.join(root, filename)
+
+
+def _yaml_parameter(values):
+    """Build a parameter dictionary from a YAML parameter."""
+    if 'uncertainty' in values:
+        lower_uncertainty = upper_uncertainty = values['uncertainty']
+    else:
+        lower_uncertainty = values.get('lower_uncertainty')
+        upper_uncertainty = values.get('upper_uncertainty')
+    return _parameter(
+        _float_or_none(values.get('value')),
+        _float_or_none(lower_uncertainty),
+        _float_or_none(upper_uncertainty))
+
+
+def _yaml_records(directory, stat=None, runid=None):
+    """
+    Read event records from per-event SourceSpec YAML files.
+
+    Parameters
+    ----------
+    directory : str
+        Directory containing SourceSpec YAML files (searched recursively).
+    stat : str, optional
+        Summary statistics: "mean", "wmean" or "pctl". If None, use the
+        reference statistics of each file.
+    runid : str, optional
+        Only read events with this runid.
+
+    Yields
+    ------
+    dict
+        Event record.
+    """
+    for yaml_file in _yaml_files(directory):
+        with open(yaml_file, encoding='utf-8') as fp:
+            # the final "comments" section of SourceSpec YAML files can
+            # contain multi-line strings which are not valid YAML: skip it
+            text = ''.join(
+                takewhile(lambda line: line != 'comments:\n', fp))
+            try:
+                data = yaml.load(text, Loader=_YAML_LOADER)
+            except yaml.YAMLError as msg:
+                print(f'Skipping "{yaml_file}": {msg}', file=sys.stderr)
+                continue
+        try:
+            record = _yaml_record(data, stat)
+        except (AttributeError, KeyError, TypeError) as msg:
+            print(
+                f'Skipping "{yaml_file}": not a SourceSpec YAML file '
+                f'({msg})', file=sys.stderr)
+            continue
+        if runid is not None and record['run_info']['run_id'] != runid:
+            continue
+        yield record
+
+
+def _yaml_record(data, stat=None):
+    """Build an event record from the content of a SourceSpec YAML file."""
+    data_run_info = data.get('run_info') or {}
+    run_info = {name: data_run_info.get(name) for name, _ in RUN_INFO}
+    run_info['run_id'] = data_run_info.get('run_id')
+    data_event_info = data['event_info']
+    event_info = {'event_id': str(data_event_info['event_id'])}
+    event_info.update({
+        name: _float_or_none(data_event_info.get(name))
+        for name, _ in EVENT_INFO if name != 'origin_time'})
+    event_info['origin_time'] = _time_or_none(
+        data_event_info.get('origin_time'))
+    data_summary = data.get('summary_spectral_parameters') or {}
+    stat_name = (
+        EXPORT_STATS[stat] if stat is not None
+        else data_summary.get('reference_statistics', 'weighted_mean'))
+    summary = {'reference_statistics': stat_name}
+    for name, _ in EXPORT_PARAMS:
+        values = (data_summary.get(name) or {}).get(stat_name)
+        if not values:
+            continue
+        par = _yaml_parameter(values)
+        par['confidence_level'] = _float_or_none(
+            values.get('confidence_level'))
+        par['nobs'] = values.get('nobs')
+        summary[name] = par
+    station_parameters = {}
+    for stid, data_station in (data.get('station_parameters') or {}).items():
+        station = {
+            'hypo_dist_in_km': _float_or_none(
+                data_station.get('hypo_dist_in_km')),
+            'azimuth': _float_or_none(data_station.get('azimuth')),
+        }
+        for name, _ in STATION_PARAMS:
+            values = data_station.get(name)
+            if not isinstance(values, dict):
+                continue
+            par = _yaml_parameter(values)
+            par['outlier'] = bool(values.get('outlier', False))
+            station[name] = par
+        station_parameters[stid] = station
+    return {
+        'run_info': run_info,
+        'event_info': event_info,
+        'inversion_info': {
+            'wave_type': (data.get('inversion_info') or {}).get('wave_type')
+        },
+        'summary_spectral_parameters': summary,
+        'station_parameters': station_parameters,
+    }
+
+
+def _sub(parent, tag, text=None, namespace=BED_NS, **attrib):
+    """Add a subelement, with optional text, to a QuakeML element."""
+    element = etree.SubElement(parent, f'{{{namespace}}}{tag}', **attrib)
+    if text is not None:
+        element.text = str(text)
+    return element
+
+
+def _real_quantity(parent, tag, par, confidence_level=None):
+    """
+    Add a QuakeML RealQuantity element.
+
+    Symmetric uncertainties are written as a single uncertainty.
+    Nothing is written if the value is missing.
+    """
+    if par is None or par['value'] is None:
+        return
+    element = _sub(parent, tag)
+    _sub(element, 'value', par['value'])
+    lower = par['lower_uncertainty']
+    upper = par['upper_uncertainty']
+    if lower is not None and lower == upper:
+        _sub(element, 'uncertainty', lower)
+    else:
+        if lower is not None:
+            _sub(element, 'lowerUncertainty', lower)
+        if upper is not None:
+            _sub(element, 'upperUncertainty', upper)
+    if confidence_level is not None:
+        _sub(element, 'confidenceLevel', confidence_level)
+
+
+def _ssp_tag(parent, tag, par):
+    """Add a SourceSpec custom tag for a summary parameter."""
+    if par is None or par['value'] is None:
+        return
+    element = _sub(parent, tag, namespace=SSP_NS)
+    _sub(element, 'value', par['value'], namespace=SSP_NS)
+    lower = par['lower_uncertainty']
+    upper = par['upper_uncertainty']
+    if lower is not None and lower == upper:
+        _sub(element, 'uncertainty', lower, namespace=SSP_NS)
+    else:
+        if lower is not None:
+            _sub(element, 'lowerUncertainty', lower, namespace=SSP_NS)
+        if upper is not None:
+            _sub(element, 'upperUncertainty', upper, namespace=SSP_NS)
+    if par.get('confidence_level') is not None:
+        _sub(
+            element, 'confidenceLevel', par['confidence_level'],
+            namespace=SSP_NS)
+
+
+def _creation_info(parent, run_info):
+    """Add a QuakeML CreationInfo element, if there is author or agency."""
+    agency = run_info.get('agency_short_name')
+    author = run_info.get('author_name')
+    if agency is None and author is None:
+        return
+    element = _sub(parent, 'creationInfo')
+    if agency is not None:
+        _sub(element, 'agencyID', agency)
+    if author is not None:
+        _sub(element, 'author', author)
+
+
+def _waveform_id(parent, stid):
+    """Add a QuakeML WaveformStreamID element from a SEED id."""
+    try:
+        net, sta, loc, chan = stid.split('.')
+    except ValueError:
+        return
+    attrib = {'networkCode': net, 'stationCode': sta}
+    if loc:
+        attrib['locationCode'] = loc
+    if chan:
+        attrib['channelCode'] = chan
+    _sub(parent, 'waveformID', **attrib)
+
+
+def _qml_event(record, smi_base, set_preferred_magnitude=False):
+    """
+    Build a QuakeML event element from an event record.
+
+    Resource identifiers follow the default templates of the
+    SourceSpec configuration file, with the event id (and the run id,
+    if any) in place of the origin id. Station magnitude identifiers
+    contain a single "#", to be valid QuakeML.
+    """
+    run_info = record['run_info']
+    event_info = record['event_info']
+    summary = record['summary_spectral_parameters']
+    key = event_info['event_id']
+    if run_info['run_id']:
+        key += f'_{run_info["run_id"]}'
+    method_id = f'{smi_base}/sourcespec/{run_info["SourceSpec_version"]}'
+    origin_id = f'{smi_base}/Origin/{key}'
+    mag_id = f'{smi_base}/Magnitude/Origin/{key}#sourcespec'
+    has_origin = None not in (
+        event_info['origin_time'], event_info['latitude'],
+        event_info['longitude'])
+    has_mag = (
+        summary.get('Mw') is not None and
+        summary['Mw']['value'] is not None)
+    ev = etree.Element(
+        f'{{{BED_NS}}}event', publicID=f'{smi_base}/Event/{key}',
+        nsmap={None: BED_NS, 'ssp': SSP_NS})
+    if has_origin:
+        _sub(ev, 'preferredOriginID', origin_id)
+    if has_mag and set_preferred_magnitude:
+        _sub(ev, 'preferredMagnitudeID', mag_id)
+    _creation_info(ev, run_info)
+    if has_origin:
+        origin = _sub(ev, 'origin', publicID=origin_id)
+        _sub(_sub(origin, 'time'), 'value', event_info['origin_time'])
+        _sub(_sub(origin, 'latitude'), 'value', event_info['latitude'])
+        _sub(_sub(origin, 'longitude'), 'value', event_info['longitude'])
+        if event_info['depth_in_km'] is not None:
+            _sub(
+                _sub(origin, 'depth'), 'value',
+                event_info['depth_in_km'] * 1e3)
+    stations = record['station_parameters']
+    station_mag_ids = []
+    if has_mag:
+        Mw = summary['Mw']
+        mag = _sub(ev, 'magnitude', publicID=mag_id)
+        _real_quantity(mag, 'mag', Mw, Mw['confidence_level'])
+        _sub(mag, 'type', 'Mw')
+        if has_origin:
+            _sub(mag, 'originID', origin_id)
+        _sub(mag, 'methodID', method_id)
+        _sub(mag, 'stationCount', len(stations))
+        _sub(mag, 'evaluationMode', 'automatic')
+        _creation_info(mag, run_info)
+        for stid in sorted(stations):
+            if stations[stid].get('Mw', {}).get('value') is None:
+                continue
+            station_mag_id = (
+                f'{smi_base}/StationMagnitude/Origin/{key}/{stid}'
+                '#sourcespec')
+            station_mag_ids.append((stid, station_mag_id))
+            contribution = _sub(mag, 'stationMagnitudeContribution')
+            _sub(contribution, 'stationMagnitudeID', station_mag_id)
+    for stid, station_mag_id in station_mag_ids:
+        par = stations[stid]
+        st_mag = _sub(ev, 'stationMagnitude', publicID=station_mag_id)
+        if has_origin:
+            _sub(st_mag, 'originID', origin_id)
+        _sub(_sub(st_mag, 'mag'), 'value', par['Mw']['value'])
+        _sub(st_mag, 'type', 'Mw')
+        _sub(st_mag, 'methodID', method_id)
+        _waveform_id(st_mag, stid)
+        _creation_info(st_mag, run_info)
+        for tag, name in QML_STATION_TAGS:
+            value = par.get(name, {}).get('value')
+            if value is not None:
+                _sub(st_mag, tag, value, namespace=SSP_NS)
+    # Seismic moment is stored in a MomentTensor object,
+    # which is part of a FocalMechanism object
+    Mo = summary.get('Mo')
+    if has_origin and Mo is not None and Mo['value'] is not None:
+        fm = _sub(
+            ev, 'focalMechanism',
+            publicID=f'{smi_base}/FocalMechanism/Origin/{key}#sourcespec')
+        _sub(fm, 'triggeringOriginID', origin_id)
+        mt = _sub(
+            fm, 'momentTensor',
+            publicID=f'{smi_base}/MomentTensor/Origin/{key}#sourcespec')
+        _sub(mt, 'derivedOriginID', origin_id)
+        if has_mag:
+            _sub(mt, 'momentMagnitudeID', mag_id)
+        _real_quantity(mt, 'scalarMoment', Mo, Mo['confidence_level'])
+        _sub(mt, 'methodID', method_id)
+        _creation_info(mt, run_info)
+        _sub(fm, 'methodID', method_id)
+        _creation_info(fm, run_info)
+    for tag, name in QML_EVENT_TAGS:
+        _ssp_tag(ev, tag, summary.get(name))
+    return ev
+
+
+@contextmanager
+def _qml_writer(qml_file, smi_base, set_preferred_magnitude=False):
+    """
+    Context manager returning a function which writes an event record
+    to a QuakeML file.
+
+    The file is written incrementally: only the current event is kept
+    in memory.
+    """
+    with etree.xmlfile(qml_file, encoding='utf-8') as xf:
+        xf.write_declaration()
+        nsmap = {'q': QML_NS, None: BED_NS, 'ssp': SSP_NS}
+        with xf.element(f'{{{QML_NS}}}quakeml', nsmap=nsmap):
+            with xf.element(
+                    f'{{{BED_NS}}}eventParameters',
+                    publicID=f'{smi_base}/EventParameters'):
+                def _write(record):
+                    xf.write(
+                        _qml_event(record, smi_base, set_preferred_magnitude),
+                        pretty_print=True)
+                yield _write
+
+
+@contextmanager
+def _yaml_writer(yaml_file):
+    """
+    Context manager returning a function which writes an event record
+    to a YAML file, as a separate YAML document.
+    """
+    with open(yaml_file, 'w', encoding='utf-8') as fp:
+        fp.write('# SourceSpec catalogue in YAML format\n')
+
+        def _write(record):
+            yaml.dump(
+                record, fp, Dumper=_YAML_DUMPER, explicit_start=True,
+                sort_keys=False, default_flow_style=None,
+                allow_unicode=True, width=1000)
+        yield _write
+
+
+@contextmanager
+def _json_writer(json_file):
+    """
+    Context manager returning a function which writes an event record
+    to a JSON Lines file.
+    """
+    with open(json_file, 'w', encoding='utf-8') as fp:
+        def _write(record):
+            fp.write(json.dumps(record, allow_nan=False))
+            fp.write('\n')
+        yield _write
+
+
+def export_catalog(records, qml_file=None, yaml_file=None, json_file=None,
+                   smi_base='smi:local', set_preferred_magnitude=False):
+    """
+    Write event records to QuakeML, YAML and/or JSON Lines files.
+
+    Records are written as soon as they are read, in a single pass.
+
+    Parameters
+    ----------
+    records : iterable of dict
+        Event records.
+    qml_file : str, optional
+        Output QuakeML file.
+    yaml_file : str, optional
+        Output YAML file.
+    json_file : str, optional
+        Output JSON Lines file.
+    smi_base : str, optional
+        Base for the QuakeML resource identifiers.
+    set_preferred_magnitude : bool, optional
+        Set the SourceSpec Mw as the QuakeML preferred magnitude.
+
+    Returns
+    -------
+    int
+        Number of exported events.
+    """
+    nevents = 0
+    with ExitStack() as stack:
+        writers = []
+        if qml_file is not None:
+            writers.append(stack.enter_context(
+                _qml_writer(qml_file, smi_base, set_preferred_magnitude)))
+        if yaml_file is not None:
+            writers.append(stack.enter_context(_yaml_writer(yaml_file)))
+        if json_file is not None:
+            writers.append(stack.enter_context(_json_writer(json_file)))
+        for record in records:
+            for write in writers:
+                write(record)
+            nevents += 1
+    return nevents
+
+
+def main():
+    """Main function."""
+    args = parse_args()
+    try:
+        if os.path.isdir(args.input):
+            records = _yaml_records(args.input, args.statistics, args.runid)
+        else:
+            records = _db_records(
+                args.input, args.statistics or 'wmean', args.runid)
+        nevents = export_catalog(
+            records, args.qml_file, args.yaml_file, args.json_file,
+            args.smi_base, args.set_preferred_magnitude)
+    except (FileNotFoundError, ValueError, sqlite3.Error) as msg:
+        sys.exit(f'Error: {msg}')
+    print(f'{nevents} events exported')
+    for outfile in args.qml_file, args.yaml_file, args.json_file:
+        if outfile is not None:
+            print(f'  {outfile}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,724 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+On-disk cache for the stages preceding the spectral inversion.
+
+The results of ``read_traces()``, ``process_traces()`` and
+``build_spectra()`` are stored in a cache directory, under a key computed
+from the content of the inputs used for the event and from the config
+parameters each stage depends on. Each key includes the key of the previous
+stage, so that any change upstream invalidates all the downstream stages.
+
+Only the inputs used for the event are hashed: the trace files read, the
+event record in the QuakeML file, the station metadata of the traces read
+and the NLL grids for the event stations. Since they are only known once
+``read_traces()`` has run, they are recorded in a manifest, which is used to
+compute the ``read_traces()`` key on the next runs.
+
+Entries are stored as pickle files, since stage results are ObsPy streams
+(or spectra) whose traces carry station metadata, event and pick objects,
+which have no plain array representation. The SourceSpec version is part of
+the key, so that entries are only read back by the version which wrote them.
+
+A command line tool (``source_spec_cache``) is provided to inspect and prune
+the cache.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import io
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import contextlib
+from glob import glob
+from datetime import datetime
+from obspy import UTCDateTime
+from obspy.core import Stream
+from obspy.core.inventory import Inventory
+from sourcespec._version import get_versions
+from sourcespec.ssp_read_event_metadata import get_qml_event_xml
+from sourcespec.ssp_read_station_metadata import read_station_metadata
+from sourcespec.ssp_read_traces import select_inventory
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
+
+STAGES = ('read_traces', 'process_traces', 'build_spectra')
+
+# Config parameters each stage depends on.
+# Parameters ending with "_" are prefixes for instrument-type or
+# station-specific parameters (e.g., "bp_freqmin_broadb").
+STAGE_CONFIG_KEYS = {
+    'read_traces': (
+        'mis_oriented_channels', 'instrument_code_acceleration',
+        'instrument_code_velocity', 'sensitivity',
+        'vp_source', 'vs_source', 'rho_source', 'layer_top_depths',
+        'qml_event_description', 'qml_event_description_regex',
+    ),
+    'process_traces': (
+        'ignore_traceids', 'use_traceids', 'epi_dist_ranges',
+        'correct_instrumental_response', 'trace_units',
+        'vp_tt', 'vs_tt', 'p_arrival_tolerance', 's_arrival_tolerance',
+        'noise_pre_time', 'signal_pre_time', 'win_length',
+        'wave_type', 'ignore_vertical', 'remove_baseline',
+        'bp_freqmin_', 'bp_freqmax_', 'rmsmin', 'sn_min', 'prescreen_sn_min',
+        'clipping_detection_algorithm', 'clipping_score_threshold',
+        'clipping_peaks_sensitivity', 'clipping_peaks_percentile',
+        'gap_max', 'overlap_max', 'weighting', 'rp_from_focal_mechanism',
+    ),
+    'build_spectra': (
+        'wave_type', 'weighting', 'f_weight', 'weight', 'trace_units',
+        'time_domain_int', 'spectral_win_length', 'taper_halfwidth',
+        'spectral_smooth_width_decades', 'spectral_sn_min',
+        'spectral_sn_freq_range', 'freq1_', 'freq2_', 'bp_freqmin_',
+        'bp_freqmax_', 'geom_spread_model', 'geom_spread_n_exponent',
+        'geom_spread_cutoff_distance', 'geom_spread_min_teleseismic_distance',
+        'free_surface_amplification', 'rpp', 'rps', 'rp_from_focal_mechanism',
+        'vp_source', 'vs_source', 'rho_source', 'layer_top_depths',
+        'vp_stations', 'vs_stations', 'rho_stations',
+    ),
+}
+
+# Command line options each stage depends on
+STAGE_OPTIONS = {
+    'read_traces': ('evid', 'evname', 'station'),
+    'process_traces': (),
+    'build_spectra': (),
+}
+
+# Config parameters (or command line options, prefixed by "options.")
+# pointing to input files, whose content is hashed
+STAGE_INPUT_FILES = {
+    'read_traces': (
+        'options.hypo_file', 'options.pick_file', 'traceid_mapping_file'),
+    'process_traces': ('clipping_skip_list', ),
+    'build_spectra': ('residuals_filepath', ),
+}
+
+# Input paths of read_traces(). Only the inputs used for the event are
+# hashed (see StageCache._input_hashes())
+READ_TRACES_PATHS = (
+    'options.trace_path', 'options.qml_file', 'station_metadata')
+
+# NLL grids each stage depends on: velocity model grids ("model") and
+# travel time and takeoff angle grids of the event stations ("time")
+STAGE_NLL_GRIDS = {
+    'read_traces': ('model', ),
+    'process_traces': ('time', ),
+    'build_spectra': ('model', ),
+}
+
+# Config values (and command line options) set by each stage, which are
+# restored when the stage results are loaded from cache
+STAGE_CONFIG_OUTPUTS = {
+    'read_traces': ('event', 'hypo_file_format', 'trace_files'),
+    'process_traces': (),
+    'build_spectra': (),
+}
+STAGE_OPTION_OUTPUTS = {
+    'read_traces': ('evname', ),
+    'process_traces': (),
+    'build_spectra': (),
+}
+
+# Size of the chunks used to hash file content
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """Return the SHA-256 hash of the content of a file."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def file_hashes(path):
+    """
+    Return a dictionary of the hashes of a file or of all the files in a
+    directory (recursively), indexed by file path.
+    """
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        files = [path]
+    elif os.path.isdir(path):
+        files = [
+            os.path.join(root, filename)
+            for root, _, filenames in os.walk(path)
+            for filename in filenames
+        ]
+    else:
+        return {path: 'missing'}
+    hashes = {}
+    for filepath in sorted(files):
+        try:
+            hashes[filepath] = file_hash(filepath)
+        except OSError:
+            hashes[filepath] = 'unreadable'
+    return hashes
+
+
+def inventory_hash(inventory):
+    """
+    Return the SHA-256 hash of an inventory, independent of the time it
+    was read at.
+    """
+    inventory = Inventory(
+        networks=inventory.networks, source='SourceSpec',
+        created=UTCDateTime(0), module=None, module_uri=None)
+    buffer = io.BytesIO()
+    inventory.write(buffer, format='STATIONXML')
+    return hashlib.sha256(buffer.getvalue()).hexdigest()
+
+
+def nll_grid_hashes(config, stations, grids=('model', 'time')):
+    """
+    Return the hashes of the NLL grids, by file path.
+
+    :param config: Config object
+    :param stations: Station codes, for the "time" grids
+    :param grids: Grids to hash: "model" for the velocity model grids,
+        "time" for the travel time and takeoff angle grids of the given
+        stations (and of the "DEFAULT" station)
+    """
+    patterns = []
+    if 'model' in grids and config.NLL_model_dir is not None:
+        patterns.append(os.path.join(config.NLL_model_dir, '*.mod.*'))
+    if 'time' in grids and config.NLL_time_dir is not None:
+        # time and angle grids: "*.<phase>.<station>.<grid_type>.*"
+        patterns.extend(
+            os.path.join(config.NLL_time_dir, f'*.*.{station}.*')
+            for station in sorted(set(stations) | {'DEFAULT'}))
+    hashes = {}
+    for pattern in patterns:
+        for path in glob(pattern):
+            hashes.update(file_hashes(path))
+    return hashes
+
+
+def _list_files(paths):
+    """Return the sorted list of the files in the given paths."""
+    files = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(root, filename)
+                for root, _, filenames in os.walk(path)
+                for filename in filenames)
+        else:
+            files.append(path)
+    return sorted(files)
+
+
+def _get_value(config, name):
+    """Get a config value or a command line option ("options.name")."""
+    if name.startswith('options.'):
+        return getattr(config.options, name.split('.', 1)[1], None)
+    return config.get(name)
+
+
+def _stage_config_values(config, stage):
+    """Return a dictionary of the config values a stage depends on."""
+    values = {}
+    for key in STAGE_CONFIG_KEYS[stage]:
+        if key.endswith('_'):
+            values.update({
+                k: v for k, v in config.items()
+                if k.startswith(key) and not isinstance(v, dict)
+            })
+        else:
+            values[key] = config.get(key)
+    for opt in STAGE_OPTIONS[stage]:
+        values[f'options.{opt}'] = getattr(config.options, opt, None)
+    return values
+
+
+def _relink_event(stream, event):
+    """Make all traces in stream point to the given event object."""
+    for trace in stream:
+        if 'event' in trace.stats:
+            trace.stats.event = event
+
+
+class StageCache():
+    """
+    On-disk cache for ``read_traces()``, ``process_traces()`` and
+    ``build_spectra()``.
+
+    The cache is disabled if ``config.cache_dir`` is ``None``.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.cache_dir = config.get('cache_dir')
+        self._keys = {}
+        self._inputs = {}
+        # station metadata, read once to hash the inventories of the traces
+        self._inventory = None
+
+    @property
+    def enabled(self):
+        """True if the cache is enabled."""
+        return self.cache_dir is not None
+
+    def _lookup_key(self, stage):
+        """
+        Return the SHA-256 hash of the SourceSpec version, the key of the
+        previous stage and the config parameters the stage depends on.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(f'sourcespec:{get_versions()["version"]}\n'.encode())
+        idx = STAGES.index(stage)
+        if idx > 0:
+            hasher.update(
+                f'previous:{self._keys.get(STAGES[idx - 1])}\n'.encode())
+        values = _stage_config_values(self.config, stage)
+        if stage == 'read_traces':
+            values.update({
+                name: _get_value(self.config, name)
+                for name in READ_TRACES_PATHS})
+        hasher.update(
+            json.dumps(values, sort_keys=True, default=str).encode())
+        return hasher.hexdigest()
+
+    def _manifest_file(self, lookup_key):
+        """Return the path of a read_traces() manifest."""
+        return os.path.join(
+            self.cache_dir, 'read_traces', 'manifests', f'{lookup_key}.json')
+
+    def _read_manifest(self, lookup_key):
+        """Read a read_traces() manifest. Return None if not available."""
+        manifest_file = self._manifest_file(lookup_key)
+        try:
+            with open(manifest_file, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as msg:
+            logger.warning(
+                f'Unable to read cache manifest {manifest_file}: {msg}. '
+                'Ignoring it.')
+            return None
+
+    def _write_manifest(self, lookup_key, st):
+        """
+        Write the manifest of the inputs used by read_traces(): the trace
+        files read and the ids of the traces.
+        """
+        manifest = {
+            'trace_files': self.config.get('trace_files') or [],
+            'trace_ids': sorted({trace.id for trace in st}),
+        }
+        manifest_file = self._manifest_file(lookup_key)
+        tmp_file = f'{manifest_file}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+            with open(tmp_file, 'w', encoding='utf-8') as fp:
+                json.dump(manifest, fp, indent=2)
+            os.replace(tmp_file, manifest_file)
+        except OSError as msg:
+            logger.warning(
+                f'Unable to write cache manifest {manifest_file}: {msg}')
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+        return manifest
+
+    def _event_hashes(self):
+        """Return the hash of the event record in the QuakeML file."""
+        qml_file = self.config.options.qml_file
+        if qml_file is None:
+            return {}
+        evid = self.config.options.evid
+        key = f'{os.path.abspath(qml_file)}#{evid}'
+        try:
+            xml = get_qml_event_xml(qml_file, evid)
+        except (OSError, ValueError, SyntaxError):
+            return {key: 'unreadable'}
+        return {key: hashlib.sha256(xml).hexdigest()}
+
+    def _inventory_hashes(self, trace_ids):
+        """Return the hashes of the station metadata, by trace id."""
+        if self._inventory is None:
+            self._inventory = read_station_metadata(
+                self.config.station_metadata)
+        return {
+            f'inventory:{trace_id}':
+            inventory_hash(select_inventory(self._inventory, trace_id))
+            for trace_id in trace_ids
+        }
+
+    def _input_hashes(self, stage, trace_ids, trace_files=()):
+        """
+        Return the hashes of the inputs of a stage, for the traces with
+        the given ids.
+        """
+        hashes = {}
+        for name in STAGE_INPUT_FILES[stage]:
+            path = _get_value(self.config, name)
+            if path is not None:
+                hashes.update(file_hashes(path))
+        stations = {trace_id.split('.')[1] for trace_id in trace_ids}
+        hashes.update(
+            nll_grid_hashes(self.config, stations, STAGE_NLL_GRIDS[stage]))
+        if stage == 'read_traces':
+            # files added to (or removed from) the trace path can change
+            # the traces read: only the list of files is hashed
+            listing = _list_files(self.config.options.trace_path or [])
+            hashes['trace_path'] = hashlib.sha256(
+                '\n'.join(listing).encode()).hexdigest()
+            for path in trace_files:
+                hashes.update(file_hashes(path))
+            hashes.update(self._event_hashes())
+            hashes.update(self._inventory_hashes(trace_ids))
+        return hashes
+
+    def _stage_key(self, stage, lookup_key, streams=(), manifest=None):
+        """
+        Compute the cache key of a stage, from its lookup key and from the
+        hashes of its inputs.
+
+        The traces used by read_traces() are taken from its manifest (read
+        from the cache, if not given): the key is None if there is no
+        manifest. For the other stages, they are the traces of the input
+        streams.
+        """
+        if stage == 'read_traces':
+            if manifest is None:
+                manifest = self._read_manifest(lookup_key)
+            if manifest is None:
+                return None
+            trace_ids = manifest['trace_ids']
+            trace_files = manifest['trace_files']
+        else:
+            trace_ids = {trace.id for stream in streams for trace in stream}
+            trace_files = ()
+        hashes = self._input_hashes(stage, trace_ids, trace_files)
+        hasher = hashlib.sha256()
+        hasher.update(f'lookup:{lookup_key}\n'.encode())
+        hasher.update(json.dumps(hashes, sort_keys=True).encode())
+        self._keys[stage] = hasher.hexdigest()
+        self._inputs[stage] = sorted(hashes)
+        return self._keys[stage]
+
+    def _entry_path(self, stage, key):
+        """Return the path of a cache entry, without extension."""
+        return os.path.join(self.cache_dir, stage, key)
+
+    def load(self, stage, key):
+        """Load a stage entry from cache. Return None on cache miss."""
+        if key is None:
+            logger.info(f'Cache miss for {stage}: no manifest')
+            return None
+        entry_file = f'{self._entry_path(stage, key)}.pickle'
+        if not os.path.exists(entry_file):
+            logger.info(f'Cache miss for {stage}: {key[:16]}')
+            return None
+        try:
+            with open(entry_file, 'rb') as fp:
+                entry = pickle.load(fp)
+        except Exception as msg:
+            logger.warning(
+                f'Unable to read cache entry {entry_file}: {msg}. '
+                'Ignoring it.')
+            return None
+        # update modification time, used to prune least recently used entries
+        with contextlib.suppress(OSError):
+            os.utime(entry_file)
+        logger.info(f'Loading {stage} results from cache: {key[:16]}')
+        return entry
+
+    def save(self, stage, key, entry, config_values):
+        """Save a stage entry to cache."""
+        entry_path = self._entry_path(stage, key)
+        entry_file = f'{entry_path}.pickle'
+        tmp_file = f'{entry_file}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            with open(tmp_file, 'wb') as fp:
+                pickle.dump(entry, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            # atomic rename, to avoid partially written entries
+            os.replace(tmp_file, entry_file)
+        except Exception as msg:
+            logger.warning(f'Unable to write cache entry {entry_file}: {msg}')
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+            return
+        evid = None
+        with contextlib.suppress(AttributeError):
+            evid = self.config.event.event_id
+        metadata = {
+            'stage': stage,
+            'key': key,
+            'evid': evid,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'sourcespec_version': get_versions()['version'],
+            'size': os.path.getsize(entry_file),
+            'inputs': self._inputs.get(stage, []),
+            'config': config_values,
+        }
+        with open(f'{entry_path}.json', 'w', encoding='utf-8') as fp:
+            json.dump(metadata, fp, indent=2, default=str)
+        logger.info(f'Saved {stage} results to cache: {key[:16]}')
+
+    def run(self, stage, func, config, *streams):
+        """
+        Run a stage function, or load its results from cache.
+
+        ``streams`` are the input streams of the stage function, which
+        are modified in place by the stage (e.g., by adding arrivals or
+        ignore flags). Their final state is cached together with the stage
+        result and restored in place on a cache hit.
+        """
+        if not self.enabled:
+            return func(config, *streams)
+        # config values and options can be modified by the stage: the
+        # lookup key is computed before running it
+        lookup_key = self._lookup_key(stage)
+        config_values = _stage_config_values(config, stage)
+        key = self._stage_key(stage, lookup_key, streams)
+        entry = self.load(stage, key)
+        if entry is None:
+            result = func(config, *streams)
+            if stage == 'read_traces':
+                # the inputs used by read_traces() are now known
+                manifest = self._write_manifest(lookup_key, result)
+                key = self._stage_key(stage, lookup_key, manifest=manifest)
+            entry = {
+                'result': result,
+                'streams': list(streams),
+                'config': {
+                    name: config.get(name)
+                    for name in STAGE_CONFIG_OUTPUTS[stage]},
+                'options': {
+                    opt: getattr(config.options, opt, None)
+                    for opt in STAGE_OPTION_OUTPUTS[stage]},
+            }
+            self.save(stage, key, entry, config_values)
+            return result
+        for name, value in entry['config'].items():
+            if value is not None:
+                config[name] = value
+        for opt, value in entry['options'].items():
+            setattr(config.options, opt, value)
+        result = entry['result']
+        for stream, cached_stream in zip(streams, entry['streams']):
+            stream.traces[:] = cached_stream.traces
+        event = config.get('event')
+        if event is not None:
+            for stream in list(streams) + _streams_in(result):
+                _relink_event(stream, event)
+        return result
+
+
+def _streams_in(result):
+    """Return a list of the streams in a stage result."""
+    if isinstance(result, Stream):
+        return [result]
+    if isinstance(result, (tuple, list)):
+        return [r for r in result if isinstance(r, Stream)]
+    return []
+
+
+# Command line interface ------------------------------------------------------
+def _parse_arguments():
+    """Parse command line arguments"""
+    # pylint: disable=import-outside-toplevel
+    import sys
+    import argparse
+    description = """\
+Inspect and prune the SourceSpec stage cache (see the "cache_dir" config
+parameter).
+"""
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparser = parser.add_subparsers(dest='command')
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('cache_dir', help='Cache directory')
+    common_parser.add_argument(
+        '--stage', '-s', choices=STAGES, help='Only consider this stage')
+    common_parser.add_argument(
+        '--evid', '-e', help='Only consider entries for this event ID')
+    subparser.add_parser(
+        'list', help='List cache entries', parents=[common_parser])
+    sp_info = subparser.add_parser(
+        'info', help='Show details of a cache entry (input files and '
+        'config parameters used to compute its key)')
+    sp_info.add_argument('cache_dir', help='Cache directory')
+    sp_info.add_argument('key', help='Entry key (or its beginning)')
+    sp_prune = subparser.add_parser(
+        'prune', help='Remove cache entries', parents=[common_parser])
+    sp_prune.add_argument(
+        '--older_than', '-o', type=float, default=None, metavar='DAYS',
+        help='Remove entries not used since this number of days')
+    sp_prune.add_argument(
+        '--max_size', '-m', type=float, default=None, metavar='MB',
+        help='Remove least recently used entries until the cache size is '
+        'smaller than this value (in megabytes)')
+    sp_prune.add_argument(
+        '--stale', action='store_true', default=False,
+        help='Remove entries created by a different SourceSpec version '
+        '(they will never be used)')
+    sp_prune.add_argument(
+        '--all', '-a', action='store_true', default=False,
+        help='Remove all the selected entries')
+    sp_prune.add_argument(
+        '--dry_run', '-n', action='store_true', default=False,
+        help='Only show which entries would be removed')
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_usage(sys.stderr)
+        sys.stderr.write(
+            'Error: at least one positional argument is required.\n')
+        sys.exit(2)
+    if args.command == 'prune' and not (
+            args.all or args.stale or args.older_than is not None or
+            args.max_size is not None):
+        sys.stderr.write(
+            'Error: specify at least one of --older_than, --max_size, '
+            '--stale or --all.\n')
+        sys.exit(2)
+    return args
+
+
+def _read_entries(cache_dir, stage=None, evid=None):
+    """Read the metadata of all cache entries."""
+    if not os.path.isdir(cache_dir):
+        raise FileNotFoundError(f'Cache directory not found: {cache_dir}')
+    entries = []
+    stages = STAGES if stage is None else (stage, )
+    for _stage in stages:
+        stage_dir = os.path.join(cache_dir, _stage)
+        if not os.path.isdir(stage_dir):
+            continue
+        for filename in sorted(os.listdir(stage_dir)):
+            if not filename.endswith('.pickle'):
+                continue
+            entry_file = os.path.join(stage_dir, filename)
+            key = filename[:-len('.pickle')]
+            metadata_file = os.path.join(stage_dir, f'{key}.json')
+            try:
+                with open(metadata_file, 'r', encoding='utf-8') as fp:
+                    metadata = json.load(fp)
+            except (OSError, ValueError):
+                metadata = {'stage': _stage, 'key': key}
+            if evid is not None and metadata.get('evid') != evid:
+                continue
+            metadata['file'] = entry_file
+            metadata['size'] = os.path.getsize(entry_file)
+            metadata['last_used'] = os.path.getmtime(entry_file)
+            entries.append(metadata)
+    return entries
+
+
+def _format_size(size):
+    """Format a size in bytes as a human readable string."""
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return f'{size:.1f} {unit}'
+
+
+def _print_entries(entries):
+    """Print a table of cache entries."""
+    for entry in entries:
+        last_used = datetime.fromtimestamp(entry['last_used'])
+        print(
+            f'{entry["stage"]:<15} {entry["key"][:16]} '
+            f'{str(entry.get("evid")):<20} {_format_size(entry["size"]):>10} '
+            f'{last_used.isoformat(timespec="seconds")}')
+    total_size = sum(entry['size'] for entry in entries)
+    print(f'{len(entries)} entries, {_format_size(total_size)}')
+
+
+def _run_info(args):
+    """Show details of a cache entry."""
+    entries = [
+        e for e in _read_entries(args.cache_dir)
+        if e['key'].startswith(args.key)]
+    if not entries:
+        print(f'No cache entry found for key: {args.key}')
+        return
+    for entry in entries:
+        entry['last_used'] = datetime.fromtimestamp(
+            entry['last_used']).isoformat(timespec='seconds')
+        print(json.dumps(entry, indent=2, default=str))
+
+
+def _remove_entry(entry):
+    """Remove a cache entry and its metadata."""
+    with contextlib.suppress(OSError):
+        os.remove(entry['file'])
+    with contextlib.suppress(OSError):
+        os.remove(f'{entry["file"][:-len(".pickle")]}.json')
+
+
+def _run_prune(args):
+    """Remove cache entries."""
+    entries = _read_entries(args.cache_dir, args.stage, args.evid)
+    to_remove = []
+    if args.all:
+        to_remove = list(entries)
+    if args.stale:
+        version = get_versions()['version']
+        to_remove += [
+            e for e in entries if e.get('sourcespec_version') != version]
+    if args.older_than is not None:
+        limit = time.time() - args.older_than * 86400
+        to_remove += [e for e in entries if e['last_used'] < limit]
+    if args.max_size is not None:
+        remaining = [e for e in entries if e not in to_remove]
+        total_size = sum(e['size'] for e in remaining)
+        max_size = args.max_size * 1024 * 1024
+        # least recently used first
+        for entry in sorted(remaining, key=lambda e: e['last_used']):
+            if total_size <= max_size:
+                break
+            to_remove.append(entry)
+            total_size -= entry['size']
+    if not to_remove:
+        print('No cache entry to remove')
+        return
+    if args.dry_run:
+        print('The following entries would be removed:')
+    else:
+        for entry in to_remove:
+            _remove_entry(entry)
+        print('Removed entries:')
+    _print_entries(to_remove)
+
+
+def _command_line_interface():
+    """Command line interface"""
+    args = _parse_arguments()
+    if args.command == 'list':
+        _print_entries(_read_entries(args.cache_dir, args.stage, args.evid))
+    elif args.command == 'info':
+        _run_info(args)
+    elif args.command == 'prune':
+        _run_prune(args)
+
+
+def main():
+    """Main function"""
+    # pylint: disable=import-outside-toplevel
+    import sys
+    try:
+        _command_line_interface()
+    except Exception as msg:
+        sys.exit(msg)
+    except KeyboardInterrupt:
+        sys.exit()
+
+
+if __name__ == '__main__':
+    main()
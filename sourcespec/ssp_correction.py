@@ -12,11 +12,12 @@ Spectral station correction calculated from ssp_residuals.
     CeCILL Free Software License Agreement v2.1
     (http://www.cecill.info/licences.en.html)
 """
-import pickle
 import logging
+import numpy as np
 from scipy.interpolate import interp1d
-from sourcespec.ssp_util import moment_to_mag, mag_to_moment
+from sourcespec.ssp_util import mag_to_moment
 from sourcespec.ssp_setup import ssp_exit
+from sourcespec.ssp_residual_store import open_residual_store
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 
 
@@ -30,27 +31,28 @@ def station_correction(spec_st, config):
     if res_filepath is None:
         return spec_st
     try:
-        with open(res_filepath, 'rb') as fp:
-            residual = pickle.load(fp)
+        residual = open_residual_store(res_filepath)
     except Exception as msg:
         logger.error(msg)
         ssp_exit(1)
 
     H_specs = [spec for spec in spec_st if spec.stats.channel[-1] == 'H']
     for spec in H_specs:
-        try:
-            corr = residual.select(id=spec.id)[0]
-        except IndexError:
+        corr = residual.get(spec.id)
+        if corr is None:
             continue
         freq = spec.get_freq()
         fmin = freq.min()
         fmax = freq.max()
-        corr = corr.slice(fmin, fmax)
-        corr.data_mag = moment_to_mag(corr.data)
+        # the correction can have a different frequency sampling than the
+        # spectrum (e.g., site terms from source_gsi): interpolate it to
+        # the spectrum frequencies. No correction outside its frequency range
+        corr_mag = np.interp(
+            freq, corr.get_freq(), corr.data_mag, left=0., right=0.)
         spec_corr = spec.copy()
         # uncorrected spectrum will have component name 'h'
         spec.stats.channel = f'{spec.stats.channel[:-1]}h'
-        spec_corr.data_mag -= corr.data_mag
+        spec_corr.data_mag -= corr_mag
         # interpolate the corrected data_mag to logspaced frequencies
         f = interp1d(freq, spec_corr.data_mag, fill_value='extrapolate')
         spec_corr.data_mag_logspaced = f(spec_corr.freq_logspaced)
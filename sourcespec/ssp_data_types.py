@@ -9,8 +9,10 @@ Classes for spectral inversion routines.
     CeCILL Free Software License Agreement v2.1
     (http://www.cecill.info/licences.en.html)
 """
+import copyreg
 import logging
 from collections import OrderedDict
+from collections.abc import Mapping
 import numpy as np
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 
@@ -161,14 +163,35 @@ class OrderedAttribDict(OrderedDict):
     """
 
     def __getattr__(self, attr):
+        if attr.startswith('__'):
+            # special methods (e.g., __setstate__) are not items
+            raise AttributeError(attr)
         return self[attr]
 
     def __setattr__(self, attr, value):
         self[attr] = value
 
+    def __reduce__(self):
+        # Pickle support: rebuild the object without calling __init__(),
+        # which can require arguments, then restore the items and the
+        # instance attributes (e.g., links to the station parameters table)
+        return copyreg.__newobj__, (type(self), ), self.__dict__ or None, \
+            None, iter(self.items())
+
 
 class SpectralParameter(OrderedAttribDict):
-    """A spectral parameter measured at one station."""
+    """
+    A spectral parameter measured at one station.
+
+    When the parameter belongs to a StationParameters() object, changes to
+    its value, uncertainties and outlier flag are written to the station
+    parameters table of the SourceSpecOutput() object owning the station.
+    """
+
+    # keys stored in the station parameters table
+    table_keys = (
+        'value', 'uncertainty', 'lower_uncertainty', 'upper_uncertainty',
+        'outlier')
 
     def __init__(self, param_id, name=None, units=None, value=None,
                  uncertainty=None,
@@ -190,6 +213,26 @@ class SpectralParameter(OrderedAttribDict):
         self.confidence_level = confidence_level
         self.outlier = False
 
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        if key not in self.table_keys:
+            return
+        # the station is not an item: it is set by StationParameters()
+        station = self.__dict__.get('_station')
+        if station is not None:
+            station.parameter_changed(self.__dict__['_name'], self)
+
+    def compact_uncertainty(self):
+        """
+        Return lower and upper uncertainty as a 2-element tuple
+        (NaN if not available).
+        """
+        if self.get('uncertainty') is not None:
+            return (self.uncertainty, self.uncertainty)
+        if self.get('lower_uncertainty') is not None:
+            return (self.lower_uncertainty, self.get('upper_uncertainty'))
+        return (np.nan, np.nan)
+
     def value_uncertainty(self):
         """Return value and uncertainty as 3-element tuple."""
         if self.lower_uncertainty is not None:
@@ -205,7 +248,9 @@ class StationParameters(OrderedAttribDict):
     the spectral parameters measured at that station.
 
     Spectral parameters are provided as attributes, using SpectralParameter()
-    objects.
+    objects. Their values, uncertainties and outlier flags are also available
+    as read-only dictionaries (``params_dict``, ``params_err_dict`` and
+    ``is_outlier_dict``).
     """
 
     def __init__(self, param_id, instrument_type=None,
@@ -218,45 +263,267 @@ class StationParameters(OrderedAttribDict):
         self.hypo_dist_in_km = hypo_dist_in_km
         self.epi_dist_in_km = epi_dist_in_km
         self.azimuth = azimuth
-        self.params_dict = {}
-        self.params_err_dict = {}
-        self.is_outlier_dict = {}
-
-    def __setattr__(self, attr, value):
+        # inversion statistics: None if not available
+        self.n_iterations = None
+        self.n_function_evaluations = None
+        self.params_dict = SpectralParametersView(self, 'value')
+        self.params_err_dict = SpectralParametersView(self, 'uncertainty')
+        self.is_outlier_dict = SpectralParametersView(self, 'outlier')
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
         if isinstance(value, SpectralParameter):
-            parname = attr
-            par = value
-            self.params_dict[parname] = par.value
-            if par.uncertainty is not None:
-                self.params_err_dict[parname] = (
-                    par.uncertainty, par.uncertainty
-                )
-            else:
-                self.params_err_dict[parname] = (
-                    par.lower_uncertainty, par.upper_uncertainty
-                )
-            self.is_outlier_dict[parname] = par.outlier
-        self[attr] = value
+            # instance attributes, not items: they are not written to the
+            # output files
+            object.__setattr__(value, '_station', self)
+            object.__setattr__(value, '_name', key)
+            self.parameter_changed(key, value)
+
+    def spectral_parameters(self):
+        """Return an iterator over (name, SpectralParameter()) pairs."""
+        return (
+            (key, value) for key, value in self.items()
+            if isinstance(value, SpectralParameter))
+
+    def parameter_changed(self, parname, par):
+        """
+        Write a spectral parameter to the station parameters table, if the
+        station belongs to a SourceSpecOutput() object.
+        """
+        table = self.__dict__.get('_table')
+        if table is not None:
+            table.set_parameter(self.__dict__['_station_id'], parname, par)
+
+
+class SpectralParametersView(Mapping):
+    """
+    Read-only dictionary of the values, of the uncertainties (as
+    2-element tuples) or of the outlier flags of the spectral parameters of
+    a station, by parameter name.
+    """
+
+    def __init__(self, station_parameters, field):
+        self._station_parameters = station_parameters
+        self._field = field
+
+    def _get(self, par):
+        if self._field == 'uncertainty':
+            return par.compact_uncertainty()
+        return par[self._field]
+
+    def __getitem__(self, parname):
+        par = self._station_parameters[parname]
+        if not isinstance(par, SpectralParameter):
+            raise KeyError(parname)
+        return self._get(par)
+
+    def __iter__(self):
+        return (
+            parname for parname, _
+            in self._station_parameters.spectral_parameters())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class StationParametersTable():
+    """
+    Columnar store of the spectral parameters measured at each station.
+
+    Values, lower and upper uncertainties and outlier flags are stored in
+    (n_stations, n_parameters) arrays, with one row per station, in the
+    order stations were added. Missing values and uncertainties are NaN and
+    missing parameters are flagged as outliers.
+
+    The table is owned by a SourceSpecOutput() object and kept up to date
+    by its StationParameters() and SpectralParameter() objects.
+    """
+
+    # array names and fill values
+    _arrays = (
+        ('value', np.nan), ('lower_uncertainty', np.nan),
+        ('upper_uncertainty', np.nan), ('outlier', True))
 
-    def rebuild_dictionaries(self):
-        """Rebuild spectral parameters dictionaries."""
-        for key, value in self.items():
-            if not isinstance(value, SpectralParameter):
-                continue
-            parname = key
-            par = value
-            self.params_dict[parname] = par.value
-            if par.uncertainty is not None:
-                self.params_err_dict[parname] = (
-                    par.uncertainty, par.uncertainty
-                )
-            elif par.lower_uncertainty is not None:
-                self.params_err_dict[parname] = (
-                    par.lower_uncertainty, par.upper_uncertainty
-                )
-            else:
-                self.params_err_dict[parname] = (np.nan, np.nan)
-            self.is_outlier_dict[parname] = par.outlier
+    def __init__(self):
+        self.station_ids = []
+        self.param_ids = []
+        self._station_index = {}
+        self._param_index = {}
+        # arrays are allocated with spare rows and columns, which are
+        # hidden by the public properties
+        self._data = {
+            name: np.full((0, 0), fill, dtype=type(fill))
+            for name, fill in self._arrays}
+
+    def __len__(self):
+        return len(self.station_ids)
+
+    def _array(self, name):
+        return self._data[name][:len(self.station_ids), :len(self.param_ids)]
+
+    @property
+    def value(self):
+        """Values, as a (n_stations, n_parameters) array."""
+        return self._array('value')
+
+    @property
+    def lower_uncertainty(self):
+        """Lower uncertainties, as a (n_stations, n_parameters) array."""
+        return self._array('lower_uncertainty')
+
+    @property
+    def upper_uncertainty(self):
+        """Upper uncertainties, as a (n_stations, n_parameters) array."""
+        return self._array('upper_uncertainty')
+
+    @property
+    def outlier(self):
+        """Outlier flags, as a (n_stations, n_parameters) array."""
+        return self._array('outlier')
+
+    def _reserve(self, nrows, ncols):
+        """Make room for nrows stations and ncols parameters."""
+        rows, cols = self._data['value'].shape
+        if nrows <= rows and ncols <= cols:
+            return
+        shape = (max(nrows, 2 * rows), max(ncols, 2 * cols))
+        for name, fill in self._arrays:
+            array = np.full(shape, fill, dtype=type(fill))
+            array[:rows, :cols] = self._data[name]
+            self._data[name] = array
+
+    def _row(self, station_id):
+        """Return the row of a station, adding it if needed."""
+        try:
+            return self._station_index[station_id]
+        except KeyError:
+            pass
+        self._reserve(len(self.station_ids) + 1, len(self.param_ids))
+        row = self._station_index[station_id] = len(self.station_ids)
+        self.station_ids.append(station_id)
+        return row
+
+    def _column(self, param_id):
+        """Return the column of a parameter, adding it if needed."""
+        try:
+            return self._param_index[param_id]
+        except KeyError:
+            pass
+        self._reserve(len(self.station_ids), len(self.param_ids) + 1)
+        col = self._param_index[param_id] = len(self.param_ids)
+        self.param_ids.append(param_id)
+        return col
+
+    def set_station(self, station_id, station_parameters):
+        """
+        Set (or replace) all the spectral parameters of a station.
+
+        :param station_id: Station id
+        :param station_parameters: StationParameters() object
+        """
+        row = self._row(station_id)
+        for name, fill in self._arrays:
+            self._data[name][row] = fill
+        for parname, par in station_parameters.spectral_parameters():
+            self.set_parameter(station_id, parname, par)
+
+    def set_parameter(self, station_id, param_id, par):
+        """
+        Set a spectral parameter of a station.
+
+        :param station_id: Station id
+        :param param_id: Parameter id
+        :param par: SpectralParameter() object
+        """
+        row = self._row(station_id)
+        col = self._column(param_id)
+        value = par.get('value')
+        self._data['value'][row, col] = np.nan if value is None else value
+        lower, upper = par.compact_uncertainty()
+        self._data['lower_uncertainty'][row, col] =\
+            np.nan if lower is None else lower
+        self._data['upper_uncertainty'][row, col] =\
+            np.nan if upper is None else upper
+        self._data['outlier'][row, col] = bool(par.get('outlier', False))
+
+    def remove_station(self, station_id):
+        """Remove a station, keeping the order of the other stations."""
+        row = self._station_index.pop(station_id)
+        nrows = len(self.station_ids)
+        for name, fill in self._arrays:
+            array = self._data[name]
+            array[row:nrows - 1] = array[row + 1:nrows]
+            array[nrows - 1] = fill
+        del self.station_ids[row]
+        self._station_index = {
+            station_id: n for n, station_id in enumerate(self.station_ids)}
+
+    def column(self, array_name, param_id):
+        """
+        Return a copy of the column of the given array for the given
+        parameter.
+
+        :param array_name: One of "value", "lower_uncertainty",
+            "upper_uncertainty", "outlier"
+        :param param_id: Parameter id
+        """
+        array = self._array(array_name)
+        try:
+            return array[:, self._param_index[param_id]].copy()
+        except KeyError:
+            # parameter not measured at any station: values are NaN and
+            # stations are flagged as outliers
+            fill_value = True if array_name == 'outlier' else np.nan
+            return np.full(len(self), fill_value, dtype=array.dtype)
+
+
+class StationParametersDict(OrderedAttribDict):
+    """
+    The StationParameters() objects of a SourceSpecOutput() object, by
+    station id.
+
+    Stations added to (or removed from) this dictionary are added to (or
+    removed from) the station parameters table.
+    """
+
+    def __init__(self, table):
+        # instance attribute, not an item
+        object.__setattr__(self, '_table', table)
+
+    def __setitem__(self, station_id, station_parameters):
+        table = self.__dict__.get('_table')
+        if table is not None and station_id in self:
+            self._unlink(self[station_id])
+        super().__setitem__(station_id, station_parameters)
+        if table is None or not isinstance(
+                station_parameters, StationParameters):
+            return
+        object.__setattr__(station_parameters, '_table', table)
+        object.__setattr__(station_parameters, '_station_id', station_id)
+        table.set_station(station_id, station_parameters)
+
+    def __delitem__(self, station_id):
+        self._unlink(self[station_id])
+        super().__delitem__(station_id)
+        table = self.__dict__.get('_table')
+        if table is not None:
+            table.remove_station(station_id)
+
+    def pop(self, station_id, *args):
+        if station_id not in self:
+            return super().pop(station_id, *args)
+        station_parameters = self[station_id]
+        del self[station_id]
+        return station_parameters
+
+    @staticmethod
+    def _unlink(station_parameters):
+        """Detach station parameters from the table."""
+        if isinstance(station_parameters, StationParameters):
+            object.__setattr__(station_parameters, '_table', None)
 
 
 class SummaryStatistics(OrderedAttribDict):
@@ -316,14 +583,23 @@ class SummarySpectralParameter(OrderedAttribDict):
 
 
 class SourceSpecOutput(OrderedAttribDict):
-    """The output of SourceSpec."""
+    """
+    The output of SourceSpec.
+
+    Station spectral parameters are also stored in a columnar table
+    (see StationParametersTable()), which is kept up to date when stations
+    or their spectral parameters change, and is used to compute arrays of
+    values, uncertainties and outliers.
+    """
 
     def __init__(self):
         self.run_info = OrderedAttribDict()
         self.event_info = OrderedAttribDict()
         self.inversion_info = OrderedAttribDict()
         self.summary_spectral_parameters = OrderedAttribDict()
-        self.station_parameters = OrderedAttribDict()
+        # keys starting with "_" are not written to the YAML file
+        self._station_table = StationParametersTable()
+        self.station_parameters = StationParametersDict(self._station_table)
         self.comments = {
             'begin': 'SourceSpec output in YAML format',
             'run_info': 'Information on the SourceSpec run',
@@ -337,37 +613,34 @@ class SourceSpecOutput(OrderedAttribDict):
                 'measurements\nperformed at that station'
         }
 
+    @property
+    def station_table(self):
+        """The columnar table of station parameters."""
+        return self._station_table
+
     def value_array(self, key, filter_outliers=False):
         """Return an array of values for the given key."""
-        vals = np.array([
-            x.params_dict.get(key, np.nan)
-            for x in self.station_parameters.values()
-        ])
+        table = self.station_table
+        vals = table.column('value', key)
         if filter_outliers:
-            outliers = self.outlier_array(key)
-            vals = vals[~outliers]
+            vals = vals[~table.column('outlier', key)]
         return vals
 
     def error_array(self, key, filter_outliers=False):
         """Return an array of errors for the given key."""
-        errs = np.array([
-            x.params_err_dict.get(key, np.nan)
-            for x in self.station_parameters.values()
-        ])
+        table = self.station_table
+        errs = np.column_stack((
+            table.column('lower_uncertainty', key),
+            table.column('upper_uncertainty', key)
+        ))
         if filter_outliers:
-            outliers = self.outlier_array(key)
-            errs = errs[~outliers]
+            errs = errs[~table.column('outlier', key)]
         return errs
 
     def outlier_array(self, key):
         """Return an array of outliers for the given key."""
-        return np.array(
-            [
-                # if we cannot find the given key, we assume outlier=True
-                x.is_outlier_dict.get(key, True)
-                for x in self.station_parameters.values()
-            ]
-        )
+        # if we cannot find the given key, we assume outlier=True
+        return self.station_table.column('outlier', key)
 
     def find_outliers(self, key, n):
         """
@@ -402,11 +675,12 @@ class SourceSpecOutput(OrderedAttribDict):
             outliers = np.logical_or(
                 values < Q1 - n * IQR, values > Q3 + n * IQR)
             outliers = np.logical_or(outliers, naninf)
-        station_ids = np.array(list(self.station_parameters.keys()))
-        for stat_id, outl in zip(station_ids, outliers):
-            stat_par = self.station_parameters[stat_id]
-            stat_par[key].outlier = outl
-            stat_par.rebuild_dictionaries()
+        # the table is updated by the spectral parameter objects
+        for stat_par, outl in zip(
+                self.station_parameters.values(), outliers):
+            par = stat_par.get(key)
+            if isinstance(par, SpectralParameter):
+                par.outlier = bool(outl)
 
     def mean_values(self):
         """Return a dictionary of mean values."""
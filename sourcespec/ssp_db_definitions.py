@@ -11,7 +11,7 @@ Table definitions for SourceSpec database.
     (http://www.cecill.info/licences.en.html)
 """
 # Current DB version
-DB_VERSION = 2
+DB_VERSION = 4
 
 # Table definitions
 STATIONS_TABLE = {
@@ -58,6 +58,10 @@ STATIONS_TABLE = {
     'azimuth': 'REAL',
 }
 STATIONS_PRIMARY_KEYS = ['stid', 'evid', 'runid']
+# Secondary indexes (new in version 3): {index name: columns}
+STATIONS_INDEXES = {
+    'Stations_evid_runid': ['evid', 'runid'],
+}
 
 EVENTS_TABLE = {
     'evid': 'TEXT',
@@ -206,3 +210,58 @@ EVENTS_TABLE = {
     'agency_url': 'TEXT'
 }
 EVENTS_PRIMARY_KEYS = ['evid', 'runid']
+# Secondary indexes (new in version 3): {index name: columns}
+EVENTS_INDEXES = {
+    'Events_runid': ['runid'],
+}
+
+# Summary tables (new in version 4), maintained by write_sqlite().
+# They store, for each runid and wave type, aggregate values of the
+# Events table, which are used by plot_sourcepars to plot 2D histograms
+# and fits of large catalogs without reading the whole Events table.
+# Width of summary bins, in Mw units and in log10 units of the parameter
+SUMMARY_BIN_WIDTH = 0.1
+# Event parameters binned against Mw
+SUMMARY_PARAMS = ['fc', 'Er', 'ssd']
+# Statistics for which summaries are computed
+SUMMARY_STATS = ['mean', 'wmean', 'pctl']
+# Number of events and sums of velocities and rigidity (mu = vs^2 * rho),
+# to compute their mean values
+SUMMARY_EVENTS_TABLE = {
+    'runid': 'TEXT',
+    'wave_type': 'TEXT',
+    'nevents': 'INTEGER',
+    'vp_count': 'INTEGER',
+    'vp_sum': 'REAL',
+    'vs_count': 'INTEGER',
+    'vs_sum': 'REAL',
+    'mu_count': 'INTEGER',
+    'mu_sum': 'REAL',
+}
+SUMMARY_EVENTS_PRIMARY_KEYS = ['runid', 'wave_type']
+# Number of events in each (Mw, log10(param)) bin
+SUMMARY_BINS_TABLE = {
+    'runid': 'TEXT',
+    'wave_type': 'TEXT',
+    'stat': 'TEXT',
+    'param': 'TEXT',
+    'mw_bin': 'INTEGER',
+    'value_bin': 'INTEGER',
+    'count': 'INTEGER',
+}
+SUMMARY_BINS_PRIMARY_KEYS = [
+    'runid', 'wave_type', 'stat', 'param', 'mw_bin', 'value_bin']
+# Sufficient statistics for a linear regression of log10(param) vs Mw
+SUMMARY_FITS_TABLE = {
+    'runid': 'TEXT',
+    'wave_type': 'TEXT',
+    'stat': 'TEXT',
+    'param': 'TEXT',
+    'n': 'INTEGER',
+    'sum_x': 'REAL',
+    'sum_y': 'REAL',
+    'sum_xx': 'REAL',
+    'sum_xy': 'REAL',
+    'sum_yy': 'REAL',
+}
+SUMMARY_FITS_PRIMARY_KEYS = ['runid', 'wave_type', 'stat', 'param']
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Summary tables for SourceSpec database.
+
+Summary tables store aggregate values of the Events table (number of events
+per bin of Mw and log10 of fc, Er and ssd, and sums needed for a linear
+regression of those parameters against Mw), for each runid and wave type.
+They are updated by write_sqlite() every time an event is written and can be
+rebuilt from the Events table using rebuild_summary_tables().
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import math
+from collections import defaultdict
+from sourcespec.ssp_db_definitions import (
+    SUMMARY_BIN_WIDTH, SUMMARY_PARAMS, SUMMARY_STATS,
+    SUMMARY_EVENTS_TABLE, SUMMARY_EVENTS_PRIMARY_KEYS,
+    SUMMARY_BINS_TABLE, SUMMARY_BINS_PRIMARY_KEYS,
+    SUMMARY_FITS_TABLE, SUMMARY_FITS_PRIMARY_KEYS)
+
+SUMMARY_TABLES = {
+    'SummaryEvents': (SUMMARY_EVENTS_TABLE, SUMMARY_EVENTS_PRIMARY_KEYS),
+    'SummaryBins': (SUMMARY_BINS_TABLE, SUMMARY_BINS_PRIMARY_KEYS),
+    'SummaryFits': (SUMMARY_FITS_TABLE, SUMMARY_FITS_PRIMARY_KEYS),
+}
+
+# Events columns used to compute the summaries
+_EVENTS_COLUMNS = ['runid', 'wave_type', 'vp', 'vs', 'rho'] + [
+    f'{param}_{stat}'
+    for stat in SUMMARY_STATS
+    for param in ['Mw'] + SUMMARY_PARAMS
+]
+
+
+def summary_bin(value):
+    """
+    Return the index of the summary bin containing value.
+
+    Bin i spans [i * SUMMARY_BIN_WIDTH, (i + 1) * SUMMARY_BIN_WIDTH).
+
+    :param value: Value (Mw or log10 of a parameter)
+    :type value: float
+    :return: Bin index
+    :rtype: int
+    """
+    # rounding avoids that, e.g., 2.3 ends up in bin 22
+    return math.floor(round(value / SUMMARY_BIN_WIDTH, 6))
+
+
+def _is_valid(value):
+    """Check that a value read from the database is a finite number."""
+    return value is not None and math.isfinite(value)
+
+
+class _Summaries():
+    """Summary values accumulated over a set of events."""
+    def __init__(self):
+        # {(runid, wave_type): [nevents, vp_count, vp_sum, vs_count, vs_sum,
+        #                       mu_count, mu_sum]}
+        self.events = defaultdict(lambda: [0, 0, 0., 0, 0., 0, 0.])
+        # {(runid, wave_type, stat, param, mw_bin, value_bin): count}
+        self.bins = defaultdict(int)
+        # {(runid, wave_type, stat, param):
+        #   [n, sum_x, sum_y, sum_xx, sum_xy, sum_yy]}
+        self.fits = defaultdict(lambda: [0, 0., 0., 0., 0., 0.])
+
+    def add_event(self, row, sign=1):
+        """
+        Add (sign=1) or remove (sign=-1) an event.
+
+        :param row: Values of the Events columns in _EVENTS_COLUMNS
+        :type row: tuple
+        :param sign: 1 to add the event, -1 to remove it
+        :type sign: int
+        """
+        values = dict(zip(_EVENTS_COLUMNS, row))
+        # NULL values cannot be used in primary keys
+        runid = values['runid'] or ''
+        wave_type = values['wave_type'] or ''
+        vp, vs, rho = values['vp'], values['vs'], values['rho']
+        mu = (vs * 1e3)**2 * rho if _is_valid(vs) and _is_valid(rho) else None
+        event_sums = self.events[(runid, wave_type)]
+        event_sums[0] += sign
+        for n, value in enumerate((vp, vs, mu)):
+            if _is_valid(value):
+                event_sums[2 * n + 1] += sign
+                event_sums[2 * n + 2] += sign * value
+        for stat in SUMMARY_STATS:
+            mw = values[f'Mw_{stat}']
+            if not _is_valid(mw):
+                continue
+            for param in SUMMARY_PARAMS:
+                value = values[f'{param}_{stat}']
+                if not _is_valid(value) or value <= 0:
+                    continue
+                log_value = math.log10(value)
+                key = (runid, wave_type, stat, param)
+                bin_key = (*key, summary_bin(mw), summary_bin(log_value))
+                self.bins[bin_key] += sign
+                fit_sums = self.fits[key]
+                fit_sums[0] += sign
+                fit_sums[1] += sign * mw
+                fit_sums[2] += sign * log_value
+                fit_sums[3] += sign * mw**2
+                fit_sums[4] += sign * mw * log_value
+                fit_sums[5] += sign * log_value**2
+
+    def write(self, cursor):
+        """
+        Add the accumulated values to the summary tables.
+
+        Rows which do not correspond anymore to any event are deleted.
+
+        :param cursor: SQLite cursor
+        :type cursor: sqlite3.Cursor
+        """
+        for table, sums in (
+                ('SummaryEvents', self.events),
+                ('SummaryBins', self.bins),
+                ('SummaryFits', self.fits)):
+            if not sums:
+                continue
+            columns, keys = SUMMARY_TABLES[table]
+            value_columns = [col for col in columns if col not in keys]
+            rows = [
+                (*key, *(value if isinstance(value, list) else [value]))
+                for key, value in sums.items()
+            ]
+            # create missing rows with zero values, then add to them
+            zeros = ', '.join('0' for _ in value_columns)
+            cursor.executemany(
+                f'INSERT OR IGNORE INTO {table} '
+                f'VALUES ({", ".join("?" * len(keys))}, {zeros});',
+                [row[:len(keys)] for row in rows])
+            set_values = ', '.join(
+                f'{col} = {col} + ?' for col in value_columns)
+            where_keys = ' AND '.join(f'{key} = ?' for key in keys)
+            cursor.executemany(
+                f'UPDATE {table} SET {set_values} WHERE {where_keys};',
+                [row[len(keys):] + row[:len(keys)] for row in rows])
+            # the first value column is a count of events
+            cursor.executemany(
+                f'DELETE FROM {table} '
+                f'WHERE {where_keys} AND {value_columns[0]} <= 0;',
+                [row[:len(keys)] for row in rows])
+
+
+def create_summary_tables(cursor):
+    """
+    Create the summary tables, if they do not exist.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    """
+    for table, (columns, keys) in SUMMARY_TABLES.items():
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {table} ('
+            + '\n'.join(
+                [f'{key} {value},' for key, value in columns.items()]
+            )
+            + 'PRIMARY KEY (' + ', '.join(keys) + ')'
+            + ');'
+        )
+
+
+def update_summary_tables(cursor, evid, runid, sign=1):
+    """
+    Add an event to the summary tables, or remove it.
+
+    The event values are read from the Events table. Nothing is done if the
+    event is not found.
+
+    To replace an event, call this function with sign=-1 before
+    writing the new event values to the Events table, then with sign=1
+    after.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param evid: Event id
+    :type evid: str
+    :param runid: Run id
+    :type runid: str
+    :param sign: 1 to add the event, -1 to remove it
+    :type sign: int
+    """
+    row = cursor.execute(
+        f'SELECT {", ".join(_EVENTS_COLUMNS)} FROM Events '
+        'WHERE evid = ? AND runid IS ?;', (evid, runid)).fetchone()
+    if row is None:
+        return
+    summaries = _Summaries()
+    summaries.add_event(row, sign)
+    summaries.write(cursor)
+
+
+def rebuild_summary_tables(cursor):
+    """
+    Rebuild the summary tables from the Events table.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :return: Number of events
+    :rtype: int
+    """
+    create_summary_tables(cursor)
+    for table in SUMMARY_TABLES:
+        cursor.execute(f'DELETE FROM {table};')
+    summaries = _Summaries()
+    nevents = 0
+    for row in cursor.execute(
+            f'SELECT {", ".join(_EVENTS_COLUMNS)} FROM Events;'):
+        summaries.add_event(row)
+        nevents += 1
+    summaries.write(cursor)
+    return nevents
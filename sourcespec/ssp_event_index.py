@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Event id index for QuakeML catalogues.
+
+Reading a whole catalogue with ``obspy.read_events()`` to get a single event
+is slow for large catalogues, and this is repeated for every event when a
+catalogue is reprocessed event by event.
+
+Large catalogues are therefore parsed only once, incrementally, and the XML
+of each event is stored (compressed) in a SQLite index file next to the
+catalogue (``<catalogue>.sspidx``), indexed by event id. The index is
+rebuilt when the catalogue changes. If the index file cannot be written,
+the index is kept in memory.
+
+Events are then read one at a time, with ObsPy.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import io
+import os
+import time
+import zlib
+import sqlite3
+import logging
+import pathlib
+import contextlib
+import xml.etree.ElementTree as ET
+from obspy import read_events
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
+
+# Increase this when the index format changes
+INDEX_VERSION = 1
+# QuakeML files smaller than this (in bytes) are not indexed
+INDEX_MIN_FILE_SIZE = 1024**2
+# Number of events inserted at a time into the index
+INDEX_BATCH_SIZE = 1000
+
+# Minimal QuakeML document, used to read a single event
+_QML_DOCUMENT = (
+    b'<?xml version="1.0" encoding="utf-8"?>\n'
+    b'<q:quakeml xmlns:q="http://quakeml.org/xmlns/quakeml/1.2" '
+    b'xmlns="http://quakeml.org/xmlns/bed/1.2">'
+    b'<eventParameters publicID="smi:local/sourcespec/event_index">'
+    b'%s</eventParameters></q:quakeml>\n'
+)
+
+# Open indexes, by catalogue path
+_INDEXES = {}
+
+
+def _local_name(tag):
+    """Return an XML tag without its namespace."""
+    return tag.rsplit('}', maxsplit=1)[-1]
+
+
+def _iter_qml_events(qml_file):
+    """
+    Parse a QuakeML file incrementally, yielding each event.
+
+    Parsed events are removed from the tree, so that memory usage does not
+    depend on the number of events.
+
+    :param qml_file: QuakeML file
+    :type qml_file: str
+    :return: Generator of (publicID, event XML) tuples
+    :rtype: generator
+    """
+    event_parameters = None
+    for action, elem in ET.iterparse(qml_file, events=('start', 'end')):
+        name = _local_name(elem.tag)
+        if action == 'start':
+            if name == 'eventParameters':
+                event_parameters = elem
+            continue
+        if name != 'event' or event_parameters is None:
+            continue
+        yield elem.get('publicID', ''), ET.tostring(elem)
+        with contextlib.suppress(ValueError):
+            event_parameters.remove(elem)
+
+
+def read_event_xml(qml_file, event_id=None):
+    """
+    Read the XML record of an event from a QuakeML file, without indexing it.
+
+    As for non-indexed catalogues, the event is the first one whose resource
+    id contains the event id.
+
+    :param qml_file: QuakeML file
+    :type qml_file: str
+    :param event_id: Event id. If None, the first event is returned.
+    :type event_id: str
+    :return: Event XML
+    :rtype: bytes
+    """
+    for resource_id, xml in _iter_qml_events(qml_file):
+        if event_id is None or event_id in resource_id:
+            return xml
+    if event_id is None:
+        raise ValueError(f'No event found in {qml_file}')
+    raise ValueError(f'Event {event_id} not found in {qml_file}')
+
+
+def _catalog_signature(qml_file):
+    """Return a string changing when the catalogue (or the index) changes."""
+    stat = os.stat(qml_file)
+    return f'{INDEX_VERSION}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+class QuakeMLIndex():
+    """
+    Event id index of a QuakeML catalogue.
+
+    :param qml_file: QuakeML file
+    :type qml_file: str
+    :param evid_from_resource_id: Function returning the event id from the
+        event resource id
+    :type evid_from_resource_id: callable
+    """
+
+    def __init__(self, qml_file, evid_from_resource_id):
+        self.qml_file = qml_file
+        self.index_file = f'{qml_file}.sspidx'
+        self.signature = _catalog_signature(qml_file)
+        self._evid_from_resource_id = evid_from_resource_id
+        self.conn = self._open_index()
+
+    def _open_index(self):
+        """Open the index file, or build it if missing or outdated."""
+        uri = pathlib.Path(os.path.abspath(self.index_file)).as_uri()
+        with contextlib.suppress(sqlite3.Error):
+            conn = sqlite3.connect(f'{uri}?mode=ro', uri=True)
+            try:
+                signature = conn.execute(
+                    "SELECT value FROM Info WHERE key='signature';"
+                ).fetchone()
+            except sqlite3.Error:
+                signature = None
+            if signature is not None and signature[0] == self.signature:
+                return conn
+            conn.close()
+        # the index is written to a temporary file, so that concurrent runs
+        # never read an incomplete index
+        tmp_file = f'{self.index_file}.{os.getpid()}.tmp'
+        try:
+            conn = sqlite3.connect(tmp_file)
+            self._build_index(conn)
+            conn.close()
+            os.replace(tmp_file, self.index_file)
+            return sqlite3.connect(f'{uri}?mode=ro', uri=True)
+        except (OSError, sqlite3.Error) as msg:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+            logger.warning(
+                f'Unable to write event index {self.index_file}: {msg}. '
+                'Keeping the index in memory.')
+        conn = sqlite3.connect(':memory:')
+        self._build_index(conn)
+        return conn
+
+    def _build_index(self, conn):
+        """Parse the catalogue and store its events into the index."""
+        logger.info(f'Indexing QuakeML catalogue {self.qml_file}...')
+        t0 = time.time()
+        conn.execute(
+            'CREATE TABLE Info (key TEXT PRIMARY KEY, value TEXT);')
+        conn.execute(
+            'CREATE TABLE Events ('
+            'pos INTEGER PRIMARY KEY, evid TEXT, resource_id TEXT, xml BLOB);')
+        rows = []
+        nevents = 0
+        for resource_id, xml in _iter_qml_events(self.qml_file):
+            rows.append((
+                nevents, self._evid_from_resource_id(resource_id),
+                resource_id, zlib.compress(xml)))
+            nevents += 1
+            if len(rows) == INDEX_BATCH_SIZE:
+                conn.executemany(
+                    'INSERT INTO Events VALUES (?, ?, ?, ?);', rows)
+                rows = []
+        conn.executemany('INSERT INTO Events VALUES (?, ?, ?, ?);', rows)
+        conn.execute('CREATE INDEX Events_evid ON Events (evid);')
+        # the signature is written last: an interrupted build is never used
+        conn.execute(
+            "INSERT INTO Info VALUES ('signature', ?);", (self.signature, ))
+        conn.commit()
+        logger.info(
+            f'Indexing QuakeML catalogue: {nevents} events indexed in '
+            f'{time.time() - t0:.1f} s')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM Events;').fetchone()[0]
+
+    def get_event_xml(self, event_id=None):
+        """
+        Get the XML record of an event from the catalogue.
+
+        Events are looked up by event id, then (as for the non-indexed
+        catalogues) by the first resource id containing the event id.
+
+        :param event_id: Event id. If None, the first event is returned.
+        :type event_id: str
+        :return: Event XML
+        :rtype: bytes
+        """
+        if event_id is None:
+            row = self.conn.execute(
+                'SELECT xml FROM Events ORDER BY pos LIMIT 1;').fetchone()
+            nevents = len(self)
+            if nevents > 1:
+                logger.warning(
+                    f'Found {nevents} events in {self.qml_file}. '
+                    'Using the first one.')
+        else:
+            row = self.conn.execute(
+                'SELECT xml FROM Events WHERE evid = ? ORDER BY pos LIMIT 1;',
+                (event_id, )).fetchone()
+            if row is None:
+                row = self.conn.execute(
+                    'SELECT xml FROM Events WHERE instr(resource_id, ?) > 0 '
+                    'ORDER BY pos LIMIT 1;', (event_id, )).fetchone()
+        if row is None:
+            if event_id is None:
+                raise ValueError(f'No event found in {self.qml_file}')
+            raise ValueError(f'Event {event_id} not found in {self.qml_file}')
+        return zlib.decompress(row[0])
+
+    def get_event(self, event_id=None):
+        """
+        Get an event from the catalogue.
+
+        :param event_id: Event id. If None, the first event is returned.
+        :type event_id: str
+        :return: QuakeML event
+        :rtype: obspy.core.event.Event
+        """
+        document = _QML_DOCUMENT % self.get_event_xml(event_id)
+        return read_events(io.BytesIO(document), format='QUAKEML')[0]
+
+    def close(self):
+        """Close the index."""
+        self.conn.close()
+
+
+def get_qml_index(qml_file, evid_from_resource_id):
+    """
+    Get the event index of a QuakeML catalogue.
+
+    The index is opened (or built) once per catalogue and reused by the
+    following calls, unless the catalogue changed.
+
+    :param qml_file: QuakeML file
+    :type qml_file: str
+    :param evid_from_resource_id: Function returning the event id from the
+        event resource id
+    :type evid_from_resource_id: callable
+    :return: Event index
+    :rtype: QuakeMLIndex
+    """
+    key = os.path.abspath(qml_file)
+    index = _INDEXES.get(key)
+    if index is not None and index.signature != _catalog_signature(qml_file):
+        index.close()
+        index = None
+    if index is None:
+        index = _INDEXES[key] = QuakeMLIndex(qml_file, evid_from_resource_id)
+    return index
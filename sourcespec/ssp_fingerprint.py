@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Event fingerprints, to skip unchanged events when reprocessing a catalogue.
+
+The fingerprint of an event run is made of the hashes of the inputs of the
+event, of the effective config and of the SourceSpec version. Only the
+inputs actually used for the event are hashed: the waveform files read, the
+station metadata of the traces read, the event record in the QuakeML
+catalogue, the NLL grids for the event stations, station residuals and
+other auxiliary files. It is saved, at the end of the run, in the event
+output directory.
+
+When ``source_spec`` is run with the ``--skip_unchanged`` option, the
+fingerprint of the current run is compared with the saved one: if nothing
+changed, the event is not processed again. Otherwise, the changes are
+reported and the event is processed.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import os
+import json
+import hashlib
+import logging
+import contextlib
+from datetime import datetime
+from sourcespec._version import get_versions
+from sourcespec.ssp_cache import file_hashes, inventory_hash, nll_grid_hashes
+from sourcespec.ssp_read_event_metadata import get_qml_event_xml
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
+
+# Input files hashed as a whole, grouped by type.
+# Config parameters, or command line options prefixed by "options."
+FINGERPRINT_FILES = {
+    'event': ('options.hypo_file', 'options.pick_file'),
+    'station residuals': ('residuals_filepath', ),
+    'other inputs': ('traceid_mapping_file', 'clipping_skip_list'),
+}
+
+# Command line options changing the results
+FINGERPRINT_OPTIONS = ('evid', 'evname', 'station')
+
+# Config values not changing the results, or set at runtime
+FINGERPRINT_IGNORED_CONFIG = (
+    'options', 'figures', 'warnings', 'workdir', 'cache_dir')
+
+
+def _get_value(config, name):
+    """Get a config value or a command line option ("options.name")."""
+    if name.startswith('options.'):
+        return getattr(config.options, name.split('.', 1)[1], None)
+    return config.get(name)
+
+
+def _waveform_hashes(config):
+    """Return the hashes of the waveform files read for the event."""
+    # "trace_files" is set by read_traces(): fall back to the whole trace
+    # path for cached results not having it
+    paths = config.get('trace_files') or config.options.trace_path or []
+    hashes = {}
+    for path in paths:
+        hashes.update(file_hashes(path))
+    return hashes
+
+
+def _station_metadata_hashes(st):
+    """Return the hashes of the station metadata, by trace id."""
+    hashes = {}
+    for trace in st:
+        if trace.id in hashes:
+            continue
+        inventory = trace.stats.get('inventory')
+        hashes[trace.id] =\
+            'missing' if inventory is None else inventory_hash(inventory)
+    return hashes
+
+
+def _event_hashes(config):
+    """
+    Return the hashes of the event files. For a QuakeML catalogue, only the
+    event record is hashed.
+    """
+    hashes = {}
+    qml_file = config.options.qml_file
+    if qml_file is not None:
+        key = f'{os.path.abspath(qml_file)}#{config.event.event_id}'
+        try:
+            xml = get_qml_event_xml(qml_file, config.options.evid)
+            hashes[key] = hashlib.sha256(xml).hexdigest()
+        except (OSError, ValueError, SyntaxError):
+            hashes[key] = 'unreadable'
+    return hashes
+
+
+def _compare_files(old, new):
+    """Describe the differences between two dictionaries of file hashes."""
+    added = len(set(new) - set(old))
+    removed = len(set(old) - set(new))
+    modified = sum(
+        1 for path in set(old) & set(new) if old[path] != new[path])
+    changes = []
+    if added:
+        changes.append(f'{added} added')
+    if removed:
+        changes.append(f'{removed} removed')
+    if modified:
+        changes.append(f'{modified} modified')
+    return ', '.join(changes)
+
+
+class EventFingerprint():
+    """
+    Fingerprint of an event run.
+
+    It must be created right after ``configure()``, so that the config
+    values are not yet modified by the processing.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.enabled = bool(getattr(config.options, 'skip_unchanged', False))
+        # sweep runs do not produce the regular event output
+        if getattr(config.options, 'sweep_file', None):
+            self.enabled = False
+        config_values = {
+            key: value for key, value in config.items()
+            if key not in FINGERPRINT_IGNORED_CONFIG}
+        for opt in FINGERPRINT_OPTIONS:
+            config_values[f'options.{opt}'] = getattr(
+                config.options, opt, None)
+        # round trip to JSON, to compare with the saved values
+        self.config_values = json.loads(
+            json.dumps(config_values, sort_keys=True, default=str))
+        self.inputs = None
+
+    def _input_hashes(self, st):
+        """Return the hashes of the event inputs, by input type."""
+        inputs = {
+            'waveforms': _waveform_hashes(self.config),
+            'station metadata': _station_metadata_hashes(st),
+            'event': _event_hashes(self.config),
+        }
+        for input_type, names in FINGERPRINT_FILES.items():
+            hashes = inputs.setdefault(input_type, {})
+            for name in names:
+                path = _get_value(self.config, name)
+                if path is not None:
+                    hashes.update(file_hashes(path))
+        stations = {trace.stats.station for trace in st}
+        inputs['other inputs'].update(
+            nll_grid_hashes(self.config, stations))
+        return inputs
+
+    def _fingerprint_file(self, outdir):
+        """Return the path of the fingerprint file in outdir."""
+        evid = self.config.event.event_id
+        return os.path.join(outdir, f'{evid}.ssp.fingerprint.json')
+
+    def _changes(self, saved):
+        """Return a list of the differences with a saved fingerprint."""
+        changes = []
+        version = get_versions()['version']
+        if saved.get('sourcespec_version') != version:
+            changes.append(
+                f'SourceSpec version ({saved.get("sourcespec_version")} '
+                f'-> {version})')
+        saved_inputs = saved.get('inputs', {})
+        for input_type, hashes in self.inputs.items():
+            file_changes = _compare_files(
+                saved_inputs.get(input_type, {}), hashes)
+            if file_changes:
+                changes.append(f'{input_type} ({file_changes})')
+        saved_config = saved.get('config', {})
+        changed_keys = sorted(
+            key for key in set(saved_config) | set(self.config_values)
+            if saved_config.get(key) != self.config_values.get(key))
+        if changed_keys:
+            changes.append(f'config ({", ".join(changed_keys)})')
+        return changes
+
+    def unchanged(self, outdir, st):
+        """
+        Check if the event was already processed with the same inputs and
+        config.
+
+        Must be called once the event is known (i.e., after
+        ``read_traces()``). The outcome is logged.
+
+        :param outdir: Event output directory
+        :type outdir: str
+        :param st: Traces read for the event
+        :type st: :class:`obspy.core.stream.Stream`
+        :return: True if the event can be skipped
+        :rtype: bool
+        """
+        if not self.enabled:
+            return False
+        self.inputs = self._input_hashes(st)
+        evid = self.config.event.event_id
+        run_id = self.config.options.run_id
+        event_str = f'Event {evid}' + (f' (run_id {run_id})' if run_id else '')
+        fingerprint_file = self._fingerprint_file(outdir)
+        try:
+            with open(fingerprint_file, 'r', encoding='utf-8') as fp:
+                saved = json.load(fp)
+        except FileNotFoundError:
+            logger.info(f'{event_str}: no previous run found, processing it')
+            return False
+        except (OSError, ValueError) as msg:
+            logger.warning(
+                f'Unable to read fingerprint file {fingerprint_file}: {msg}. '
+                'Ignoring it.')
+            return False
+        if not os.path.exists(os.path.join(outdir, f'{evid}.ssp.yaml')):
+            logger.info(
+                f'{event_str}: output of previous run not found, '
+                'processing it')
+            return False
+        changes = self._changes(saved)
+        if changes:
+            logger.info(
+                f'{event_str}: changed since last run: {"; ".join(changes)}. '
+                'Processing it')
+            return False
+        logger.info(
+            f'{event_str}: skipped, input files and config unchanged since '
+            f'last run ({saved.get("run_completed")}). Output directory: '
+            f'{outdir}')
+        return True
+
+    def save(self):
+        """
+        Save the fingerprint to the event output directory.
+
+        If the fingerprint is disabled, an existing fingerprint file is
+        removed, since it does not correspond anymore to the output.
+        """
+        fingerprint_file = self._fingerprint_file(self.config.options.outdir)
+        if not self.enabled or self.inputs is None:
+            with contextlib.suppress(OSError):
+                os.remove(fingerprint_file)
+            return
+        fingerprint = {
+            'evid': self.config.event.event_id,
+            'run_id': self.config.options.run_id,
+            'run_completed': datetime.now().isoformat(timespec='seconds'),
+            'sourcespec_version': get_versions()['version'],
+            'inputs': self.inputs,
+            'config': self.config_values,
+        }
+        tmp_file = f'{fingerprint_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as fp:
+                json.dump(fingerprint, fp, indent=2)
+            os.replace(tmp_file, fingerprint_file)
+        except OSError as msg:
+            logger.warning(
+                f'Unable to write fingerprint file {fingerprint_file}: {msg}')
+            with contextlib.suppress(OSError):
+                os.remove(tmp_file)
+            return
+        logger.info(f'Event fingerprint written to file: {fingerprint_file}')
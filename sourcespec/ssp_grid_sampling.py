@@ -20,7 +20,6 @@ import numpy as np
 from scipy.signal import peak_widths as find_peak_widths
 # pylint: disable=no-name-in-module
 from scipy.signal._peak_finding_utils import PeakPropertyWarning
-import matplotlib.pyplot as plt
 from sourcespec.kdtree import KDTree
 from sourcespec.savefig import savefig
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
@@ -115,8 +114,67 @@ class GridSampling():
                 bds = tuple(np.log10(bds))
             self.truebounds.append(bds)
         self.kdt = None
+        self.kdt_coords = None
         self.extent = None
 
+    def __getstate__(self):
+        """
+        Pickle support: the misfit function (generally a closure) and the
+        kd-tree (whose cells refer to the misfit function) are not pickled.
+        Plotting methods only need the misfit values and the coordinates of
+        the kd-tree cells.
+        """
+        state = self.__dict__.copy()
+        state['misfit_func'] = None
+        state['kdt'] = None
+        return state
+
+    def to_arrays(self):
+        """
+        Return a dictionary of the arrays describing the grid sampling
+        (see :func:`write_misfit_grids()`).
+        """
+        arrays = {
+            'misfit': self.misfit,
+            'bounds': np.array(self.bounds, dtype=float),
+            'truebounds': np.array(self.truebounds, dtype=float),
+            'params_opt': self.params_opt,
+            'params_err': np.array(self.params_err, dtype=float),
+            'min_idx': np.array(self.min_idx),
+            'params_name': np.array(self.params_name, dtype=str),
+            'params_unit': np.array(self.params_unit, dtype=str),
+            'sampling_mode': np.array(self.sampling_mode, dtype=str),
+        }
+        for dim, (values, cond_misfit) in enumerate(
+                zip(self.values_1d, self.conditional_misfit)):
+            arrays[f'values_{dim}'] = values
+            arrays[f'cond_misfit_{dim}'] = cond_misfit
+        if self.kdt_coords is not None:
+            arrays['kdt_coords'] = self.kdt_coords
+            arrays['extent'] = np.array(self.extent, dtype=float)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild a grid sampling from the arrays returned by
+        :meth:`to_arrays()`.
+
+        The returned object has no misfit function, but provides optimal
+        parameters, uncertainties, conditional misfit and plotting methods.
+        """
+        misfit = arrays['misfit']
+        gs = cls(
+            None, tuple(map(tuple, arrays['bounds'])), misfit.shape,
+            tuple(arrays['sampling_mode']), tuple(arrays['params_name']),
+            tuple(arrays['params_unit']))
+        gs.truebounds = list(map(tuple, arrays['truebounds']))
+        gs.misfit = misfit
+        if 'kdt_coords' in arrays:
+            gs.kdt_coords = arrays['kdt_coords']
+            gs.extent = tuple(arrays['extent'])
+        return gs
+
     @property
     def values(self):
         """Return a meshgrid of parameter values."""
@@ -248,6 +306,7 @@ class GridSampling():
             deltas.append((bds[1] - bds[0]) / ns)
         pdf, extent = kdt.get_pdf(deltas)
         self.kdt = kdt
+        self.kdt_coords = np.array([cell.coords for cell in kdt.cells])
         self.misfit = -np.log(pdf)
         self.nsteps = self.misfit.shape
         self.extent = extent
@@ -257,6 +316,8 @@ class GridSampling():
         # Check config, if we need to plot at all
         if not config.plot_show and not config.plot_save:
             return
+        # pylint: disable=import-outside-toplevel
+        import matplotlib.pyplot as plt
         ndim = self.misfit.ndim
         fig, ax = plt.subplots(ndim, 1, figsize=(5, 5), dpi=300)
         for dim, mm in enumerate(self.conditional_misfit):
@@ -311,6 +372,8 @@ class GridSampling():
         # Check config, if we need to plot at all
         if not config.plot_show and not config.plot_save:
             return
+        # pylint: disable=import-outside-toplevel
+        import matplotlib.pyplot as plt
         # Find the index to extract
         idx = tuple(
             v for n, v in enumerate(self.min_idx) if n not in plot_par_idx)
@@ -357,7 +420,7 @@ class GridSampling():
             ymax = ymean + tolerance * np.abs(ymean)
         ax.set_xlim(xmin, xmax)
         ax.set_ylim(ymin, ymax)
-        if self.kdt is not None:
+        if self.kdt_coords is not None:
             self._plot_kdtree_structure(ax, plot_par_idx, params_opt_all)
         ax.scatter(*params_opt, facecolors='none', edgecolors='w')
         ax.set_title(label)
@@ -423,7 +486,7 @@ class GridSampling():
         ax2.set_xlabel(xlabel)
 
     def _plot_kdtree_structure(self, ax, plot_par_idx, params_opt_all):
-        coords = np.array([cell.coords for cell in self.kdt.cells])
+        coords = self.kdt_coords
         # find the complement to plot_par_idx
         allidx = np.arange(len(self.nsteps))
         ii = allidx[~np.isin(allidx, plot_par_idx)]
@@ -455,3 +518,51 @@ class GridSampling():
             coords_2d[:, 0], coords_2d[:, 1], s=8,
             facecolor='k', edgecolors='none'
         )
+
+
+def write_misfit_grids(grid_samplings, filename):
+    """
+    Write misfit grids to a compressed numpy file (npz).
+
+    For each label (generally, the spectrum id and instrument type), the
+    following arrays are stored, with names in the form "label/array":
+    misfit (the misfit grid), values_N (parameter values along dimension N),
+    cond_misfit_N (conditional misfit along dimension N), bounds,
+    truebounds, params_opt, params_err, min_idx, params_name, params_unit,
+    sampling_mode and, for k-d tree search, kdt_coords and extent.
+    The array "labels" lists all the labels.
+
+    :param grid_samplings: Dictionary of GridSampling objects, keyed by label
+    :type grid_samplings: dict
+    :param filename: Output file name
+    :type filename: str
+    """
+    arrays = {'labels': np.array(list(grid_samplings), dtype=str)}
+    for label, gs in grid_samplings.items():
+        for name, array in gs.to_arrays().items():
+            arrays[f'{label}/{name}'] = array
+    np.savez_compressed(filename, **arrays)
+
+
+def read_misfit_grids(filename):
+    """
+    Read misfit grids written by :func:`write_misfit_grids()`.
+
+    The returned GridSampling objects have no misfit function, but provide
+    optimal parameters, uncertainties, conditional misfit and plotting
+    methods.
+
+    :param filename: Input file name
+    :type filename: str
+    :return: Dictionary of GridSampling objects, keyed by label
+    :rtype: dict
+    """
+    grid_samplings = {}
+    with np.load(filename) as data:
+        for label in data['labels']:
+            prefix = f'{label}/'
+            arrays = {
+                name[len(prefix):]: data[name] for name in data.files
+                if name.startswith(prefix)}
+            grid_samplings[str(label)] = GridSampling.from_arrays(arrays)
+    return grid_samplings
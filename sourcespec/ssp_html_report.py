@@ -549,6 +549,7 @@ def _add_inversion_info_to_html(sspec_output, replacements):
         'TNC': 'Truncated Newton',
         'LM': 'Levenberg-Marquardt',
         'BH': 'Basin-hopping',
+        'MS': 'Multi-start local minimization',
         'GS': 'Grid search',
         'IS': 'K-d tree importance sampling',
     }
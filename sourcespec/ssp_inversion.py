@@ -15,6 +15,7 @@ Spectral inversion routines for sourcespec.
     CeCILL Free Software License Agreement v2.1
     (http://www.cecill.info/licences.en.html)
 """
+import os
 import logging
 import numpy as np
 from scipy.optimize import curve_fit, minimize, basinhopping
@@ -29,11 +30,30 @@ from sourcespec.ssp_util import (
 from sourcespec.ssp_data_types import (
     InitialValues, Bounds, SpectralParameter, StationParameters,
     SourceSpecOutput)
-from sourcespec.ssp_grid_sampling import GridSampling
+from sourcespec.ssp_grid_sampling import GridSampling, write_misfit_grids
+from sourcespec.ssp_render import submit_plots
+from sourcespec.ssp_multistart import MultiStart
+from sourcespec.ssp_sqlite_output import read_station_parameters
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 
 
-def _curve_fit(config, spec, weight, yerr, initial_values, bounds):
+def _params_err_from_covariance(freq_logspaced, ydata, yerr, params_opt):
+    """Symmetric parameter errors from the covariance at params_opt."""
+    # trick: use curve_fit() bounded to params_opt
+    # to get the covariance
+    # pylint: disable=unbalanced-tuple-unpacking
+    _, params_cov = curve_fit(
+        spectral_model, freq_logspaced, ydata,
+        p0=params_opt, sigma=yerr,
+        bounds=(params_opt - (1e-10), params_opt + (1e-10))
+    )
+    err = np.sqrt(params_cov.diagonal())
+    # symmetric error
+    return tuple((e, e) for e in err)
+
+
+def _curve_fit(config, spec, weight, yerr, initial_values, bounds,
+               misfit_grids=None):
     """
     Curve fitting.
 
@@ -42,11 +62,33 @@ def _curve_fit(config, spec, weight, yerr, initial_values, bounds):
         Trust Region Reflective algorithm if bounds are provided.
       - Truncated Newton algorithm (TNC) with bounds.
       - Basin-hopping (BH)
+      - Multi-start bounded local minimization (MS)
       - Grid search (GS)
+
+    Returns the optimal parameters, their errors, the misfit, the number of
+    iterations (None if not provided by the algorithm) and the number of
+    evaluations of the objective function (or of the spectral model, for LM).
+
+    For GS and IS, if misfit_grids (a dictionary) is provided, the
+    GridSampling object is stored in it.
     """
     freq_logspaced = spec.freq_logspaced
     ydata = spec.data_mag_logspaced
-    minimize_func = objective_func(freq_logspaced, ydata, weight)
+    _objective_func = objective_func(freq_logspaced, ydata, weight)
+    nit = None
+    nfev = 0
+
+    # count the function evaluations (vectorized calls count once per point)
+    def minimize_func(params):
+        nonlocal nfev
+        nfev += np.size(params[0])
+        return _objective_func(params)
+
+    def model_func(freq, Mw, fc, t_star):
+        nonlocal nfev
+        nfev += 1
+        return spectral_model(freq, Mw, fc, t_star)
+
     if config.inv_algorithm == 'TNC':
         res = minimize(
             minimize_func,
@@ -54,17 +96,9 @@ def _curve_fit(config, spec, weight, yerr, initial_values, bounds):
             callback=callback, bounds=bounds.bounds
         )
         params_opt = res.x
-        # trick: use curve_fit() bounded to params_opt
-        # to get the covariance
-        # pylint: disable=unbalanced-tuple-unpacking
-        _, params_cov = curve_fit(
-            spectral_model, freq_logspaced, ydata,
-            p0=params_opt, sigma=yerr,
-            bounds=(params_opt - (1e-10), params_opt + (1e-10))
-        )
-        err = np.sqrt(params_cov.diagonal())
-        # symmetric error
-        params_err = ((e, e) for e in err)
+        nit = res.nit
+        params_err = _params_err_from_covariance(
+            freq_logspaced, ydata, yerr, params_opt)
     elif config.inv_algorithm == 'LM':
         bnds = bounds.get_bounds_curve_fit()
         if bnds is not None:
@@ -75,7 +109,7 @@ def _curve_fit(config, spec, weight, yerr, initial_values, bounds):
             )
         # pylint: disable=unbalanced-tuple-unpacking
         params_opt, params_cov = curve_fit(
-            spectral_model, freq_logspaced, ydata,
+            model_func, freq_logspaced, ydata,
             p0=initial_values.get_params0(), sigma=yerr,
             bounds=bnds
         )
@@ -88,17 +122,21 @@ def _curve_fit(config, spec, weight, yerr, initial_values, bounds):
             accept_test=bounds
         )
         params_opt = res.x
-        # trick: use curve_fit() bounded to params_opt
-        # to get the covariance
-        # pylint: disable=unbalanced-tuple-unpacking
-        _, params_cov = curve_fit(
-            spectral_model, freq_logspaced, ydata,
-            p0=params_opt, sigma=yerr,
-            bounds=(params_opt - (1e-10), params_opt + (1e-10))
-        )
-        err = np.sqrt(params_cov.diagonal())
-        # symmetric error
-        params_err = ((e, e) for e in err)
+        nit = res.nit
+        params_err = _params_err_from_covariance(
+            freq_logspaced, ydata, yerr, params_opt)
+    elif config.inv_algorithm == 'MS':
+        multistart = MultiStart(
+            minimize_func, bounds.bounds, sampling_mode=('lin', 'log', 'lin'),
+            params_name=('Mw', 'fc', 't_star'),
+            n_starts=config.multistart_n_starts, seed=config.multistart_seed)
+        multistart.search()
+        logger.info(
+            f'{spec.id} {spec.stats.instrtype}: multi-start: {multistart}')
+        params_opt = multistart.params_opt
+        nit = multistart.nit
+        params_err = _params_err_from_covariance(
+            freq_logspaced, ydata, yerr, params_opt)
     elif config.inv_algorithm in ['GS', 'IS']:
         nsteps = (20, 150, 150)  # we do fewer steps in magnitude
         sampling_mode = ('lin', 'log', 'lin')
@@ -114,18 +152,22 @@ def _curve_fit(config, spec, weight, yerr, initial_values, bounds):
         params_opt = grid_sampling.params_opt
         params_err = grid_sampling.params_err
         spec_label = f'{spec.id} {spec.stats.instrtype}'
-        grid_sampling.plot_conditional_misfit(config, spec_label)
-        # fc-t_star
-        plot_par_idx = (1, 2)
-        grid_sampling.plot_misfit_2d(config, plot_par_idx, spec_label)
-        # fc-Mw
-        plot_par_idx = (1, 0)
-        grid_sampling.plot_misfit_2d(config, plot_par_idx, spec_label)
-        # tstar-Mw
-        plot_par_idx = (2, 0)
-        grid_sampling.plot_misfit_2d(config, plot_par_idx, spec_label)
-    misfit = minimize_func(params_opt)
-    return params_opt, params_err, misfit
+        # all the misfit plots in one job, so that the grid sampling
+        # object (and its misfit array) is only serialized once
+        plot_misfit_2d = grid_sampling.plot_misfit_2d
+        submit_plots(config, [
+            (grid_sampling.plot_conditional_misfit, (spec_label, ), {}),
+            # fc-t_star
+            (plot_misfit_2d, ((1, 2), spec_label), {}),
+            # fc-Mw
+            (plot_misfit_2d, ((1, 0), spec_label), {}),
+            # tstar-Mw
+            (plot_misfit_2d, ((2, 0), spec_label), {}),
+        ])
+        if misfit_grids is not None:
+            misfit_grids[spec_label] = grid_sampling
+    misfit = _objective_func(params_opt)
+    return params_opt, params_err, misfit, nit, nfev
 
 
 def _freq_ranges_for_Mw0_and_tstar0(config, weight, freq_logspaced, statId):
@@ -172,8 +214,35 @@ def _freq_ranges_for_Mw0_and_tstar0(config, weight, freq_logspaced, statId):
     return idx0, idx1
 
 
-def _spec_inversion(config, spec, spec_weight):
-    """Invert one spectrum, return a StationParameters() object."""
+def _apply_warm_start(initial_values, bounds, warm_values):
+    """
+    Replace initial values with warm-start values, clipped to the bounds.
+
+    Bounds are not modified.
+    """
+    for name, value, (vmin, vmax) in zip(
+            ('Mw_0', 'fc_0', 't_star_0'), warm_values, bounds.bounds):
+        if value is None or not np.isfinite(value):
+            continue
+        if vmin is not None:
+            value = max(value, vmin)
+        if vmax is not None:
+            value = min(value, vmax)
+        setattr(initial_values, name, value)
+
+
+def _spec_inversion(config, spec, spec_weight, warm_values=None,
+                    misfit_grids=None):
+    """
+    Invert one spectrum, return a StationParameters() object.
+
+    If warm_values (a tuple of Mw, fc, t_star) is provided, it is used as
+    initial values for the inversion, instead of the values estimated from
+    the spectrum.
+
+    If misfit_grids (a dictionary) is provided, the misfit grid of the GS
+    and IS algorithms is stored in it.
+    """
     # azimuth computation
     coords = spec.stats.coords
     stla = coords.latitude
@@ -241,12 +310,15 @@ def _spec_inversion(config, spec, spec_weight):
         bounds.t_star_min = t_star_min
     if t_star_max is not None:
         bounds.t_star_max = t_star_max
+    if warm_values is not None:
+        _apply_warm_start(initial_values, bounds, warm_values)
     # Initial values need to be printed here because Bounds can modify them
     logger.info(f'{statId}: initial values: {initial_values}')
     logger.info(f'{statId}: bounds: {bounds}')
     try:
-        params_opt, params_err, misfit = _curve_fit(
-            config, spec, weight, yerr, initial_values, bounds)
+        params_opt, params_err, misfit, nit, nfev = _curve_fit(
+            config, spec, weight, yerr, initial_values, bounds,
+            misfit_grids)
     except (RuntimeError, ValueError) as m:
         raise RuntimeError(
             f'{m}\n{statId}: unable to fit spectral model'
@@ -257,6 +329,8 @@ def _spec_inversion(config, spec, spec_weight):
     inverted_par_str = f'Mw: {Mw:.4f}; fc: {fc:.4f}; t_star: {t_star:.4f}'
     logger.info(f'{statId}: optimal values: {inverted_par_str}')
     logger.info(f'{statId}: misfit: {misfit:.3f}')
+    nit_str = '' if nit is None else f'iterations: {nit}; '
+    logger.info(f'{statId}: {nit_str}function evaluations: {nfev}')
 
     if np.isclose(fc, bounds.fc_min, rtol=0.1):
         raise ValueError(
@@ -300,6 +374,8 @@ def _spec_inversion(config, spec, spec_weight):
         hypo_dist_in_km=spec.stats.hypo_dist,
         epi_dist_in_km=spec.stats.epi_dist,
         azimuth=az)
+    station_pars.n_iterations = nit
+    station_pars.n_function_evaluations = nfev
     station_pars.Mw = SpectralParameter(
         param_id='Mw', value=Mw,
         lower_uncertainty=Mw_err[0], upper_uncertainty=Mw_err[1],
@@ -387,10 +463,42 @@ def _spec_inversion(config, spec, spec_weight):
     return station_pars
 
 
+def _warm_start_values(config, spec, db_station_params, sspec_output):
+    """
+    Return warm-start values (Mw, fc, t_star) for a spectrum, or None.
+
+    Values are taken from a previous run (if available) or computed as the
+    median of the stations already inverted. In the latter case, t_star is
+    computed from the median quality factor and the station travel time.
+    """
+    if config.inv_warm_start == 'no_warm_start':
+        return None
+    statId = f'{spec.id} {spec.stats.instrtype}'
+    if spec.id in db_station_params:
+        logger.info(f'{statId}: warm start from previous run')
+        return db_station_params[spec.id]
+    station_params = list(sspec_output.station_parameters.values())
+    if not station_params:
+        return None
+    Mw = np.nanmedian([par.Mw.value for par in station_params])
+    fc = np.nanmedian([par.fc.value for par in station_params])
+    Qo = np.array([par.Qo.value for par in station_params])
+    Qo = Qo[np.isfinite(Qo) & (Qo > 0)]
+    t_star = None
+    if Qo.size:
+        travel_time = spec.stats.travel_times[config.wave_type[0]]
+        t_star = travel_time / np.median(Qo)
+    logger.info(
+        f'{statId}: warm start from {len(station_params)} inverted '
+        'station(s)')
+    return Mw, fc, t_star
+
+
 def _synth_spec(config, spec, station_pars):
     """Return a stream with one or more synthetic spectra."""
-    par = station_pars.params_dict
-    par_err = station_pars.params_err_dict
+    # copies, since the dictionaries are views on the station parameters
+    par = dict(station_pars.params_dict)
+    par_err = dict(station_pars.params_err_dict)
     spec_st = Stream()
     params_opt = [par[key] for key in ('Mw', 'fc', 't_star')]
 
@@ -438,6 +546,17 @@ def _synth_spec(config, spec, station_pars):
     return spec_st
 
 
+def _write_misfit_grids(config, misfit_grids):
+    """Write the misfit grids of the GS and IS algorithms to file."""
+    outdir = config.options.outdir
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    evid = config.event.event_id
+    misfit_file = os.path.join(outdir, f'{evid}.misfit.npz')
+    write_misfit_grids(misfit_grids, misfit_file)
+    logger.info(f'Misfit grids saved to: {misfit_file}')
+
+
 def spectral_inversion(config, spec_st, weight_st):
     """Inversion of displacement spectra."""
     logger.info('Inverting spectra...')
@@ -452,12 +571,25 @@ def spectral_inversion(config, spec_st, weight_st):
         'TNC': 'Using truncated Newton algorithm for inversion.',
         'LM': 'Using Levenberg-Marquardt algorithm for inversion.',
         'BH': 'Using basin-hopping algorithm for inversion.',
+        'MS': 'Using multi-start local minimization for inversion.',
         'GS': 'Using grid search for inversion.',
         'IS': 'Using k-d tree importance sampling for inversion.'
     }
     logger.info(algorithm_messages[config.inv_algorithm])
-
-    stations = {x.stats.station for x in spec_st}
+    db_station_params = {}
+    if config.inv_warm_start == 'database':
+        db_station_params = read_station_parameters(config)
+        logger.info(
+            'Warm start: station parameters from a previous run found for '
+            f'{len(db_station_params)} station(s)')
+
+    misfit_grids = None
+    if config.save_misfit_grids and config.inv_algorithm in ['GS', 'IS']:
+        misfit_grids = {}
+
+    # stations are inverted in a fixed order, since warm-start values
+    # depend on the stations already inverted
+    stations = sorted({x.stats.station for x in spec_st})
     spectra = [sp for sta in stations for sp in spec_st.select(station=sta)]
 
     sspec_output = SourceSpecOutput()
@@ -499,14 +631,22 @@ def spectral_inversion(config, spec_st, weight_st):
         if spec.stats.ignore:
             continue
         spec_weight = select_trace(weight_st, spec.id, spec.stats.instrtype)
+        warm_values = _warm_start_values(
+            config, spec, db_station_params, sspec_output)
         try:
-            station_pars = _spec_inversion(config, spec, spec_weight)
+            station_pars = _spec_inversion(
+                config, spec, spec_weight, warm_values, misfit_grids)
         except (RuntimeError, ValueError) as msg:
             logger.warning(msg)
+            if misfit_grids is not None:
+                # only keep the misfit grids of valid inversions
+                misfit_grids.pop(f'{spec.id} {spec.stats.instrtype}', None)
             continue
         spec_st += _synth_spec(config, spec, station_pars)
         sspec_output.station_parameters[station_pars.param_id] = station_pars
 
+    if misfit_grids:
+        _write_misfit_grids(config, misfit_grids)
     logger.info('Inverting spectra: done')
     logger.info('---------------------------------------------------')
     return sspec_output
@@ -0,0 +1,197 @@
+# -*- coding: utf8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+A class for multi-start bounded optimization.
+
+Starting points are drawn from a Latin hypercube sampling of the parameter
+bounds. The misfit of all the starting points is evaluated in a single
+vectorized call and local bounded minimizations are started from the best
+points, in batches, until the best minimum is found by several starts.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import logging
+import numpy as np
+from scipy.optimize import minimize
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
+
+
+def latin_hypercube(n_samples, ndim, rng):
+    """
+    Latin hypercube sampling of the unit hypercube.
+
+    Each dimension is divided into n_samples intervals of equal size and
+    every interval is sampled exactly once.
+
+    :param n_samples: Number of samples
+    :type n_samples: int
+    :param ndim: Number of dimensions
+    :type ndim: int
+    :param rng: Random number generator
+    :type rng: numpy.random.Generator
+    :return: Samples, shape (n_samples, ndim), values in [0, 1)
+    :rtype: numpy.ndarray
+    """
+    samples = np.empty((n_samples, ndim))
+    for dim in range(ndim):
+        samples[:, dim] =\
+            (rng.permutation(n_samples) + rng.random(n_samples)) / n_samples
+    return samples
+
+
+class MultiStart():
+    """
+    A class for multi-start bounded optimization.
+
+    The misfit function must accept a sequence of parameters, each being
+    either a scalar or an array of shape (n, 1): in the latter case, it must
+    return an array of n misfit values.
+    """
+
+    # Number of local minimizations run before checking for convergence
+    batch_size = 8
+    # The search stops when the best minimum has been found by this number
+    # of local minimizations
+    n_hits = 3
+    # Tolerances for considering two minima equal
+    rtol = 1e-4
+    atol = 1e-8
+    # Number of Latin hypercube samples per local minimization
+    oversampling = 10
+
+    def __init__(self, misfit_func, bounds, sampling_mode, params_name,
+                 n_starts=50, seed=None):
+        """
+        Init multi-start optimization.
+
+        bounds : sequence of (min, max) pairs for each dimension.
+        sampling_mode : sequence of 'lin' or 'log' for each dimension.
+        params_name : sequence of parameter names (str).
+        n_starts : maximum number of local minimizations.
+        seed : seed for the random number generator.
+        """
+        self.misfit_func = misfit_func
+        self.bounds = tuple(tuple(bds) for bds in bounds)
+        self.sampling_mode = sampling_mode
+        self.params_name = params_name
+        self.n_starts = n_starts
+        self.seed = seed
+        for bds, mode in zip(self.bounds, self.sampling_mode):
+            if None in bds:
+                msg = 'All parameters must be bounded for multi-start search'
+                raise RuntimeError(msg)
+            if mode == 'log' and bds[0] <= 0:
+                msg = 'Log-sampled parameters must have positive bounds'
+                raise RuntimeError(msg)
+        # local minima: misfit values, parameters, iterations, evaluations
+        self.minima_misfit = None
+        self.minima_params = None
+        self.nit = 0
+        self.nfev = 0
+
+    def _starting_points(self):
+        """
+        Return the starting points, sorted by increasing misfit.
+
+        n_starts * oversampling points are drawn from a Latin hypercube and
+        their misfit is computed in a single vectorized call.
+        """
+        rng = np.random.default_rng(self.seed)
+        n_samples = self.n_starts * self.oversampling
+        unit_samples = latin_hypercube(n_samples, len(self.bounds), rng)
+        samples = np.empty_like(unit_samples)
+        for dim, (bds, mode) in enumerate(
+                zip(self.bounds, self.sampling_mode)):
+            vmin, vmax = bds
+            if mode == 'log':
+                vmin, vmax = np.log10(vmin), np.log10(vmax)
+            values = vmin + unit_samples[:, dim] * (vmax - vmin)
+            samples[:, dim] = 10**values if mode == 'log' else values
+        misfit = self.misfit_func(
+            [samples[:, dim, None] for dim in range(samples.shape[1])])
+        self.nfev += n_samples
+        order = np.argsort(misfit)
+        return samples[order][:self.n_starts]
+
+    def search(self):
+        """Run the multi-start search."""
+        minima_misfit = []
+        minima_params = []
+        for x0 in self._starting_points():
+            res = minimize(
+                self.misfit_func, x0=x0, method='L-BFGS-B',
+                bounds=self.bounds)
+            minima_misfit.append(float(res.fun))
+            minima_params.append(res.x)
+            self.nit += res.nit
+            self.nfev += res.nfev
+            if len(minima_misfit) % self.batch_size:
+                continue
+            if self._converged(minima_misfit):
+                break
+        self.minima_misfit = np.array(minima_misfit)
+        self.minima_params = np.array(minima_params)
+
+    def _converged(self, minima_misfit):
+        """Check if the best minimum has been found enough times."""
+        minima_misfit = np.asarray(minima_misfit)
+        hits = np.isclose(
+            minima_misfit, minima_misfit.min(), rtol=self.rtol, atol=self.atol)
+        return hits.sum() >= self.n_hits
+
+    @property
+    def n_runs(self):
+        """Return the number of local minimizations run."""
+        if self.minima_misfit is None:
+            return 0
+        return len(self.minima_misfit)
+
+    @property
+    def params_opt(self):
+        """Return optimal parameters."""
+        if self.minima_misfit is None:
+            return None
+        return self.minima_params[np.argmin(self.minima_misfit)]
+
+    @property
+    def misfit_opt(self):
+        """Return the misfit of the optimal parameters."""
+        if self.minima_misfit is None:
+            return None
+        return self.minima_misfit.min()
+
+    @property
+    def n_distinct_minima(self):
+        """Return the number of distinct local minima (by misfit value)."""
+        if self.minima_misfit is None:
+            return 0
+        misfits = np.sort(self.minima_misfit)
+        distinct = ~np.isclose(
+            misfits[1:], misfits[:-1], rtol=self.rtol, atol=self.atol)
+        return 1 + int(distinct.sum())
+
+    @property
+    def minima_spread(self):
+        """Return the standard deviation of local minima parameters."""
+        if self.minima_params is None:
+            return None
+        return self.minima_params.std(axis=0)
+
+    def __str__(self):
+        """String representation: a summary of the local minima."""
+        if self.minima_misfit is None:
+            return 'multi-start search not run'
+        spread = ', '.join(
+            f'{name}: {std:.4g}'
+            for name, std in zip(self.params_name, self.minima_spread))
+        return (
+            f'{self.n_runs} local starts, '
+            f'{self.n_distinct_minima} distinct minima; '
+            f'misfit range: {self.minima_misfit.min():.4f}, '
+            f'{self.minima_misfit.max():.4f}; '
+            f'spread of minima (std): {spread}'
+        )
@@ -194,6 +194,30 @@ def _update_parser_for_source_spec(parser):
         help='use run_id as a subdirectory of the event directory\n'
              '(default: False)'
     )
+    parser.add_argument(
+        '-x', '--sweep', dest='sweep_file',
+        action='store', default=None,
+        help='parameter sweep: build spectra once and run the inversion\n'
+             'for each set of config overrides defined in SWEEP_FILE\n'
+             '(YAML format). Results are written to a comparison table\n'
+             '(CSV and SQLite); no plots nor reports are produced.',
+        metavar='SWEEP_FILE'
+    )
+    parser.add_argument(
+        '--sweep_jobs', dest='sweep_jobs', type=int,
+        action='store', default=None,
+        help='number of parallel jobs for the parameter sweep\n'
+             '(default: number of CPUs)',
+        metavar='NJOBS'
+    )
+    parser.add_argument(
+        '--skip_unchanged', dest='skip_unchanged',
+        action='store_true', default=False,
+        help='skip the event if its input files and config did not\n'
+             'change since the last run with this option, in the same\n'
+             'output directory. The reason for skipping or processing\n'
+             'the event is logged (default: False)'
+    )
 
 
 def _update_parser_for_source_model(parser):
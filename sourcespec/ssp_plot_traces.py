@@ -22,6 +22,7 @@ from matplotlib import patches
 import matplotlib.patheffects as PathEffects
 from matplotlib.ticker import ScalarFormatter as sf
 from sourcespec.savefig import savefig
+from sourcespec.ssp_process_traces import trace_snippets
 from sourcespec._version import get_versions
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 # Reduce logging level for Matplotlib to avoid DEBUG messages
@@ -121,6 +122,10 @@ def _make_fig(config, nlines, ncols):
     return fig, axes
 
 
+# Resolution (dots per inch) for trace decimation: for each dot column,
+# only the first, minimum, maximum and last samples are plotted.
+# This is the same resolution used for png figures.
+TRACE_DECIMATION_DPI = 300
 # Keep track of saved figure numbers to avoid saving the same figure twice
 SAVED_FIGURE_NUMBERS = []
 # Bounding box for saving figures
@@ -164,29 +169,31 @@ def _savefig(config, figures, force_numbering=False):
         pdf.close()
 
 
-def _plot_min_max(ax, x_vals, y_vals, linewidth, color, alpha, zorder):
-    """Quick and dirty plot using less points. Useful for vector plotting."""
-    ax_width_in_pixels = int(np.ceil(ax.bbox.width))
-    nsamples = len(x_vals)
-    samples_per_pixel = int(np.ceil(nsamples / ax_width_in_pixels))
-    # find the closest multiple of samples_per_pixel (rounded down)
-    nsamples -= nsamples % samples_per_pixel
-    # resample x_vals
-    x_vals = x_vals[:nsamples:samples_per_pixel]
-    # reshape y_vals so that each row has a number of elements equal to
-    # samples_per_pixel
-    y_vals = y_vals[:nsamples].reshape(-1, samples_per_pixel)
-    # find min and max for each row
-    y_min = y_vals.min(axis=1)
-    y_max = y_vals.max(axis=1)
-    # double the number of elements in x_vals
-    dx = x_vals[1] - x_vals[0]
-    x_vals = np.column_stack((x_vals, x_vals + dx / 2)).flatten()
-    # alternate mins and maxs in y_vals
-    y_vals = np.column_stack((y_min, y_max)).flatten()
-    ax.plot(
-        x_vals, y_vals, linewidth=linewidth, color=color, alpha=alpha,
-        zorder=zorder)
+def _decimate_min_max(x_vals, y_vals, npixels):
+    """
+    Decimate a line for plotting, preserving its look.
+
+    Samples are divided in (at least) npixels bins and, for each bin, only the
+    first, minimum, maximum and last samples are kept, in time order
+    (M4 algorithm). Peaks are preserved and, if bins are not wider than a
+    pixel column, the decimated line is drawn as the original one.
+    """
+    nsamples = len(y_vals)
+    samples_per_bin = int(np.ceil(nsamples / npixels))
+    if samples_per_bin < 5 or not np.all(np.isfinite(y_vals)):
+        return x_vals, y_vals
+    nbins = int(np.ceil(nsamples / samples_per_bin))
+    # pad the last bin with NaNs, which are ignored by nanargmin/nanargmax
+    bins = np.full(nbins * samples_per_bin, np.nan)
+    bins[:nsamples] = y_vals
+    bins = bins.reshape(nbins, samples_per_bin)
+    first = np.arange(nbins) * samples_per_bin
+    last = np.minimum(first + samples_per_bin, nsamples) - 1
+    idx_min = first + np.nanargmin(bins, axis=1)
+    idx_max = first + np.nanargmax(bins, axis=1)
+    # np.unique() also sorts indexes, i.e., samples are kept in time order
+    idx = np.unique(np.concatenate((first, idx_min, idx_max, last)))
+    return x_vals[idx], y_vals[idx]
 
 
 def _freq_string(freq):
@@ -234,15 +241,17 @@ def _plot_trace(config, trace, ntraces, tmax, ax, trans, trans3, path_effects):
     # dim out ignored traces
     alpha = 0.3 if trace.stats.ignore else 1.0
     times = trace.times() + trace.stats.time_offset
-    if config.plot_save_format == 'png':
-        ax.plot(
-            times, trace.data, linewidth=1, color=color,
-            alpha=alpha, zorder=20, rasterized=True)
-    else:
-        # reduce the number of points to plot for vector formats
-        _plot_min_max(
-            ax, times, trace.data, linewidth=1, color=color,
-            alpha=alpha, zorder=20)
+    data = trace.data
+    if not config.plot_show:
+        # reduce the number of points to plot, based on the axes width
+        # (figures shown on screen keep all the points, for zooming)
+        npixels = int(np.ceil(
+            ax.bbox.width / ax.figure.dpi * TRACE_DECIMATION_DPI))
+        times, data = _decimate_min_max(times, data, npixels)
+    # high dpi needed to rasterize png
+    ax.plot(
+        times, data, linewidth=1, color=color, alpha=alpha, zorder=20,
+        rasterized=config.plot_save_format == 'png')
     ax.text(0.05, trace.data.mean(), trace.stats.channel,
             fontsize=8, color=color, transform=trans3, zorder=22,
             path_effects=path_effects)
@@ -332,10 +341,7 @@ def _set_ylim(axes):
 
 
 def _trim_traces(config, st):
-    for trace in st:
-        t1 = trace.stats.arrivals['P'][1] - config.noise_pre_time
-        t2 = trace.stats.arrivals['S'][1] + 3 * config.win_length
-        trace.trim(starttime=t1, endtime=t2)
+    st.traces = trace_snippets(config, st).traces
     # compute time offset for correctly aligning traces when plotting
     min_starttime = min(tr.stats.starttime for tr in st)
     for trace in st:
@@ -17,7 +17,7 @@ Trace processing for sourcespec.
 import logging
 import re
 import numpy as np
-from scipy.signal import savgol_filter
+from scipy.signal import savgol_filter, detrend
 from obspy.core import Stream
 from obspy.core.util import AttribDict
 from sourcespec.ssp_setup import ssp_exit
@@ -25,9 +25,13 @@ from sourcespec.ssp_util import (
     remove_instr_response, station_to_event_position)
 from sourcespec.ssp_wave_arrival import add_arrival_to_trace
 from sourcespec.clipping_detection import (
-    compute_clipping_score, clipping_peaks)
+    compute_clipping_score, clipping_peaks, read_clipping_skip_list,
+    listed_as_clipped)
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 
+# Maximum number of samples per window for the pre-screening S/N ratio
+PRESCREEN_MAX_SAMPLES = 1000
+
 
 def _get_bandpass_frequencies(config, trace):
     """Get frequencies for bandpass filter."""
@@ -155,6 +159,51 @@ def _check_sn_ratio(config, trace):
         trace.stats.ignore_reason = 'low S/N'
 
 
+def _window_rms(trace, start, end):
+    """
+    RMS of the detrended trace data between two arrivals (e.g., 'N1' and
+    'N2').
+
+    Data are decimated to at most ``PRESCREEN_MAX_SAMPLES`` samples, which is
+    enough for a rough estimate of the RMS.
+    """
+    starttime = trace.stats.starttime
+    sampling_rate = trace.stats.sampling_rate
+    t1 = trace.stats.arrivals[start][1]
+    t2 = trace.stats.arrivals[end][1]
+    i1 = max(int(round((t1 - starttime) * sampling_rate)), 0)
+    i2 = int(round((t2 - starttime) * sampling_rate))
+    data = trace.data[i1:i2 + 1]
+    step = max(len(data) // PRESCREEN_MAX_SAMPLES, 1)
+    data = data[::step].astype(float)
+    if len(data) < 2:
+        return 0.
+    return np.sqrt(np.mean(detrend(data)**2))
+
+
+def _prescreen_sn_ratio(config, trace):
+    """
+    Skip traces with a low S/N ratio, before the instrument correction.
+
+    This is a fast estimate on the raw (detrended and decimated) data,
+    to avoid processing hopeless traces. The final S/N ratio is computed by
+    ``_check_sn_ratio()`` on the processed trace.
+    """
+    sn_min = config.prescreen_sn_min
+    if sn_min is None:
+        return
+    wave = config.wave_type[0]
+    rms_noise = _window_rms(trace, 'N1', 'N2')
+    # let _check_sn_ratio() deal with empty noise windows
+    if rms_noise == 0:
+        return
+    sn_ratio = _window_rms(trace, f'{wave}1', f'{wave}2') / rms_noise
+    if sn_ratio < sn_min:
+        raise RuntimeError(
+            f'{trace.stats.info}: pre-screening S/N ({sn_ratio:.1f}) smaller '
+            f'than {sn_min:g}: skipping trace')
+
+
 def _get_detrended_trace_copy(trace):
     # noise time window for s/n ratio
     tr_copy = trace.copy()
@@ -396,6 +445,37 @@ def _merge_stream(config, st):
     return st[0]
 
 
+def _read_clipping_skip_list(config):
+    """Read the clipping skip list, if any."""
+    if config.clipping_skip_list is None:
+        return None
+    try:
+        skip_list = read_clipping_skip_list(config.clipping_skip_list)
+    except Exception as msg:
+        logger.error(
+            f'Unable to read clipping skip list '
+            f'{config.clipping_skip_list}: {msg}')
+        ssp_exit(1)
+    nspans = sum(len(spans) for spans in skip_list.values())
+    logger.info(
+        f'Clipping skip list: {nspans} clipped time spans for '
+        f'{len(skip_list)} trace ids')
+    return skip_list
+
+
+def _skip_listed_as_clipped(skip_list, st):
+    """Skip traces listed as clipped in the clipping skip list."""
+    if skip_list is None:
+        return
+    traceid = st[0].id
+    starttime = min(tr.stats.starttime for tr in st)
+    endtime = max(tr.stats.endtime for tr in st)
+    if listed_as_clipped(skip_list, traceid, starttime, endtime):
+        raise RuntimeError(
+            f'{traceid}: listed as clipped in clipping skip list: '
+            'skipping trace')
+
+
 def _skip_ignored(config, traceid):
     """Skip traces ignored from config."""
     network, station, location, channel = traceid.split('.')
@@ -425,11 +505,13 @@ def process_traces(config, st):
     """Remove mean, deconvolve and ignore unwanted components."""
     logger.info('Processing traces...')
     out_st = Stream()
+    clipping_skip_list = _read_clipping_skip_list(config)
     for traceid in sorted({tr.id for tr in st}):
         try:
             _skip_ignored(config, traceid)
             # We still use a stream, since the trace can have gaps or overlaps
             st_sel = st.select(id=traceid)
+            _skip_listed_as_clipped(clipping_skip_list, st_sel)
             for _trace in st_sel:
                 _add_station_to_event_position(_trace)
                 _check_epicentral_distance(config, _trace)
@@ -437,6 +519,7 @@ def process_traces(config, st):
                 _define_signal_and_noise_windows(config, _trace)
             _check_signal_window(config, st_sel)
             trace = _merge_stream(config, st_sel)
+            _prescreen_sn_ratio(config, trace)
             trace.stats.ignore = False
             trace_process = _process_trace(config, trace)
             out_st.append(trace_process)
@@ -463,3 +546,21 @@ def process_traces(config, st):
     logger.info('Processing traces: done')
     logger.info('---------------------------------------------------')
     return out_st
+
+
+def trace_snippets(config, st):
+    """
+    Return a copy of the traces, cut between ``noise_pre_time`` before the P
+    arrival and three signal windows (``win_length``) after the S arrival.
+
+    This is the part of the traces shown in the trace plots.
+    """
+    snippets = Stream()
+    for trace in st:
+        t1 = trace.stats.arrivals['P'][1] - config.noise_pre_time
+        t2 = trace.stats.arrivals['S'][1] + 3 * config.win_length
+        snippet = trace.slice(starttime=t1, endtime=t2)
+        # slice() shares data with the original trace
+        snippet.data = snippet.data.copy()
+        snippets.append(snippet)
+    return snippets
@@ -23,6 +23,8 @@ from obspy import read_events
 from sourcespec.ssp_setup import ssp_exit, TRACEID_MAP
 from sourcespec.ssp_event import SSPEvent
 from sourcespec.ssp_pick import SSPPick
+from sourcespec.ssp_event_index import (
+    INDEX_MIN_FILE_SIZE, get_qml_index, read_event_xml)
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 
 
@@ -76,6 +78,10 @@ def parse_qml(config):
 
 
 def _get_event_from_qml(qml_file, event_id=None):
+    # large catalogues are indexed once, then read one event at a time
+    if os.path.getsize(qml_file) >= INDEX_MIN_FILE_SIZE:
+        qml_index = get_qml_index(qml_file, _get_evid_from_resource_id)
+        return qml_index.get_event(event_id)
     cat = read_events(qml_file)
     if event_id is not None:
         _qml_events = [ev for ev in cat if event_id in str(ev.resource_id)]
@@ -93,6 +99,23 @@ def _get_event_from_qml(qml_file, event_id=None):
     return qml_event
 
 
+def get_qml_event_xml(qml_file, event_id=None):
+    """
+    Get the XML record of the event read from a QuakeML file.
+
+    :param qml_file: QuakeML file
+    :type qml_file: str
+    :param event_id: Event id. If None, the first event is returned.
+    :type event_id: str
+    :return: Event XML
+    :rtype: bytes
+    """
+    if os.path.getsize(qml_file) >= INDEX_MIN_FILE_SIZE:
+        qml_index = get_qml_index(qml_file, _get_evid_from_resource_id)
+        return qml_index.get_event_xml(event_id)
+    return read_event_xml(qml_file, event_id)
+
+
 def _get_evid_from_resource_id(resource_id):
     """
     Get evid from resource_id.
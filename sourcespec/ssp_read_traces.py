@@ -83,15 +83,32 @@ def _add_instrtype(trace):
     trace.stats.info = f'{trace.id} {trace.stats.instrtype}'
 
 
-def _add_inventory(trace, inventory, config):
-    """Add inventory to trace."""
-    net, sta, loc, chan = trace.id.split('.')
-    inv = (
+def select_inventory(inventory, trace_id):
+    """
+    Select the station metadata for a trace id, falling back to the
+    generic station metadata ("XX.GENERIC.XX.XXX"), if any.
+
+    :param inventory: Station metadata
+    :type inventory: :class:`~obspy.core.inventory.inventory.Inventory`
+    :param trace_id: Trace id
+    :type trace_id: str
+
+    :return: Selected station metadata (possibly empty)
+    :rtype: :class:`~obspy.core.inventory.inventory.Inventory`
+    """
+    net, sta, loc, chan = trace_id.split('.')
+    return (
         inventory.select(
             network=net, station=sta, location=loc, channel=chan)
         or inventory.select(
             network='XX', station='GENERIC', location='XX', channel='XXX')
     )
+
+
+def _add_inventory(trace, inventory, config):
+    """Add inventory to trace."""
+    net, sta, loc, chan = trace.id.split('.')
+    inv = select_inventory(inventory, trace.id)
     if 'XX.GENERIC.XX.XXX' in inv.get_contents()['channels']:
         inv = inv.copy()
         inv.networks[0].code = net
@@ -264,12 +281,12 @@ def _hypo_vel(hypo, config):
     logger.info(f'{depth_string}, {vp_string}, {vs_string}, {rho_string}')
 
 
-def _build_filelist(path, filelist, tmpdir):
+def _build_filelist(path, filelist, tmpdir, archives=None):
     if os.path.isdir(path):
         listing = os.listdir(path)
         for filename in listing:
             fullpath = os.path.join(path, filename)
-            _build_filelist(fullpath, filelist, tmpdir)
+            _build_filelist(fullpath, filelist, tmpdir, archives)
     else:
         try:
             # pylint: disable=unspecified-encoding consider-using-with
@@ -278,6 +295,8 @@ def _build_filelist(path, filelist, tmpdir):
             logger.error(err)
             return
         if tarfile.is_tarfile(path) and tmpdir is not None:
+            if archives is not None:
+                archives.append(path)
             with tarfile.open(path) as tar:
                 try:
                     tar.extractall(path=tmpdir)
@@ -285,6 +304,8 @@ def _build_filelist(path, filelist, tmpdir):
                     logger.warning(
                         f'{path}: Unable to fully extract tar archive: {msg}')
         elif zipfile.is_zipfile(path) and tmpdir is not None:
+            if archives is not None:
+                archives.append(path)
             with zipfile.ZipFile(path) as zipf:
                 try:
                     zipf.extractall(path=tmpdir)
@@ -305,8 +326,10 @@ def _read_trace_files(config, inventory, ssp_event, picks):
     #         to move files to it and extract all tar archives
     tmpdir = tempfile.mkdtemp()
     filelist = []
+    archives = []
     for trace_path in config.options.trace_path:
-        _build_filelist(trace_path, filelist, tmpdir)
+        _build_filelist(trace_path, filelist, tmpdir, archives)
+    input_files = set(filelist)
     # ph 1.2: rerun '_build_filelist()' in tmpdir to add to the
     #         filelist all the extraceted files
     listing = os.listdir(tmpdir)
@@ -318,6 +341,8 @@ def _read_trace_files(config, inventory, ssp_event, picks):
         config.horizontal_channel_codes_1 +\
         config.horizontal_channel_codes_2
     st = Stream()
+    # input files actually read (archives are considered as a whole)
+    trace_files = archives
     for filename in sorted(filelist):
         try:
             tmpst = read(filename, fsize=False)
@@ -325,6 +350,8 @@ def _read_trace_files(config, inventory, ssp_event, picks):
             logger.warning(
                 f'{filename}: Unable to read file as a trace: skipping')
             continue
+        if filename in input_files:
+            trace_files.append(filename)
         for trace in tmpst.traces:
             orientation = trace.stats.channel[-1]
             if orientation not in orientation_codes:
@@ -352,6 +379,7 @@ def _read_trace_files(config, inventory, ssp_event, picks):
                 continue
             st.append(trace)
     shutil.rmtree(tmpdir)
+    config.trace_files = sorted(os.path.abspath(f) for f in trace_files)
     return st
 # -----------------------------------------------------------------------------
 
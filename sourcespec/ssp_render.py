@@ -0,0 +1,781 @@
+# -*- coding: utf8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Parallel and deferred rendering of figures.
+
+Each plotting call is turned into a self-contained job (the plotting
+function and a pickled snapshot of its arguments), which is rendered in a
+pool of worker processes using the Agg backend. Figure file names, log
+messages and the list of figures in ``config.figures`` are the same as for
+serial rendering.
+
+Plotting functions can be given by name (``'module.function'``), so that
+plotting modules are only imported where figures are rendered.
+
+If the ``plot_deferred`` config parameter is set, jobs are not rendered but
+saved, together with the data for the HTML report, to a plot data file
+(``EVID.plotdata.npz``). Figures and HTML report can be produced later from
+this file, using the ``source_spec_plot`` command.
+
+The plot data file contains no pickled objects: plotting inputs (trace
+snippets, spectra, weights and fits, misfit grids, station parameters and
+geometry) are saved as plain arrays, referenced from JSON descriptions of
+the jobs and of the config, from which ``source_spec_plot`` rebuilds them.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import os
+import json
+import pickle
+import hashlib
+import inspect
+import contextlib
+import logging
+import importlib
+from argparse import Namespace
+from datetime import datetime
+from collections import defaultdict
+import numpy as np
+from obspy import UTCDateTime
+from obspy.core import Stream, Trace
+from obspy.core.util import AttribDict
+from sourcespec._version import get_versions
+from sourcespec.config import Config
+from sourcespec.savefig import flush_figures
+from sourcespec.spectrum import Spectrum
+from sourcespec.ssp_data_types import (
+    OrderedAttribDict, SpectralParameter, SpectralParametersView,
+    StationParameters, StationParametersDict, StationParametersTable,
+    SummaryStatistics, SummarySpectralParameter, SourceSpecOutput)
+from sourcespec.ssp_event import (
+    SSPEvent, SSPHypocenter, SSPCoordinate, SSPDepth, SSPMagnitude,
+    SSPScalarMoment, SSPFocalMechanism, SSPMomentTensor)
+from sourcespec.ssp_grid_sampling import GridSampling
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
+
+# Version of the plot data file format. Increase it when the content of
+# the file entries changes
+PLOTDATA_FORMAT_VERSION = 2
+
+# Rendering jobs submitted to the worker pool: (future, job name) tuples,
+# in submission order
+_JOBS = []
+# Worker pool, created at the first submitted job
+EXECUTOR = None
+
+# Classes which can be saved to plot data files: mappings are rebuilt from
+# their items, traces from their header and arrays, other objects from
+# their attributes
+_MAPPING_CLASSES = {
+    cls.__name__: cls for cls in (
+        dict, AttribDict, OrderedAttribDict, SpectralParameter,
+        StationParameters, StationParametersDict, SummaryStatistics,
+        SummarySpectralParameter, SourceSpecOutput)
+}
+_TRACE_CLASSES = {cls.__name__: cls for cls in (Trace, Spectrum)}
+_OBJECT_CLASSES = {
+    cls.__name__: cls for cls in (
+        Namespace, SSPEvent, SSPHypocenter, SSPCoordinate, SSPDepth,
+        SSPMagnitude, SSPScalarMoment, SSPFocalMechanism, SSPMomentTensor)
+}
+# Mapping values which are not saved, since they are rebuilt together with
+# the mapping
+_REBUILT_VALUES = (SpectralParametersView, StationParametersTable)
+# Trace header fields which are not used for plotting
+_SKIPPED_STATS = ('endtime', 'event', 'inventory', 'picks')
+# Config values which are not saved
+_SKIPPED_CONFIG = ('figures', )
+
+
+class _PlotDataWriter():
+    """
+    Store plotting jobs for deferred rendering.
+
+    Plotting inputs are encoded, at submission time, as JSON-compatible
+    values, where arrays are replaced by references to plain arrays, which
+    are stored once (by content).
+    """
+
+    def __init__(self):
+        self.arrays = {}
+        self.configs = []
+        self.jobs = []
+
+    def clear(self):
+        """Remove all the stored jobs."""
+        self.__init__()
+
+    def array(self, array):
+        """Store an array and return a reference to it."""
+        array = np.asarray(array)
+        if array.dtype.hasobject:
+            raise TypeError('object arrays cannot be saved')
+        hasher = hashlib.sha1()
+        hasher.update(f'{array.dtype.str}{array.shape}'.encode())
+        hasher.update(np.ascontiguousarray(array).tobytes())
+        name = f'array_{hasher.hexdigest()}'
+        if name not in self.arrays:
+            self.arrays[name] = array.copy()
+        return {'__array__': name}
+
+    def _encode_trace(self, trace):
+        """Encode a trace (or a spectrum) as its header and arrays."""
+        stats = {}
+        for key, value in trace.stats.items():
+            if key in _SKIPPED_STATS:
+                continue
+            try:
+                stats[key] = self.encode(value)
+            except TypeError:
+                # header fields which are not plain data are not saved
+                continue
+        arrays = {
+            name: self.array(value) for name, value in vars(trace).items()
+            if isinstance(value, np.ndarray)
+        }
+        return {
+            '__trace__': type(trace).__name__, 'stats': stats,
+            'arrays': arrays}
+
+    def encode(self, value):
+        """
+        Encode a value as a JSON-compatible value.
+
+        :raises TypeError: if the value cannot be saved
+        """
+        # pylint: disable=too-many-return-statements
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return value
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.ndarray):
+            return self.array(value)
+        if isinstance(value, UTCDateTime):
+            return {'__utcdatetime__': value.ns}
+        if isinstance(value, datetime):
+            return {'__datetime__': value.isoformat()}
+        if isinstance(value, tuple):
+            return {'__tuple__': [self.encode(v) for v in value]}
+        if isinstance(value, list):
+            return [self.encode(v) for v in value]
+        if isinstance(value, Stream):
+            return {'__stream__': [self._encode_trace(tr) for tr in value]}
+        if type(value).__name__ in _TRACE_CLASSES:
+            return self._encode_trace(value)
+        if isinstance(value, GridSampling):
+            return {'__grid__': {
+                name: self.array(array)
+                for name, array in value.to_arrays().items()}}
+        class_name = type(value).__name__
+        if class_name in _MAPPING_CLASSES:
+            return {'__mapping__': class_name, 'items': [
+                [self.encode(key), self.encode(val)]
+                for key, val in value.items()
+                if not isinstance(val, _REBUILT_VALUES)]}
+        if class_name in _OBJECT_CLASSES:
+            return {'__object__': class_name, 'attributes': {
+                key: self.encode(val) for key, val in vars(value).items()}}
+        raise TypeError(f'{class_name} objects cannot be saved')
+
+    def _encode_config(self, config):
+        """Encode a config and return its index in the saved configs."""
+        values = {}
+        for key, value in config.items():
+            if key in _SKIPPED_CONFIG:
+                continue
+            try:
+                values[key] = self.encode(value)
+            except TypeError as err:
+                logger.warning(f'Config value "{key}" not saved: {err}')
+        encoded = json.dumps(values, sort_keys=True)
+        # configs are generally the same for all the jobs
+        with contextlib.suppress(ValueError):
+            return self.configs.index(encoded)
+        self.configs.append(encoded)
+        return len(self.configs) - 1
+
+    def _encode_call(self, func, args, kwargs):
+        """Encode a plotting call."""
+        if isinstance(func, str):
+            call = {'func': func}
+        elif inspect.ismethod(func):
+            call = {'object': self.encode(func.__self__),
+                    'method': func.__name__}
+        else:
+            call = {'func': f'{func.__module__}.{func.__qualname__}'}
+        call['args'] = self.encode(list(args))
+        call['kwargs'] = self.encode(dict(kwargs))
+        return call
+
+    def add_job(self, config, calls):
+        """Store a job: a config and a sequence of plotting calls."""
+        self.jobs.append({
+            'config': self._encode_config(config),
+            'calls': [self._encode_call(*call) for call in calls],
+        })
+
+    def html_report(self, config, sspec_output):
+        """Return the encoded data for the HTML report."""
+        return {
+            'config': self._encode_config(config),
+            'sspec_output': self.encode(sspec_output),
+        }
+
+
+class _PlotDataReader():
+    """Rebuild plotting jobs from a plot data file."""
+
+    def __init__(self, plotdata):
+        self.plotdata = plotdata
+        self.configs = _read_json_entry(plotdata, 'configs')
+        self.jobs = _read_json_entry(plotdata, 'jobs')
+
+    @staticmethod
+    def _new_mapping(cls):
+        """Return an empty mapping of the given class."""
+        if cls in (
+                SpectralParameter, StationParameters, StationParametersDict,
+                SummaryStatistics, SummarySpectralParameter):
+            # all the items are restored afterwards
+            return cls(None)
+        return cls()
+
+    def _decode_trace(self, value):
+        """Rebuild a trace (or a spectrum)."""
+        cls = _TRACE_CLASSES[value['__trace__']]
+        arrays = {
+            name: self.decode(ref) for name, ref in value['arrays'].items()}
+        header = {
+            key: self.decode(val) for key, val in value['stats'].items()}
+        trace = cls(data=arrays.pop('data'), header=header)
+        for name, array in arrays.items():
+            setattr(trace, name, array)
+        return trace
+
+    def _decode_mapping(self, value):
+        """Rebuild a mapping from its items."""
+        cls = _MAPPING_CLASSES[value['__mapping__']]
+        mapping = self._new_mapping(cls)
+        for key, val in value['items']:
+            key = self.decode(key)
+            val = self.decode(val)
+            if cls is SourceSpecOutput and key == 'station_parameters':
+                # stations must be added to the station parameters table
+                for station_id, station_parameters in val.items():
+                    mapping.station_parameters[station_id] =\
+                        station_parameters
+                continue
+            mapping[key] = val
+        return mapping
+
+    def decode(self, value):
+        """Decode a value encoded by _PlotDataWriter.encode()."""
+        # pylint: disable=too-many-return-statements
+        if isinstance(value, list):
+            return [self.decode(v) for v in value]
+        if not isinstance(value, dict):
+            return value
+        if '__array__' in value:
+            return self.plotdata[value['__array__']]
+        if '__utcdatetime__' in value:
+            return UTCDateTime(ns=value['__utcdatetime__'])
+        if '__datetime__' in value:
+            return datetime.fromisoformat(value['__datetime__'])
+        if '__tuple__' in value:
+            return tuple(self.decode(v) for v in value['__tuple__'])
+        if '__stream__' in value:
+            return Stream(
+                [self._decode_trace(tr) for tr in value['__stream__']])
+        if '__trace__' in value:
+            return self._decode_trace(value)
+        if '__grid__' in value:
+            return GridSampling.from_arrays({
+                name: self.decode(ref)
+                for name, ref in value['__grid__'].items()})
+        if '__mapping__' in value:
+            return self._decode_mapping(value)
+        if '__object__' in value:
+            cls = _OBJECT_CLASSES[value['__object__']]
+            obj = cls.__new__(cls)
+            vars(obj).update({
+                key: self.decode(val)
+                for key, val in value['attributes'].items()})
+            return obj
+        raise ValueError(f'Unknown plot data value: {value}')
+
+    def config(self, index):
+        """Rebuild a saved config."""
+        config = Config()
+        for key, value in self.configs[index].items():
+            config[key] = self.decode(value)
+        config.figures = defaultdict(list)
+        return config
+
+    def _decode_call(self, call):
+        """Rebuild a plotting call."""
+        if 'method' in call:
+            func = getattr(self.decode(call['object']), call['method'])
+        else:
+            func = call['func']
+        return func, self.decode(call['args']), self.decode(call['kwargs'])
+
+    def job(self, index):
+        """Rebuild the config and the plotting calls of a job."""
+        job = self.jobs[index]
+        return (
+            self.config(job['config']),
+            [self._decode_call(call) for call in job['calls']])
+
+    def html_report(self):
+        """
+        Rebuild the config and the SourceSpec output for the HTML report.
+        Return None if not available.
+        """
+        if 'html_report' not in self.plotdata.files:
+            return None
+        report = _read_json_entry(self.plotdata, 'html_report')
+        return (
+            self.config(report['config']),
+            self.decode(report['sspec_output']))
+
+
+# Jobs saved for deferred rendering, in submission order
+_DEFERRED = _PlotDataWriter()
+
+
+def _json_entry(value):
+    """Return a JSON-encoded value, as a byte array."""
+    return np.frombuffer(json.dumps(value).encode('utf-8'), dtype=np.uint8)
+
+
+def _read_json_entry(plotdata, name):
+    """Read a JSON-encoded entry of a plot data file."""
+    return json.loads(plotdata[name].tobytes().decode('utf-8'))
+
+
+class _RecordCollector(logging.Handler):
+    """Store log records, so that they can be sent to the main process."""
+
+    def __init__(self):
+        super().__init__(level=logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        # make the record picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+_COLLECTOR = _RecordCollector()
+
+
+def _use_agg_backend():
+    """Use the non-interactive Agg backend."""
+    # pylint: disable=import-outside-toplevel
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+
+def _init_worker():
+    """Use a non-interactive backend and collect log records."""
+    _use_agg_backend()
+    logger_root = logging.getLogger()
+    for hdlr in logger_root.handlers[:]:
+        logger_root.removeHandler(hdlr)
+    logger_root.addHandler(_COLLECTOR)
+    logger_root.setLevel(logging.DEBUG)
+
+
+def _resolve(func):
+    """Return the function object, if func is a 'module.function' name."""
+    if not isinstance(func, str):
+        return func
+    module_name, func_name = func.rsplit('.', maxsplit=1)
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def _job_name(calls):
+    """Return the names of the plotting functions of a job."""
+    return ', '.join(
+        func.rsplit('.', maxsplit=1)[-1] if isinstance(func, str)
+        else getattr(func, '__name__', str(func))
+        for func, _, _ in calls)
+
+
+def _render(job):
+    """
+    Render a pickled job.
+
+    Return the figures added to ``config.figures`` and the log records
+    (only when running in a worker process). If rendering fails, the log
+    records are attached to the exception (``records`` attribute).
+    """
+    config, calls = pickle.loads(job)
+    return _run_calls(config, calls)
+
+
+def _render_saved(plotdata_file, index, outdir):
+    """
+    Render a job saved to a plot data file.
+
+    Return values are the same as for :func:`_render()`.
+    """
+    with np.load(plotdata_file, allow_pickle=False) as plotdata:
+        config, calls = _PlotDataReader(plotdata).job(index)
+    config.options.outdir = outdir
+    return _run_calls(config, calls)
+
+
+def _run_calls(config, calls):
+    """Run the plotting calls of a job. See :func:`_render()`."""
+    config.figures = defaultdict(list)
+    _COLLECTOR.records = []
+    try:
+        for func, args, kwargs in calls:
+            _resolve(func)(config, *args, **kwargs)
+        flush_figures()
+    except Exception as err:
+        err.records = _COLLECTOR.records
+        raise
+    return dict(config.figures), _COLLECTOR.records
+
+
+def _merge_figures(figures, job_figures):
+    """Add the figure file names of a job to figures."""
+    for key, figfiles in job_figures.items():
+        figures[key] += figfiles
+
+
+def _emit_records(records):
+    """Re-emit log records from a worker process."""
+    for record in records:
+        logging.getLogger(record.name).handle(record)
+
+
+def _collect_results(jobs, figures):
+    """
+    Wait for rendering jobs, re-emit their log messages and add their
+    figure file names to figures, in job order.
+
+    All the jobs are waited for; then, the exception of the first failed
+    job, if any, is raised.
+    """
+    errors = []
+    for future, name in jobs:
+        try:
+            job_figures, records = future.result()
+        except Exception as err:
+            _emit_records(getattr(err, 'records', []))
+            logger.error(f'Unable to render figure ({name}): {err}')
+            errors.append(err)
+            continue
+        _emit_records(records)
+        _merge_figures(figures, job_figures)
+    if errors:
+        raise errors[0]
+
+
+def _n_jobs(config):
+    """Return the number of parallel rendering jobs."""
+    return config.plot_jobs or os.cpu_count() or 1
+
+
+def _get_executor(config):
+    """Return the worker pool, creating it at the first call."""
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor
+    # pylint: disable=global-statement
+    global EXECUTOR
+    if EXECUTOR is None:
+        n_jobs = _n_jobs(config)
+        logger.info(f'Rendering figures on {n_jobs} parallel job(s)')
+        EXECUTOR = ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_init_worker)
+    return EXECUTOR
+
+
+def _deferred_config(config):
+    """
+    Return a copy of config for deferred rendering, where figures are saved
+    and not shown.
+    """
+    job_config = Config(config)
+    job_config.plot_deferred = False
+    job_config.plot_show = False
+    job_config.plot_save = True
+    job_config.figures = defaultdict(list)
+    return job_config
+
+
+def submit_plot(config, func, *args, **kwargs):
+    """
+    Render a figure by calling ``func(config, *args, **kwargs)``.
+
+    If figures are saved to disk and not shown, and more than one rendering
+    job is allowed, the call is rendered in a worker process; otherwise it is
+    run immediately.
+    Arguments are pickled at submission time, so later changes to them do
+    not affect the figure.
+    Call :func:`wait_plots()` to wait for all the figures to be written.
+
+    If ``config.plot_deferred`` is set, the call is only stored, to be
+    saved by :func:`save_plot_data()`. Arguments are then encoded at
+    submission time as plain arrays and JSON-compatible values: they must
+    be numbers, strings, arrays, streams, misfit grids or SourceSpec data
+    types (see :class:`_PlotDataWriter`).
+
+    :param config: Config object
+    :type config: :class:`~sourcespec.config.Config`
+    :param func: Plotting function or method, taking ``config`` as first
+        argument, or name of a plotting function (``'module.function'``)
+    :type func: callable or str
+    """
+    submit_plots(config, [(func, args, kwargs)])
+
+
+def submit_plots(config, calls):
+    """
+    Render a sequence of figures in the same job.
+
+    Use this for plotting calls sharing module-level state (e.g., the
+    bounding box of the spectral plots, which is computed for the first
+    plot and reused for the following ones).
+
+    :param config: Config object
+    :type config: :class:`~sourcespec.config.Config`
+    :param calls: Sequence of ``(func, args, kwargs)`` tuples, see
+        :func:`submit_plot()`
+    :type calls: list
+    """
+    if config.plot_deferred:
+        _DEFERRED.add_job(_deferred_config(config), calls)
+        return
+    if config.plot_show or not config.plot_save or _n_jobs(config) == 1:
+        for func, args, kwargs in calls:
+            _resolve(func)(config, *args, **kwargs)
+        return
+    job = pickle.dumps((config, calls), protocol=pickle.HIGHEST_PROTOCOL)
+    future = _get_executor(config).submit(_render, job)
+    _JOBS.append((future, _job_name(calls)))
+
+
+def wait_plots(config):
+    """
+    Wait for all the submitted figures to be written.
+
+    Log messages from the workers are re-emitted and figure file names are
+    added to ``config.figures``, in submission order. Figures rendered in
+    the main process are flushed to disk.
+    If a figure could not be rendered, its exception is raised once all
+    the other figures are written, as for serial rendering.
+
+    :param config: Config object
+    :type config: :class:`~sourcespec.config.Config`
+    """
+    # pylint: disable=global-statement
+    global EXECUTOR
+    try:
+        if EXECUTOR is not None:
+            try:
+                _collect_results(_JOBS, config.figures)
+            finally:
+                _JOBS.clear()
+                EXECUTOR.shutdown()
+                EXECUTOR = None
+    finally:
+        flush_figures()
+
+
+def _plotdata_info(evid):
+    """Return the version stamp of a plot data file."""
+    return {
+        'format_version': PLOTDATA_FORMAT_VERSION,
+        'sourcespec_version': get_versions()['version'],
+        'evid': evid,
+    }
+
+
+def _check_plotdata_info(plotdata, plotdata_file):
+    """
+    Check that a plot data file has the format read by this SourceSpec
+    version.
+
+    :raises ValueError: if the file is not stamped or if it has another
+        format
+    """
+    if 'info' not in plotdata.files:
+        raise ValueError(
+            f'{plotdata_file}: no version information found. '
+            'Re-run source_spec to produce a new plot data file')
+    info = _read_json_entry(plotdata, 'info')
+    if info.get('format_version') != PLOTDATA_FORMAT_VERSION:
+        raise ValueError(
+            f'{plotdata_file}: saved by SourceSpec '
+            f'{info.get("sourcespec_version")} (plot data format '
+            f'{info.get("format_version")}), but this SourceSpec version '
+            f'reads plot data format {PLOTDATA_FORMAT_VERSION}. '
+            'Re-run source_spec to produce a new plot data file')
+
+
+def save_plot_data(config, sspec_output):
+    """
+    Save the plot data for deferred rendering.
+
+    The file ``EVID.plotdata.npz`` contains the following entries:
+
+    - ``info``: SourceSpec version and plot data format version, which is
+      checked by :func:`render_plot_data()`
+    - ``configs``: the configs used by the rendering jobs
+    - ``jobs``: the plotting calls of each rendering job
+    - ``html_report``: the data needed for the HTML report (only if
+      ``config.html_report`` is set)
+    - ``array_*``: plain arrays (trace snippets, spectra, weights and fits,
+      misfit grids, station parameters and geometry), referenced by the
+      entries above
+
+    All the entries, except arrays, are JSON documents stored as byte
+    arrays. No entry is pickled.
+
+    :param config: Config object
+    :type config: :class:`~sourcespec.config.Config`
+    :param sspec_output: Output of the spectral inversion
+    :type sspec_output: :class:`~sourcespec.ssp_data_types.SourceSpecOutput`
+    """
+    evid = config.event.event_id
+    plotdata_file = os.path.join(
+        config.options.outdir, f'{evid}.plotdata.npz')
+    entries = {'info': _json_entry(_plotdata_info(evid))}
+    if config.html_report:
+        entries['html_report'] = _json_entry(
+            _DEFERRED.html_report(_deferred_config(config), sspec_output))
+    entries['configs'] = _json_entry(
+        [json.loads(encoded) for encoded in _DEFERRED.configs])
+    entries['jobs'] = _json_entry(_DEFERRED.jobs)
+    entries.update(_DEFERRED.arrays)
+    np.savez_compressed(plotdata_file, **entries)
+    _DEFERRED.clear()
+    logger.info(f'Plot data saved to: {plotdata_file}')
+
+
+def render_plot_data(plotdata_file, outdir=None, n_jobs=None,
+                     html_report=True):
+    """
+    Render figures and HTML report from a plot data file.
+
+    :param plotdata_file: Plot data file (``EVID.plotdata.npz``)
+    :type plotdata_file: str
+    :param outdir: Output directory. Default is the directory of the plot
+        data file
+    :type outdir: str
+    :param n_jobs: Number of parallel rendering jobs. Default is the number
+        of CPUs
+    :type n_jobs: int
+    :param html_report: Produce the HTML report, if its data is available
+    :type html_report: bool
+    :raises ValueError: if the plot data file has another format
+    """
+    # pylint: disable=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor
+    if outdir is None:
+        outdir = os.path.dirname(os.path.abspath(plotdata_file))
+    with np.load(plotdata_file, allow_pickle=False) as plotdata:
+        _check_plotdata_info(plotdata, plotdata_file)
+        n_saved_jobs = len(_read_json_entry(plotdata, 'jobs'))
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    figures = defaultdict(list)
+    n_jobs = min(n_jobs or os.cpu_count() or 1, n_saved_jobs)
+    if n_jobs <= 1:
+        _use_agg_backend()
+        errors = []
+        for n in range(n_saved_jobs):
+            try:
+                job_figures, _ = _render_saved(plotdata_file, n, outdir)
+            except Exception as err:
+                logger.error(f'Unable to render figure (job {n}): {err}')
+                errors.append(err)
+                continue
+            _merge_figures(figures, job_figures)
+        if errors:
+            raise errors[0]
+    else:
+        logger.info(f'Rendering figures on {n_jobs} parallel job(s)')
+        with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker) as executor:
+            futures = [
+                (executor.submit(_render_saved, plotdata_file, n, outdir),
+                 f'job {n}')
+                for n in range(n_saved_jobs)
+            ]
+            _collect_results(futures, figures)
+    if not html_report:
+        return
+    with np.load(plotdata_file, allow_pickle=False) as plotdata:
+        report = _PlotDataReader(plotdata).html_report()
+    if report is None:
+        return
+    config, sspec_output = report
+    config.options.outdir = outdir
+    config.figures = figures
+    from sourcespec.ssp_html_report import html_report as write_html_report
+    write_html_report(config, sspec_output)
+
+
+def _parse_arguments():
+    """Parse command line arguments"""
+    # pylint: disable=import-outside-toplevel
+    import argparse
+    description = """\
+Produce figures and HTML report from a plot data file (EVID.plotdata.npz),
+saved by source_spec when the "plot_deferred" config parameter is set.
+Plotting inputs are rebuilt from the plain arrays stored in the file.
+"""
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('plotdata_file', help='Plot data file')
+    parser.add_argument(
+        '-o', '--outdir', default=None,
+        help='Output directory. Default is the directory of the plot '
+        'data file')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='Number of parallel rendering jobs. Default is the number of '
+        'CPUs')
+    parser.add_argument(
+        '--no_report', action='store_true', default=False,
+        help='Do not produce the HTML report')
+    return parser.parse_args()
+
+
+def _command_line_interface():
+    """Command line interface"""
+    args = _parse_arguments()
+    if not os.path.exists(args.plotdata_file):
+        raise FileNotFoundError(f'File not found: {args.plotdata_file}')
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    render_plot_data(
+        args.plotdata_file, args.outdir, args.jobs, not args.no_report)
+
+
+def main():
+    """Main function"""
+    # pylint: disable=import-outside-toplevel
+    import sys
+    try:
+        _command_line_interface()
+    except Exception as msg:
+        sys.exit(msg)
+    except KeyboardInterrupt:
+        sys.exit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+# -*- coding: utf8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Read and write residual spectra in a memory-mapped binary store.
+
+Station residuals (EVID-residuals.sspres) and mean station residuals used
+for station correction (residual_mean.sspres) are stored in a single binary
+file, made of:
+
+- an 8-byte magic string (``SSPRES01``);
+- the header length, as a little-endian unsigned 64-bit integer;
+- a JSON header, indexing the spectra: id, first frequency, frequency step,
+  number of points, hypocentral distance (if known) and, for each column
+  (e.g., ``data_mag``), the offset of its values in the data section;
+- the data section, with all the values as little-endian 64-bit floats,
+  aligned to 64 bytes.
+
+The data section is memory-mapped at the first access, so that only the
+spectra actually requested are read from disk.
+
+Residual files in the legacy pickle format can still be read and can be
+converted with :func:`convert_residuals_pickle()`.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import os
+import json
+import struct
+import logging
+import numpy as np
+from sourcespec.spectrum import Spectrum
+from sourcespec.ssp_util import moment_to_mag, mag_to_moment
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
+
+RESIDUAL_STORE_MAGIC = b'SSPRES01'
+RESIDUAL_STORE_EXTENSION = '.sspres'
+# Optional columns, stored when the corresponding spectrum attribute exists
+# (e.g., for mean residuals computed by source_residuals)
+OPTIONAL_COLUMNS = ('data_mag_std', 'data_mag_count')
+_DTYPE = np.dtype('<f8')
+_ALIGNMENT = 64
+
+
+def is_residual_store(filename):
+    """Check if a file is a residual store (and not a legacy pickle)."""
+    with open(filename, 'rb') as fp:
+        return fp.read(len(RESIDUAL_STORE_MAGIC)) == RESIDUAL_STORE_MAGIC
+
+
+def _spectrum_columns(spec):
+    """Return the columns to be stored for a spectrum."""
+    data_mag = getattr(spec, 'data_mag', None)
+    if data_mag is None or len(data_mag) != len(spec.data):
+        data_mag = moment_to_mag(spec.data)
+    columns = {'data_mag': data_mag}
+    for column in OPTIONAL_COLUMNS:
+        values = getattr(spec, column, None)
+        if values is not None:
+            columns[column] = values
+    return columns
+
+
+def _pack_spectra(spectra):
+    """
+    Return the header entries and the column arrays for a list of spectra.
+    """
+    entries = []
+    arrays = []
+    nitems = 0
+    for spec in spectra:
+        entry = {
+            'id': spec.id,
+            'begin': float(spec.stats.begin),
+            'delta': float(spec.stats.delta),
+            'npts': len(spec.data),
+            'columns': {}
+        }
+        hypo_dist = spec.stats.get('hypo_dist')
+        if hypo_dist is not None:
+            entry['hypo_dist'] = float(hypo_dist)
+        for column, values in _spectrum_columns(spec).items():
+            values = np.asarray(values, dtype=_DTYPE)
+            if len(values) != entry['npts']:
+                raise ValueError(
+                    f'{spec.id}: "{column}" has {len(values)} points '
+                    f'instead of {entry["npts"]}')
+            entry['columns'][column] = nitems
+            arrays.append(values)
+            nitems += len(values)
+        entries.append(entry)
+    return entries, arrays, nitems
+
+
+def write_residual_store(spectra, filename, metadata=None):
+    """
+    Write residual spectra to a residual store.
+
+    :param spectra: Residual spectra (``data_mag`` is used, if available)
+    :type spectra: iterable of :class:`~sourcespec.spectrum.Spectrum`
+    :param filename: Output file name
+    :type filename: str
+    :param metadata: Optional metadata (must be JSON serializable)
+    :type metadata: dict
+    """
+    entries, arrays, nitems = _pack_spectra(spectra)
+    header = {
+        'version': 1,
+        'dtype': _DTYPE.str,
+        'nitems': nitems,
+        'metadata': metadata or {},
+        'spectra': entries
+    }
+    header = json.dumps(header).encode('utf8')
+    # pad the header, so that the data section is aligned
+    prefix_len = len(RESIDUAL_STORE_MAGIC) + 8
+    padding = -(prefix_len + len(header)) % _ALIGNMENT
+    header += b' ' * padding
+    with open(filename, 'wb') as fp:
+        fp.write(RESIDUAL_STORE_MAGIC)
+        fp.write(struct.pack('<Q', len(header)))
+        fp.write(header)
+        for values in arrays:
+            fp.write(values.tobytes())
+
+
+class ResidualStore():
+    """
+    A collection of residual spectra, indexed by spectrum id.
+
+    Use :func:`open_residual_store()` to open a residual file.
+    Spectra are built only when requested, with :meth:`get()` or by
+    iterating over the store.
+    """
+
+    def __init__(self, entries, data, filename=None, metadata=None):
+        self.filename = filename
+        self.metadata = metadata or {}
+        self._entries = entries
+        self._index = {}
+        for n, entry in enumerate(entries):
+            self._index.setdefault(entry['id'], n)
+        # data is either an array or a callable returning an array
+        self._data = data
+
+    @classmethod
+    def from_file(cls, filename):
+        """Open a residual store file. The data section is not read."""
+        with open(filename, 'rb') as fp:
+            magic = fp.read(len(RESIDUAL_STORE_MAGIC))
+            if magic != RESIDUAL_STORE_MAGIC:
+                raise ValueError(f'{filename}: not a residual store file')
+            header_len, = struct.unpack('<Q', fp.read(8))
+            header = json.loads(fp.read(header_len).decode('utf8'))
+        if header['version'] != 1:
+            raise ValueError(
+                f'{filename}: unsupported residual store version: '
+                f'{header["version"]}')
+        offset = len(RESIDUAL_STORE_MAGIC) + 8 + header_len
+        nitems = header['nitems']
+
+        def _memmap():
+            if nitems == 0:
+                return np.empty(0, dtype=_DTYPE)
+            return np.memmap(
+                filename, dtype=header['dtype'], mode='r', offset=offset,
+                shape=(nitems, ))
+        return cls(header['spectra'], _memmap, filename, header['metadata'])
+
+    @classmethod
+    def from_spectra(cls, spectra, metadata=None):
+        """Build an in-memory residual store from residual spectra."""
+        entries, arrays, _nitems = _pack_spectra(spectra)
+        data = (
+            np.concatenate(arrays) if arrays else np.empty(0, dtype=_DTYPE))
+        return cls(entries, data, metadata=metadata)
+
+    @property
+    def data(self):
+        """The data section (memory-mapped at the first access)."""
+        if callable(self._data):
+            self._data = self._data()
+        return self._data
+
+    @property
+    def ids(self):
+        """Spectrum ids, in file order."""
+        return [entry['id'] for entry in self._entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, spec_id):
+        return spec_id in self._index
+
+    def __iter__(self):
+        for entry in self._entries:
+            yield self._build_spectrum(entry)
+
+    def column(self, spec_id, column='data_mag'):
+        """
+        Return the values of a column for a spectrum, as a read-only view
+        on the data section.
+        """
+        entry = self._entries[self._index[spec_id]]
+        return self._column(entry, column)
+
+    def _column(self, entry, column):
+        start = entry['columns'][column]
+        return self.data[start:start + entry['npts']]
+
+    def frequency_sampling(self, spec_id):
+        """Return first frequency, frequency step and number of points."""
+        entry = self._entries[self._index[spec_id]]
+        return entry['begin'], entry['delta'], entry['npts']
+
+    def hypo_dist(self, spec_id):
+        """Return the hypocentral distance (km) for spec_id, or None."""
+        return self._entries[self._index[spec_id]].get('hypo_dist')
+
+    def get(self, spec_id):
+        """Return the residual spectrum for spec_id, or None."""
+        try:
+            entry = self._entries[self._index[spec_id]]
+        except KeyError:
+            return None
+        return self._build_spectrum(entry)
+
+    def _build_spectrum(self, entry):
+        spec = Spectrum()
+        spec.id = entry['id']
+        spec.stats.begin = entry['begin']
+        spec.stats.delta = entry['delta']
+        if 'hypo_dist' in entry:
+            spec.stats.hypo_dist = entry['hypo_dist']
+        spec.data_mag = np.array(self._column(entry, 'data_mag'))
+        spec.data = mag_to_moment(spec.data_mag)
+        for column in OPTIONAL_COLUMNS:
+            if column in entry['columns']:
+                setattr(
+                    spec, column, np.array(self._column(entry, column)))
+        if 'data_mag_count' in entry['columns']:
+            spec.data_mag_count = spec.data_mag_count.astype(int)
+        return spec
+
+
+def _read_residuals_pickle(filename):
+    """Read a residual file in the legacy pickle format."""
+    # pylint: disable=import-outside-toplevel
+    import pickle
+    with open(filename, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def open_residual_store(filename, warn_legacy=True):
+    """
+    Open a residual file.
+
+    Files in the legacy pickle format are fully read and converted in memory.
+
+    :param filename: Residual file name
+    :type filename: str
+    :param warn_legacy: Log a warning for files in the legacy pickle format
+    :type warn_legacy: bool
+    :return: The residual store
+    :rtype: :class:`ResidualStore`
+    """
+    if is_residual_store(filename):
+        return ResidualStore.from_file(filename)
+    if warn_legacy:
+        logger.warning(
+            f'{filename}: legacy pickle format. Use '
+            '"source_residuals --convert" to convert it.')
+    return ResidualStore.from_spectra(_read_residuals_pickle(filename))
+
+
+def convert_residuals_pickle(pickle_file, store_file=None):
+    """
+    Convert a residual file from the legacy pickle format.
+
+    :param pickle_file: Residual file in pickle format
+    :type pickle_file: str
+    :param store_file: Output file name. Default is the input file name,
+        with the ``.sspres`` extension
+    :type store_file: str
+    :return: The output file name
+    :rtype: str
+    """
+    if store_file is None:
+        store_file = os.path.splitext(pickle_file)[0] + \
+            RESIDUAL_STORE_EXTENSION
+    write_residual_store(_read_residuals_pickle(pickle_file), store_file)
+    return store_file
@@ -14,10 +14,11 @@ Spectral residual routine for sourcespec.
 """
 import os
 import logging
-import pickle
 from obspy.core import Stream
 from sourcespec.ssp_spectral_model import spectral_model
 from sourcespec.ssp_util import mag_to_moment
+from sourcespec.ssp_residual_store import (
+    write_residual_store, RESIDUAL_STORE_EXTENSION)
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 
 
@@ -25,7 +26,8 @@ def spectral_residuals(config, spec_st, sspec_output):
     """
     Compute spectral residuals with respect to an average spectral model.
 
-    Saves a stream of residuals to disk using pickle.
+    Saves residuals to disk as a residual store
+    (see :mod:`sourcespec.ssp_residual_store`).
     """
     # get reference summary values
     summary_values = sspec_output.reference_values()
@@ -46,9 +48,9 @@ def spectral_residuals(config, spec_st, sspec_output):
             res.data = mag_to_moment(res.data_mag)
             residuals.append(res)
 
-    # Save residuals as pickle file
+    # Save residuals to a residual store file
     evid = config.event.event_id
-    res_file = os.path.join(config.options.outdir, f'{evid}-residuals.pickle')
-    with open(res_file, 'wb') as fp:
-        pickle.dump(residuals, fp)
+    res_file = os.path.join(
+        config.options.outdir, f'{evid}-residuals{RESIDUAL_STORE_EXTENSION}')
+    write_residual_store(residuals, res_file, metadata={'evid': evid})
     logger.info(f'Spectral residuals saved to: {res_file}')
@@ -30,7 +30,7 @@ from datetime import datetime
 from collections import defaultdict
 from sourcespec import __version__, __banner__
 from sourcespec.configobj import ConfigObj
-from sourcespec.configobj.validate import Validator
+from sourcespec.configobj.validate import Validator, ValidateError
 from sourcespec.config import Config
 from sourcespec.ssp_update_db import update_db_file
 
@@ -748,6 +748,8 @@ def configure(options, progname, config_overrides=None):
     # Fix and expand paths in config
     if config.database_file:
         config.database_file = _fix_and_expand_path(config.database_file)
+    if config.cache_dir:
+        config.cache_dir = _fix_and_expand_path(config.cache_dir)
     if config.traceid_mapping_file:
         config.traceid_mapping_file = _fix_and_expand_path(
             config.traceid_mapping_file)
@@ -756,6 +758,9 @@ def configure(options, progname, config_overrides=None):
     if config.residuals_filepath:
         config.residuals_filepath = _fix_and_expand_path(
             config.residuals_filepath)
+    if config.clipping_skip_list:
+        config.clipping_skip_list = _fix_and_expand_path(
+            config.clipping_skip_list)
 
     # Parse force_list options into lists of float
     try:
@@ -820,7 +825,8 @@ def configure(options, progname, config_overrides=None):
 
     _init_instrument_codes(config)
     _init_traceid_map(config.traceid_mapping_file)
-    _init_plotting(config.plot_show)
+    if not config.plot_deferred:
+        _init_plotting(config.plot_show)
     # Create a dict to store figure paths
     config.figures = defaultdict(list)
     # store the absolute path of the current working directory
@@ -828,6 +834,38 @@ def configure(options, progname, config_overrides=None):
     return config
 
 
+def validate_config_values(named_values):
+    """
+    Validate dictionaries of config values against the configspec.
+
+    Values are converted as when they are read from a config file. The
+    configspec is parsed once and all the dictionaries are checked by the
+    same validator.
+
+    :param dict named_values: Dictionaries of config values, by name (the
+        name is used in error messages)
+    :return: Validated dictionaries of config values, by name
+    :rtype: dict
+    :raises ValueError: if a parameter is unknown or a value is invalid
+    """
+    configspec = _parse_configspec()
+    val = Validator()
+    validated = {}
+    for name, values in named_values.items():
+        validated[name] = {}
+        for key, value in values.items():
+            if key not in configspec:
+                raise ValueError(f'{name}: unknown parameter "{key}"')
+            if value == 'None':
+                value = None
+            try:
+                validated[name][key] = val.check(configspec[key], value)
+            except ValidateError as err:
+                raise ValueError(
+                    f'{name}: invalid value for "{key}": "{value}"') from err
+    return validated
+
+
 def save_config(config):
     """Save config file to output dir."""
     # Actually, it renames the file already existing.
@@ -840,21 +878,27 @@ def save_config(config):
     os.rename(src, dst)
 
 
-def move_outdir(config):
-    """Move outdir to a new dir named from evid (and optional run_id)."""
-    try:
-        evid = config.event.event_id
-    except Exception:
-        return
-    src = config.options.outdir
+def event_outdir(config):
+    """Return the outdir named from evid (and optional run_id)."""
+    evid = config.event.event_id
     run_id = config.options.run_id
     run_id_subdir = config.options.run_id_subdir
-    dst = os.path.split(src)[0]
+    dst = os.path.split(config.options.outdir)[0]
     dst = os.path.join(dst, str(evid))
     if run_id and run_id_subdir:
         dst = os.path.join(dst, str(run_id))
     elif run_id:
         dst += f'_{run_id}'
+    return dst
+
+
+def move_outdir(config):
+    """Move outdir to a new dir named from evid (and optional run_id)."""
+    try:
+        dst = event_outdir(config)
+    except Exception:
+        return
+    src = config.options.outdir
     # Create destination
     if not os.path.exists(dst):
         os.makedirs(dst)
@@ -870,6 +914,11 @@ def move_outdir(config):
     config.options.outdir = dst
 
 
+def remove_outdir(config):
+    """Remove outdir, when the event is not processed."""
+    shutil.rmtree(config.options.outdir, ignore_errors=True)
+
+
 def remove_old_outdir(config):
     """Try to remove the old outdir."""
     try:
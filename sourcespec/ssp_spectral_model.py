@@ -44,7 +44,12 @@ def spectral_model(freq, Mw, fc, t_star, alpha=1.):
 
 
 def objective_func(xdata, ydata, weight):
-    """Objective function generator for bounded inversion."""
+    """
+    Objective function generator for bounded inversion.
+
+    Parameters can be scalars or arrays of shape (n, 1): in the latter case,
+    the objective function returns an array of n values.
+    """
     errsum = np.sum(weight)
 
     def _objective_func(params):
@@ -57,7 +62,7 @@ def objective_func(xdata, ydata, weight):
         res = np.array(ydata) - np.array(model)
         res2 = np.power(res, 2)
         wres = np.array(weight) * np.array(res2)
-        return np.sqrt(np.sum(wres) / errsum)
+        return np.sqrt(np.sum(wres, axis=-1) / errsum)
     return _objective_func
 
 
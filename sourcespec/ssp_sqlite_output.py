@@ -3,22 +3,67 @@
 """
 SQLite output for source_spec.
 
+The database connection is opened once per process and per database file,
+and reused for all the events written by the process. The database uses
+write-ahead logging (WAL), so that readers do not block writers and commits
+are cheaper. Summary tables (see ssp_db_summary) are updated every time an
+event is written.
+
 :copyright:
     2013-2023 Claudio Satriano <satriano@ipgp.fr>
 :license:
     CeCILL Free Software License Agreement v2.1
     (http://www.cecill.info/licences.en.html)
 """
-import os.path
+import os
+import atexit
 import logging
 import sqlite3
 from sourcespec.ssp_setup import ssp_exit
 from sourcespec.ssp_db_definitions import (
     DB_VERSION,
-    STATIONS_TABLE, STATIONS_PRIMARY_KEYS, EVENTS_TABLE, EVENTS_PRIMARY_KEYS)
+    STATIONS_TABLE, STATIONS_PRIMARY_KEYS, STATIONS_INDEXES,
+    EVENTS_TABLE, EVENTS_PRIMARY_KEYS, EVENTS_INDEXES)
+from sourcespec.ssp_db_summary import (
+    create_summary_tables, update_summary_tables)
 from sourcespec._version import get_versions
 logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
 
+# Insert statements, with one placeholder per table column
+SQL_INSERT_INTO_STATIONS = (
+    'INSERT OR REPLACE INTO Stations VALUES('
+    f'{",".join("?" * len(STATIONS_TABLE))});')
+SQL_INSERT_INTO_EVENTS = (
+    'INSERT OR REPLACE INTO Events VALUES('
+    f'{",".join("?" * len(EVENTS_TABLE))});')
+
+# Spectral parameters written to the Stations table (value, uncertainties and
+# outlier flag), in the same order as in STATIONS_TABLE
+STATIONS_SPECTRAL_PARAMETERS = [
+    'Mo', 'Mw', 'fc', 't_star', 'Qo', 'ssd', 'radius', 'Er', 'sigma_a']
+
+# Open database connections, keyed by absolute file path
+_CONNECTIONS = {}
+
+
+def _reset_connections():
+    """Forget the connections of the parent, after a fork."""
+    _CONNECTIONS.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_connections)
+
+
+def close_connections():
+    """Close all the open database connections."""
+    for conn in _CONNECTIONS.values():
+        conn.close()
+    _CONNECTIONS.clear()
+
+
+atexit.register(close_connections)
+
 
 def _db_file_exists(db_file):
     """
@@ -32,17 +77,29 @@ def _db_file_exists(db_file):
     return os.path.isfile(db_file)
 
 
-def _open_sqlite_db(db_file):
+def _open_sqlite_db(db_file, wal=False):
     """
     Open SQLite database.
 
     :param db_file: SQLite database file
     :type db_file: str
+    :param wal: Switch the database to write-ahead logging (WAL)
+    :type wal: bool
     :return: SQLite connection and cursor
     :rtype: tuple
     """
     try:
         conn = sqlite3.connect(db_file, timeout=60)
+        # WAL is persistent: it is enabled once for the database file.
+        # Note that it requires all the processes accessing the database to
+        # be on the same host (it does not work on network file systems).
+        if wal:
+            conn.execute('PRAGMA journal_mode = WAL')
+        journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        if journal_mode.lower() == 'wal':
+            # Safe in WAL mode: the database cannot be corrupted, but the
+            # last transactions can be lost in case of power failure
+            conn.execute('PRAGMA synchronous = NORMAL')
     except Exception as msg:
         logger.error(msg)
         logger.info(
@@ -51,6 +108,42 @@ def _open_sqlite_db(db_file):
     return conn, conn.cursor()
 
 
+def _get_connection(db_file, wal=False):
+    """
+    Return a connection to the SQLite database, opening it at the first call.
+
+    At the first call, database version is checked (or set, for a new
+    database) and tables, indexes and summary tables are created, if needed.
+
+    :param db_file: SQLite database file
+    :type db_file: str
+    :param wal: Use write-ahead logging (WAL), if the database is created
+    :type wal: bool
+    :return: SQLite connection
+    :rtype: sqlite3.Connection
+    """
+    key = os.path.abspath(db_file)
+    if key in _CONNECTIONS:
+        return _CONNECTIONS[key]
+    db_file_exists = _db_file_exists(db_file)
+    # the journal mode of existing databases is not changed, since they
+    # can be on a file system not supporting WAL
+    conn, cursor = _open_sqlite_db(db_file, wal=wal and not db_file_exists)
+    if db_file_exists:
+        _check_db_version(cursor, db_file)
+    else:
+        _set_db_version(cursor)
+    _create_stations_table(cursor, db_file)
+    _create_events_table(cursor, db_file)
+    try:
+        create_summary_tables(cursor)
+    except Exception as db_err:
+        _log_db_write_error(db_err, db_file)
+    conn.commit()
+    _CONNECTIONS[key] = conn
+    return conn
+
+
 def _check_db_version(cursor, db_file):
     """
     Check database version.
@@ -110,9 +203,31 @@ def _log_db_write_error(db_err, db_file):
     ssp_exit(1)
 
 
+def _create_indexes(cursor, db_file, table, indexes):
+    """
+    Create secondary indexes.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param db_file: SQLite database file
+    :type db_file: str
+    :param table: Table name
+    :type table: str
+    :param indexes: Index definitions ({index name: columns})
+    :type indexes: dict
+    """
+    for name, columns in indexes.items():
+        try:
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} '
+                f'ON {table} ({", ".join(columns)});')
+        except Exception as db_err:
+            _log_db_write_error(db_err, db_file)
+
+
 def _create_stations_table(cursor, db_file):
     """
-    Create Stations table.
+    Create Stations table and its indexes.
 
     :param cursor: SQLite cursor
     :type cursor: sqlite3.Cursor
@@ -129,6 +244,7 @@ def _create_stations_table(cursor, db_file):
         cursor.execute(sql_create_stations_table)
     except Exception as db_err:
         _log_db_write_error(db_err, db_file)
+    _create_indexes(cursor, db_file, 'Stations', STATIONS_INDEXES)
 
 
 def _write_stations_table(cursor, db_file, sspec_output, config):
@@ -148,49 +264,39 @@ def _write_stations_table(cursor, db_file, sspec_output, config):
     evid = event.event_id
     runid = config.options.run_id
     stationpar = sspec_output.station_parameters
-    nobs = 0
-    for statId in sorted(stationpar.keys()):
-        nobs += 1
-        par = stationpar[statId]
-        # Insert new line
-        t = (
-            statId, evid, runid,
-            *par.Mo.value_uncertainty(),
-            int(par.Mo.outlier),
-            *par.Mw.value_uncertainty(),
-            int(par.Mw.outlier),
-            *par.fc.value_uncertainty(),
-            int(par.fc.outlier),
-            *par.t_star.value_uncertainty(),
-            int(par.t_star.outlier),
-            *par.Qo.value_uncertainty(),
-            int(par.Qo.outlier),
-            *par.ssd.value_uncertainty(),
-            int(par.ssd.outlier),
-            *par.radius.value_uncertainty(),
-            int(par.radius.outlier),
-            *par.Er.value_uncertainty(),
-            int(par.Er.outlier),
-            *par.sigma_a.value_uncertainty(),
-            int(par.sigma_a.outlier),
-            par.hypo_dist_in_km,
-            par.azimuth
-        )
-        # Create a string like ?,?,?,?
-        values = ','.join('?' * len(t))
-        sql_insert_into_stations =\
-            f'INSERT OR REPLACE INTO Stations VALUES({values});'
-        try:
-            cursor.execute(sql_insert_into_stations, t)
-        except Exception as msg:
-            _log_db_write_error(msg, db_file)
-            ssp_exit(1)
-    return nobs
+    table = sspec_output.station_table
+    order = sorted(
+        range(len(table)), key=lambda n: table.station_ids[n])
+    station_ids = [table.station_ids[n] for n in order]
+    # one column per table field, in the same order as in STATIONS_TABLE
+    columns = [
+        station_ids,
+        [evid] * len(order),
+        [runid] * len(order)
+    ]
+    for param in STATIONS_SPECTRAL_PARAMETERS:
+        columns += [
+            table.column('value', param)[order].tolist(),
+            table.column('lower_uncertainty', param)[order].tolist(),
+            table.column('upper_uncertainty', param)[order].tolist(),
+            table.column('outlier', param)[order].astype(int).tolist(),
+        ]
+    columns += [
+        [stationpar[statId].hypo_dist_in_km for statId in station_ids],
+        [stationpar[statId].azimuth for statId in station_ids]
+    ]
+    rows = list(zip(*columns))
+    try:
+        cursor.executemany(SQL_INSERT_INTO_STATIONS, rows)
+    except Exception as msg:
+        _log_db_write_error(msg, db_file)
+        ssp_exit(1)
+    return len(rows)
 
 
 def _create_events_table(cursor, db_file):
     """
-    Create Events table.
+    Create Events table and its indexes.
 
     :param cursor: SQLite cursor
     :type cursor: sqlite3.Cursor
@@ -207,6 +313,7 @@ def _create_events_table(cursor, db_file):
         cursor.execute(sql_create_events_table)
     except Exception as db_err:
         _log_db_write_error(db_err, db_file)
+    _create_indexes(cursor, db_file, 'Events', EVENTS_INDEXES)
 
 
 def _write_events_table(cursor, db_file, sspec_output, config, nobs):
@@ -377,16 +484,59 @@ def _write_events_table(cursor, db_file, sspec_output, config, nobs):
         config.agency_short_name,
         config.agency_url
     )
-    # Create a string like ?,?,?,?
-    values = ','.join('?' * len(t))
-    sql_insert_into_events = f'INSERT OR REPLACE INTO Events VALUES({values});'
     try:
-        cursor.execute(sql_insert_into_events, t)
+        cursor.execute(SQL_INSERT_INTO_EVENTS, t)
     except Exception as msg:
         _log_db_write_error(msg, db_file)
         ssp_exit(1)
 
 
+def read_station_parameters(config):
+    """
+    Read from database the station parameters of previous runs for the
+    current event.
+
+    For each station, values of the current run id are preferred; otherwise,
+    the most recently written values are returned.
+
+    :param config: SSP configuration object
+    :type config: config.Config
+    :return: A dictionary of (Mw, fc, t_star) tuples, keyed by station id.
+        Empty if the database does not exist or if it contains no values for
+        the current event.
+    :rtype: dict
+    """
+    db_file = config.get('database_file', None)
+    if not db_file or not _db_file_exists(db_file):
+        return {}
+    evid = config.event.event_id
+    runid = config.options.run_id
+    sql_select = (
+        'SELECT stid, runid, Mw, fc, t_star FROM Stations '
+        'WHERE evid = ? ORDER BY rowid'
+    )
+    try:
+        conn = _CONNECTIONS.get(os.path.abspath(db_file))
+        if conn is None:
+            conn = sqlite3.connect(db_file, timeout=60)
+            rows = conn.execute(sql_select, (evid, )).fetchall()
+            conn.close()
+        else:
+            rows = conn.execute(sql_select, (evid, )).fetchall()
+    except sqlite3.Error as msg:
+        logger.warning(
+            f'Unable to read station parameters from "{db_file}": {msg}')
+        return {}
+    station_parameters = {}
+    station_runids = {}
+    for stid, row_runid, Mw, fc, t_star in rows:
+        if station_runids.get(stid) == runid and row_runid != runid:
+            continue
+        station_parameters[stid] = (Mw, fc, t_star)
+        station_runids[stid] = row_runid
+    return station_parameters
+
+
 def write_sqlite(config, sspec_output):
     """
     Write SSP output to SQLite database.
@@ -400,24 +550,17 @@ def write_sqlite(config, sspec_output):
     if not db_file:
         return
 
-    db_file_exists = _db_file_exists(db_file)
-    conn, cursor = _open_sqlite_db(db_file)
-    if db_file_exists:
-        _check_db_version(cursor, db_file)
-    else:
-        _set_db_version(cursor)
-
-    # Create Stations table
-    _create_stations_table(cursor, db_file)
-    # Write station source parameters to database
-    nobs = _write_stations_table(cursor, db_file, sspec_output, config)
-    # Commit changes
-    conn.commit()
-    # Create Events table
-    _create_events_table(cursor, db_file)
-    # Write event source parameters to database
-    _write_events_table(cursor, db_file, sspec_output, config, nobs)
-    # Commit changes and close database
-    conn.commit()
-    conn.close()
+    conn = _get_connection(db_file, wal=config.get('database_wal', True))
+    cursor = conn.cursor()
+    evid = config.event.event_id
+    runid = config.options.run_id
+    # Station and event source parameters, as well as summary tables,
+    # are written in a single transaction
+    with conn:
+        # remove from summary tables the values of a previous run
+        # for the same event and runid, if any
+        update_summary_tables(cursor, evid, runid, sign=-1)
+        nobs = _write_stations_table(cursor, db_file, sspec_output, config)
+        _write_events_table(cursor, db_file, sspec_output, config, nobs)
+        update_summary_tables(cursor, evid, runid)
     logger.info(f'Output written to SQLite database: {db_file}')
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+# SPDX-License-Identifier: CECILL-2.1
+"""
+Parameter sweep for source_spec.
+
+Spectra are built only once. The spectral inversion, the radiated energy and
+the summary statistics are then computed for each set of config overrides
+(a "variant"), in parallel, and the results of all the variants are written
+to a comparison table (CSV and SQLite). No plots nor reports are produced.
+
+The sweep file is a YAML file with two optional sections:
+
+.. code-block:: yaml
+
+    # every combination of the listed values is a variant
+    grid:
+      t_star_0_variability: [0.1, 0.5, 1.0]
+      weighting: [frequency, inv_frequency]
+    # explicit list of named variants
+    variants:
+      narrow_fc:
+        fc_min_max: [1, 20]
+      no_Qo_bounds:
+        Qo_min_max: null
+
+A variant named "base", with no overrides, is always computed first.
+
+Parameters used for reading and processing traces or building spectra
+cannot be swept. The weighting parameters can, since the weights are
+rebuilt from the spectra, with one exception: "noise" weighting also
+changes the trace processing and the spectra (signal window, rejection of
+traces with an empty or too low noise window), so "weighting" can be
+swept only among "noise" (if it is the weighting of the base config) or
+only among the other weighting types.
+
+:copyright:
+    2023 Claudio Satriano <satriano@ipgp.fr>
+:license:
+    CeCILL Free Software License Agreement v2.1
+    (http://www.cecill.info/licences.en.html)
+"""
+import os
+import csv
+import json
+import logging
+import sqlite3
+import itertools
+import contextlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import yaml
+from sourcespec.config import Config
+from sourcespec.ssp_setup import validate_config_values, ssp_exit
+from sourcespec.ssp_cache import STAGE_CONFIG_KEYS
+from sourcespec.ssp_build_spectra import _build_weight_spectral_stream
+from sourcespec.ssp_inversion import spectral_inversion
+from sourcespec.ssp_radiated_energy import radiated_energy_and_apparent_stress
+from sourcespec.ssp_summary_statistics import compute_summary_statistics
+logger = logging.getLogger(__name__.rsplit('.', maxsplit=1)[-1])
+
+# Summary parameters written to the comparison table
+SWEEP_PARAMS = (
+    'Mw', 'Mo', 'fc', 't_star', 'radius', 'ssd', 'Qo', 'Er', 'sigma_a')
+
+# Config parameters used to build the weight spectra: when they are
+# overridden, weights are rebuilt from the (unchanged) spectra.
+# Note: "weighting" cannot be switched from or to "noise", which is also
+# used for processing traces and building spectra
+WEIGHT_CONFIG_KEYS = ('weighting', 'f_weight', 'weight')
+
+# Config values forced for all the variants: no plots, no reports and no
+# local magnitude (which does not depend on the inversion)
+VARIANT_CONFIG = {
+    'plot_show': False,
+    'plot_save': False,
+    'html_report': False,
+    'compute_local_magnitude': False,
+    'plot_deferred': False,
+    'save_misfit_grids': False,
+}
+
+# Spectral streams shared by the variants run by the same process
+_SPECTRA = {}
+
+
+def _is_upstream_key(key):
+    """
+    True if a config parameter is used for reading, processing traces or
+    building spectra, which are done only once for all the variants.
+    """
+    if key in WEIGHT_CONFIG_KEYS:
+        return False
+    for stage_keys in STAGE_CONFIG_KEYS.values():
+        for stage_key in stage_keys:
+            if stage_key.endswith('_') and key.startswith(stage_key):
+                return True
+            if key == stage_key:
+                return True
+    return False
+
+
+def _read_variants(sweep_file):
+    """Read the sweep file and return a list of (name, overrides) tuples."""
+    try:
+        with open(sweep_file, 'r', encoding='utf-8') as fp:
+            sweep = yaml.safe_load(fp) or {}
+    except (OSError, yaml.YAMLError) as msg:
+        raise ValueError(f'Unable to read sweep file: {msg}') from msg
+    if not isinstance(sweep, dict):
+        raise ValueError('Sweep file must contain a "grid" or "variants" map')
+    unknown = set(sweep) - {'grid', 'variants'}
+    if unknown:
+        raise ValueError(f'Unknown sweep file section(s): {sorted(unknown)}')
+    variants = [('base', {})]
+    grid = sweep.get('grid') or {}
+    if not isinstance(grid, dict):
+        raise ValueError('"grid" must be a map of parameter values')
+    keys = list(grid)
+    values = [v if isinstance(v, list) else [v] for v in grid.values()]
+    if keys:
+        for n, combination in enumerate(itertools.product(*values), start=1):
+            variants.append((f'grid_{n:03d}', dict(zip(keys, combination))))
+    named_variants = sweep.get('variants') or {}
+    if not isinstance(named_variants, dict):
+        raise ValueError('"variants" must be a map of named overrides')
+    for name, overrides in named_variants.items():
+        overrides = overrides or {}
+        if not isinstance(overrides, dict):
+            raise ValueError(f'Variant "{name}": overrides must be a map')
+        variants.append((str(name), overrides))
+    names = [name for name, _ in variants]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f'Duplicate variant name(s): {sorted(duplicates)}')
+    return variants
+
+
+def _check_overrides(config, name, overrides):
+    """
+    Check that the validated overrides of a variant can be swept.
+    """
+    for key in overrides:
+        if _is_upstream_key(key):
+            raise ValueError(
+                f'Variant "{name}": parameter "{key}" is used for processing '
+                'traces or building spectra and cannot be swept')
+    weighting = overrides.get('weighting', config.weighting)
+    if (weighting == 'noise') != (config.weighting == 'noise'):
+        raise ValueError(
+            f'Variant "{name}": "weighting" cannot be changed from '
+            f'"{config.weighting}" to "{weighting}", since "noise" weighting '
+            'is also used for processing traces and building spectra. '
+            'Run a separate sweep with "weighting" set to '
+            f'"{weighting}" in the config file')
+
+
+def read_sweep_file(config):
+    """
+    Read and validate the sweep file given on the command line.
+
+    :param config: SSP configuration object
+    :type config: config.Config
+    :return: A list of (name, overrides) tuples. The first variant, named
+        "base", has no overrides.
+    :rtype: list
+    """
+    sweep_file = config.options.sweep_file
+    try:
+        variants = _read_variants(sweep_file)
+        # all the overrides are validated at once against the configspec
+        validated = validate_config_values({
+            f'Variant "{name}"': overrides for name, overrides in variants})
+        variants = [
+            (name, validated[f'Variant "{name}"']) for name, _ in variants]
+        for name, overrides in variants:
+            _check_overrides(config, name, overrides)
+    except ValueError as msg:
+        logger.error(f'{sweep_file}: {msg}')
+        ssp_exit(1)
+    logger.info(
+        f'Parameter sweep: {len(variants)} variants read from {sweep_file}')
+    return variants
+
+
+def _variant_config(config, overrides):
+    """Build the config object of a variant."""
+    variant_config = Config(config.copy())
+    for key, value in overrides.items():
+        variant_config[key] = value
+    for key, value in VARIANT_CONFIG.items():
+        variant_config[key] = value
+    variant_config.figures = defaultdict(list)
+    return variant_config
+
+
+def _init_worker(spec_st, specnoise_st, weight_st):
+    """Store the spectral streams shared by all the variants."""
+    _SPECTRA['spec_st'] = spec_st
+    _SPECTRA['specnoise_st'] = specnoise_st
+    _SPECTRA['weight_st'] = weight_st
+
+
+@contextlib.contextmanager
+def _quiet_logging():
+    """Only log warnings and errors while running a variant."""
+    logger_root = logging.getLogger()
+    level = logger_root.level
+    logger_root.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        logger_root.setLevel(level)
+
+
+def _run_variant(name, config, overrides):
+    """
+    Run the inversion, the radiated energy and the summary statistics for
+    a variant.
+
+    Return a dictionary with the variant results.
+    """
+    # spectral_inversion() appends synthetic spectra to spec_st:
+    # work on a copy, so that spectra can be reused by other variants
+    spec_st = _SPECTRA['spec_st'].copy()
+    specnoise_st = _SPECTRA['specnoise_st']
+    weight_st = _SPECTRA['weight_st']
+    row = {'variant': name, 'overrides': overrides, 'nobs': 0}
+    with _quiet_logging():
+        if any(key in WEIGHT_CONFIG_KEYS for key in overrides):
+            weight_st = _build_weight_spectral_stream(
+                config, spec_st, specnoise_st)
+        sspec_output = spectral_inversion(config, spec_st, weight_st)
+        if len(sspec_output.station_parameters) == 0:
+            # compute_summary_statistics() would exit
+            return row
+        radiated_energy_and_apparent_stress(
+            config, spec_st, specnoise_st, sspec_output)
+        compute_summary_statistics(config, sspec_output)
+    values = sspec_output.reference_values()
+    uncertainties = sspec_output.reference_uncertainties()
+    row['nobs'] = len(sspec_output.station_parameters)
+    for param in SWEEP_PARAMS:
+        err_minus, err_plus = uncertainties.get(param, (None, None))
+        row[param] = values.get(param)
+        row[f'{param}_err_minus'] = err_minus
+        row[f'{param}_err_plus'] = err_plus
+    return row
+
+
+def _run_variants(config, variants, spectra):
+    """Run all the variants, in parallel if possible."""
+    n_jobs = config.options.sweep_jobs or os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs, len(variants)))
+    logger.info(
+        f'Running {len(variants)} variants on {n_jobs} parallel job(s)...')
+    variant_configs = [
+        (name, _variant_config(config, overrides), overrides)
+        for name, overrides in variants
+    ]
+    rows = {}
+    if n_jobs == 1:
+        _init_worker(*spectra)
+        for name, variant_config, overrides in variant_configs:
+            rows[name] = _run_variant(name, variant_config, overrides)
+            _log_row(rows[name])
+    else:
+        with ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker,
+                initargs=spectra) as executor:
+            futures = {
+                executor.submit(_run_variant, *args): args[0]
+                for args in variant_configs
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    rows[name] = future.result()
+                except Exception as msg:
+                    logger.warning(f'Variant "{name}" failed: {msg}')
+                    rows[name] = {
+                        'variant': name, 'overrides': dict(variants)[name],
+                        'nobs': 0}
+                _log_row(rows[name])
+    # keep the variant order of the sweep file
+    return [rows[name] for name, _ in variants]
+
+
+def _log_row(row):
+    """Log a short summary of the results of a variant."""
+    name = row['variant']
+    if not row['nobs']:
+        logger.warning(f'Variant "{name}": no source parameter calculated')
+        return
+    logger.info(
+        f'Variant "{name}": nobs: {row["nobs"]}, '
+        f'Mw: {row["Mw"]:.2f}, fc: {row["fc"]:.3f}, '
+        f't_star: {row["t_star"]:.3f}')
+
+
+def _table_columns():
+    """Return the names of the result columns of the comparison table."""
+    columns = ['nobs']
+    for param in SWEEP_PARAMS:
+        columns += [param, f'{param}_err_minus', f'{param}_err_plus']
+    return columns
+
+
+def _write_csv(config, rows):
+    """Write the comparison table to a CSV file."""
+    evid = config.event.event_id
+    csv_file = os.path.join(config.options.outdir, f'{evid}.sweep.csv')
+    # one column per swept parameter
+    override_keys = []
+    for row in rows:
+        override_keys += [
+            key for key in row['overrides'] if key not in override_keys]
+    fieldnames = ['variant'] + override_keys + _table_columns()
+    with open(csv_file, 'w', encoding='utf-8', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=fieldnames, restval='')
+        writer.writeheader()
+        for row in rows:
+            csv_row = {
+                key: value for key, value in row.items()
+                if key != 'overrides'}
+            csv_row.update(row['overrides'])
+            writer.writerow(csv_row)
+    logger.info(f'Sweep results written to file: {csv_file}')
+
+
+def _write_sqlite(config, rows):
+    """Write the comparison table to a SQLite file ("Sweep" table)."""
+    evid = config.event.event_id
+    runid = config.options.run_id
+    db_file = os.path.join(config.options.outdir, f'{evid}.sweep.sqlite')
+    columns = _table_columns()
+    column_defs = ', '.join(
+        f'{col} INT' if col == 'nobs' else f'{col} REAL' for col in columns)
+    sql_create = (
+        'CREATE TABLE IF NOT EXISTS Sweep '
+        '(evid TEXT, runid TEXT, variant TEXT, overrides TEXT, '
+        f'{column_defs}, PRIMARY KEY(evid, runid, variant));'
+    )
+    placeholders = ', '.join('?' * (len(columns) + 4))
+    sql_insert = f'INSERT OR REPLACE INTO Sweep VALUES ({placeholders});'
+    values = [
+        (evid, runid, row['variant'],
+         json.dumps(row['overrides'], default=str)) +
+        tuple(row.get(col) for col in columns)
+        for row in rows
+    ]
+    try:
+        conn = sqlite3.connect(db_file, timeout=60)
+        with conn:
+            conn.execute(sql_create)
+            conn.executemany(sql_insert, values)
+        conn.close()
+    except sqlite3.Error as msg:
+        logger.error(f'Unable to write sweep results to {db_file}: {msg}')
+        return
+    logger.info(f'Sweep results written to file: {db_file}')
+
+
+def run_sweep(config, spec_st, specnoise_st, weight_st, variants):
+    """
+    Run a parameter sweep on the spectra of an event.
+
+    :param config: SSP configuration object
+    :type config: config.Config
+    :param spec_st: Stream of spectra
+    :type spec_st: obspy.core.stream.Stream
+    :param specnoise_st: Stream of noise spectra
+    :type specnoise_st: obspy.core.stream.Stream
+    :param weight_st: Stream of spectral weights
+    :type weight_st: obspy.core.stream.Stream
+    :param variants: List of (name, overrides) tuples, as returned by
+        :func:`read_sweep_file`
+    :type variants: list
+    """
+    logger.info('Running parameter sweep...')
+    rows = _run_variants(config, variants, (spec_st, specnoise_st, weight_st))
+    if not os.path.exists(config.options.outdir):
+        os.makedirs(config.options.outdir)
+    _write_csv(config, rows)
+    _write_sqlite(config, rows)
+    logger.info('Running parameter sweep: done')
+    logger.info('---------------------------------------------------')
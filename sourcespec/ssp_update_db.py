@@ -4,6 +4,18 @@
 """
 Update an existing SourceSpec database from a previous version.
 
+The database is updated by a sequence of migration steps, one per version
+(see ``MIGRATIONS``), each one committed separately.
+
+Tables are changed in place, using ``ALTER TABLE``, whenever possible.
+When a table must be rebuilt (e.g., because its primary key changed), rows
+are copied to the new table in batches of rowids, each one in its own
+transaction. The progress is stored in the database, so that an
+interrupted update can be resumed by running it again.
+
+Before updating, a backup copy of the database is made using the SQLite
+online backup API, a few pages at a time.
+
 :copyright:
     2013-2023 Claudio Satriano <satriano@ipgp.fr>
 :license:
@@ -12,24 +24,37 @@ Update an existing SourceSpec database from a previous version.
 """
 import os
 import sys
-import shutil
 import sqlite3
+import contextlib
 from sourcespec.ssp_db_definitions import (
     DB_VERSION,
-    STATIONS_TABLE, STATIONS_PRIMARY_KEYS, EVENTS_TABLE, EVENTS_PRIMARY_KEYS)
+    STATIONS_TABLE, STATIONS_PRIMARY_KEYS, STATIONS_INDEXES,
+    EVENTS_TABLE, EVENTS_PRIMARY_KEYS, EVENTS_INDEXES)
+from sourcespec.ssp_db_summary import rebuild_summary_tables
+
+# Number of rowids copied in each transaction, when rebuilding a table
+MIGRATION_BATCH_SIZE = 50000
+# Number of database pages copied at each step of the backup
+BACKUP_PAGES_PER_STEP = 4096
+# Table storing the progress of table rebuilds, to resume them
+PROGRESS_TABLE = 'UpdateProgress'
+# Table marking an update in progress, storing the version before the update
+IN_PROGRESS_TABLE = 'UpdateInProgress'
 
 
 def _open_sqlite_db(db_file):
     """
     Open SQLite database.
 
+    Transactions are explicitly managed by the migration steps.
+
     :param db_file: SQLite database file
     :type db_file: str
     :return: SQLite connection and cursor
     :rtype: tuple
     """
     try:
-        conn = sqlite3.connect(db_file, timeout=60)
+        conn = sqlite3.connect(db_file, timeout=60, isolation_level=None)
     except Exception as msg:
         sys.stderr.write(f'{msg}\n')
         sys.stderr.write(
@@ -56,6 +81,286 @@ def _get_db_version(cursor, db_file):
         sys.exit(1)
 
 
+@contextlib.contextmanager
+def _transaction(cursor):
+    """
+    Run the enclosed statements in a single transaction.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    """
+    cursor.execute('BEGIN IMMEDIATE;')
+    try:
+        yield cursor
+    except BaseException:
+        cursor.execute('ROLLBACK;')
+        raise
+    cursor.execute('COMMIT;')
+
+
+def _print_progress(label, done, total):
+    """
+    Print the progress of a long operation on a single line.
+
+    :param label: Operation label
+    :type label: str
+    :param done: Amount of work done
+    :type done: int
+    :param total: Total amount of work
+    :type total: int
+    """
+    percent = 100 * done / total if total else 100
+    end = '\n' if done >= total else ''
+    print(f'\r  {label}: {percent:5.1f}%', end=end, flush=True)
+
+
+def _backup_db(conn, backup_file):
+    """
+    Make a backup copy of the database, using the SQLite online backup API.
+
+    The database is copied a few pages at a time, so that other
+    connections are not blocked during the whole copy.
+
+    :param conn: SQLite connection
+    :type conn: sqlite3.Connection
+    :param backup_file: Backup file
+    :type backup_file: str
+    """
+    def _progress(_status, remaining, total):
+        _print_progress('Backup', total - remaining, total)
+
+    backup_conn = sqlite3.connect(backup_file)
+    try:
+        conn.backup(
+            backup_conn, pages=BACKUP_PAGES_PER_STEP, progress=_progress)
+    finally:
+        backup_conn.close()
+
+
+def _table_info(cursor, table):
+    """
+    Get column names and primary keys of a table.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param table: Table name
+    :type table: str
+    :return: List of column names, list of primary keys
+    :rtype: tuple
+    """
+    info = cursor.execute(f'PRAGMA table_info({table});').fetchall()
+    columns = [row[1] for row in info]
+    primary_keys = [row[1] for row in sorted(info, key=lambda r: r[5])
+                    if row[5] > 0]
+    return columns, primary_keys
+
+
+def _table_exists(cursor, table):
+    """
+    Check if a table exists.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param table: Table name
+    :type table: str
+    :return: True if the table exists
+    :rtype: bool
+    """
+    return cursor.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name=?;",
+        (table, )).fetchone() is not None
+
+
+def _rebuild_in_progress(cursor, table):
+    """
+    Check if the rebuild of a table was interrupted.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param table: Table name
+    :type table: str
+    :return: Progress row (table, last rowid, max rowid) or None
+    :rtype: tuple
+    """
+    if not _table_exists(cursor, PROGRESS_TABLE):
+        return None
+    return cursor.execute(
+        f'SELECT * FROM {PROGRESS_TABLE} WHERE tablename=?;',
+        (table, )).fetchone()
+
+
+def _update_in_progress(cursor):
+    """
+    Check if a previous update was interrupted.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :return: Database version before the interrupted update, or None
+    :rtype: int
+    """
+    if not _table_exists(cursor, IN_PROGRESS_TABLE):
+        return None
+    row = cursor.execute(
+        f'SELECT from_version FROM {IN_PROGRESS_TABLE};').fetchone()
+    return None if row is None else row[0]
+
+
+def _alter_table(cursor, table, table_def, renamed_columns, columns):
+    """
+    Update a table in place: rename columns and add new columns.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param table: Table name
+    :type table: str
+    :param table_def: New table definition {column: type}
+    :type table_def: dict
+    :param renamed_columns: Renamed columns {old name: new name}
+    :type renamed_columns: dict
+    :param columns: Current column names
+    :type columns: list
+    """
+    statements = [
+        f'ALTER TABLE {table} RENAME COLUMN {old} TO {new};'
+        for old, new in renamed_columns.items() if old in columns]
+    new_columns = [renamed_columns.get(col, col) for col in columns]
+    statements += [
+        f'ALTER TABLE {table} ADD COLUMN {col} {col_type};'
+        for col, col_type in table_def.items() if col not in new_columns]
+    if not statements:
+        return
+    with _transaction(cursor):
+        for statement in statements:
+            cursor.execute(statement)
+
+
+def _rebuild_table(cursor, table, table_def, primary_keys, renamed_columns,
+                   indexes):
+    """
+    Rebuild a table, copying rows in batches of rowids.
+
+    Each batch is copied in its own transaction, together with the progress
+    of the copy: if interrupted, the rebuild restarts from the last batch.
+    Rows written during the rebuild are copied in the final transaction,
+    which replaces the old table with the new one.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param table: Table name
+    :type table: str
+    :param table_def: New table definition {column: type}
+    :type table_def: dict
+    :param primary_keys: New primary keys
+    :type primary_keys: list
+    :param renamed_columns: Renamed columns {old name: new name}
+    :type renamed_columns: dict
+    :param indexes: Secondary indexes {index name: columns}
+    :type indexes: dict
+    """
+    new_table = f'{table}New'
+    progress = _rebuild_in_progress(cursor, table)
+    if progress is None:
+        sql_create_new_table = (
+            f'CREATE TABLE IF NOT EXISTS {new_table} ('
+            + '\n'.join(
+                [f'{key} {value},' for key, value in table_def.items()]
+            )
+            + 'PRIMARY KEY (' + ', '.join(primary_keys) + ')'
+            + ');'
+        )
+        with _transaction(cursor):
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} ('
+                'tablename TEXT PRIMARY KEY, last_rowid INTEGER, '
+                'max_rowid INTEGER);')
+            cursor.execute(f'DROP TABLE IF EXISTS {new_table};')
+            cursor.execute(sql_create_new_table)
+            max_rowid = cursor.execute(
+                f'SELECT MAX(rowid) FROM {table};').fetchone()[0] or 0
+            cursor.execute(
+                f'INSERT INTO {PROGRESS_TABLE} VALUES (?, ?, ?);',
+                (table, 0, max_rowid))
+        last_rowid = 0
+    else:
+        _, last_rowid, max_rowid = progress
+        print(f'  Resuming rebuild of table {table}')
+    # columns not existing in the old table are left empty.
+    # Each batch is copied in the same transaction as its progress row, so
+    # that a resumed rebuild never copies a row twice: rows whose keys
+    # collide under the new definition make the migration fail.
+    columns, _ = _table_info(cursor, table)
+    old_columns = {renamed_columns.get(col, col): col for col in columns}
+    copied_columns = [col for col in table_def if col in old_columns]
+    sql_copy_rows = (
+        f'INSERT INTO {new_table} ({", ".join(copied_columns)}) '
+        f'SELECT {", ".join(old_columns[col] for col in copied_columns)} '
+        f'FROM {table} WHERE rowid > ? AND rowid <= ? ORDER BY rowid;'
+    )
+    _print_progress(table, last_rowid, max_rowid)
+    while last_rowid < max_rowid:
+        next_rowid = min(last_rowid + MIGRATION_BATCH_SIZE, max_rowid)
+        with _transaction(cursor):
+            cursor.execute(sql_copy_rows, (last_rowid, next_rowid))
+            cursor.execute(
+                f'UPDATE {PROGRESS_TABLE} SET last_rowid=? WHERE tablename=?;',
+                (next_rowid, table))
+        last_rowid = next_rowid
+        _print_progress(table, last_rowid, max_rowid)
+    with _transaction(cursor):
+        max_rowid = cursor.execute(
+            f'SELECT MAX(rowid) FROM {table};').fetchone()[0] or 0
+        cursor.execute(sql_copy_rows, (last_rowid, max_rowid))
+        cursor.execute(f'DROP TABLE {table};')
+        cursor.execute(f'ALTER TABLE {new_table} RENAME TO {table};')
+        for name, index_columns in (indexes or {}).items():
+            cursor.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} '
+                f'ON {table} ({", ".join(index_columns)});')
+        cursor.execute(
+            f'DELETE FROM {PROGRESS_TABLE} WHERE tablename=?;', (table, ))
+
+
+def _migrate_table(cursor, table, table_def, primary_keys,
+                   renamed_columns=None, indexes=None):
+    """
+    Migrate a table to a new definition.
+
+    The table is altered in place if the primary keys did not change and
+    new columns are only appended (the ``INSERT`` statements of
+    ``ssp_sqlite_output`` rely on the column order). Otherwise, it is
+    rebuilt.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    :param table: Table name
+    :type table: str
+    :param table_def: New table definition {column: type}
+    :type table_def: dict
+    :param primary_keys: New primary keys
+    :type primary_keys: list
+    :param renamed_columns: Renamed columns {old name: new name}
+    :type renamed_columns: dict
+    :param indexes: Secondary indexes, recreated if the table is rebuilt
+        {index name: columns}
+    :type indexes: dict
+    """
+    renamed_columns = renamed_columns or {}
+    columns, old_primary_keys = _table_info(cursor, table)
+    new_columns = [renamed_columns.get(col, col) for col in columns]
+    old_primary_keys = [
+        renamed_columns.get(col, col) for col in old_primary_keys]
+    in_place = (
+        _rebuild_in_progress(cursor, table) is None
+        and old_primary_keys == list(primary_keys)
+        and new_columns == list(table_def)[:len(new_columns)]
+    )
+    if in_place:
+        _alter_table(cursor, table, table_def, renamed_columns, columns)
+    else:
+        _rebuild_table(
+            cursor, table, table_def, primary_keys, renamed_columns, indexes)
+
+
 def _version_1_to_2(cursor):
     """
     Update a version 1 database to version 2.
@@ -75,38 +380,15 @@ def _version_1_to_2(cursor):
     #     t_star_is_outlier, Qo_is_outlier, ssd_is_outlier, ra_is_outlier,
     #     Er_err_minus, Er_err_plus, Er_is_outlier
     #     sigma_a, sigma_a_err_minus, sigma_a_err_plus, sigma_a_is_outlier
+    # The table is rebuilt, since the primary keys changed
     renamed_station_keys = {
         'bsd': 'ssd',
         'bsd_err_minus': 'ssd_err_minus',
         'bsd_err_plus': 'ssd_err_plus'
     }
-    list_sql_rename_station_keys = [
-        f'ALTER TABLE Stations RENAME COLUMN {key} TO {value};'
-        for key, value in renamed_station_keys.items()]
-    sql_create_new_stations_table = (
-        'CREATE TABLE IF NOT EXISTS StationsNew ('
-        + '\n'.join(
-            [f'{key} {value},' for key, value in STATIONS_TABLE.items()]
-        )
-        + 'PRIMARY KEY (' + ', '.join(STATIONS_PRIMARY_KEYS) + ')'
-        + ');'
-    )
-    new_station_keys = [
-        'Mo_is_outlier', 'Mw_is_outlier', 'fc_is_outlier', 't_star_is_outlier',
-        'Qo_is_outlier', 'ssd_is_outlier', 'ra_is_outlier',
-        'Er_err_minus', 'Er_err_plus', 'Er_is_outlier',
-        'sigma_a', 'sigma_a_err_minus', 'sigma_a_err_plus',
-        'sigma_a_is_outlier'
-    ]
-    station_keys = ', '.join([
-        key for key in STATIONS_TABLE if key not in new_station_keys])
-    sql_insert_new_station_keys = (
-        f'INSERT INTO StationsNew ({station_keys}) '
-        f'SELECT {station_keys} FROM Stations;'
-    )
-    sql_drop_old_stations_table = 'DROP TABLE Stations;'
-    sql_rename_new_stations_table =\
-        'ALTER TABLE StationsNew RENAME TO Stations;'
+    _migrate_table(
+        cursor, 'Stations', STATIONS_TABLE, STATIONS_PRIMARY_KEYS,
+        renamed_station_keys)
 
     # Events table:
     # New in version 2:
@@ -139,6 +421,7 @@ def _version_1_to_2(cursor):
     #     sigma_a_mean_nobs, sigma_a_wmean_nobs, sigma_a_pctl_nobs,
     #     Ml_wmean, Ml_wmean_err_minus, Ml_wmean_err_plus,
     #     Ml_mean_nobs, Ml_wmean_nobs, Ml_pctl_nobs,
+    # The table is rebuilt, since the primary keys changed
     renamed_event_keys = {
         'bsd_mean': 'ssd_mean',
         'bsd_mean_err_minus': 'ssd_mean_err_minus',
@@ -150,65 +433,53 @@ def _version_1_to_2(cursor):
         'bsd_pctl_err_minus': 'ssd_pctl_err_minus',
         'bsd_pctl_err_plus': 'ssd_pctl_err_plus'
     }
-    list_sql_rename_event_keys = [
-        f'ALTER TABLE Events RENAME COLUMN {key} TO {value};'
-        for key, value in renamed_event_keys.items()]
-    sql_create_new_events_table = (
-        'CREATE TABLE IF NOT EXISTS EventsNew ('
-        + '\n'.join(
-            [f'{key} {value},' for key, value in EVENTS_TABLE.items()]
-        )
-        + 'PRIMARY KEY (' + ', '.join(EVENTS_PRIMARY_KEYS) + ')'
-        + ');'
-    )
-    new_event_keys = [
-        'vp', 'vs', 'rho', 'wave_type',
-        'kp', 'ks',
-        'Mo_mean_nobs', 'Mo_wmean_nobs', 'Mo_pctl_nobs',
-        'Mw_mean_nobs', 'Mw_wmean_nobs', 'Mw_pctl_nobs',
-        'fc_mean_nobs', 'fc_wmean_nobs', 'fc_pctl_nobs',
-        't_star_mean_nobs', 't_star_wmean_nobs', 't_star_pctl_nobs',
-        'Qo_mean_nobs', 'Qo_wmean_nobs', 'Qo_pctl_nobs',
-        'ra_mean_nobs', 'ra_wmean_nobs', 'ra_pctl_nobs',
-        'ssd_mean_nobs', 'ssd_wmean_nobs', 'ssd_pctl_nobs',
-        'Er_wmean', 'Er_wmean_err_minus', 'Er_wmean_err_plus',
-        'Er_mean_nobs', 'Er_wmean_nobs', 'Er_pctl_nobs',
-        'sigma_a_mean', 'sigma_a_mean_err_minus', 'sigma_a_mean_err_plus',
-        'sigma_a_wmean', 'sigma_a_wmean_err_minus', 'sigma_a_wmean_err_plus',
-        'sigma_a_pctl', 'sigma_a_pctl_err_minus', 'sigma_a_pctl_err_plus',
-        'sigma_a_mean_nobs', 'sigma_a_wmean_nobs', 'sigma_a_pctl_nobs',
-        'Ml_wmean', 'Ml_wmean_err_minus', 'Ml_wmean_err_plus',
-        'Ml_mean_nobs', 'Ml_wmean_nobs', 'Ml_pctl_nobs',
-    ]
-    event_keys = ', '.join([
-        key for key in EVENTS_TABLE if key not in new_event_keys])
-    sql_insert_new_event_keys = (
-        f'INSERT INTO EventsNew ({event_keys}) '
-        f'SELECT {event_keys} FROM Events;'
-    )
-    sql_drop_old_events_table = 'DROP TABLE Events;'
-    sql_rename_new_events_table = 'ALTER TABLE EventsNew RENAME TO Events;'
+    _migrate_table(
+        cursor, 'Events', EVENTS_TABLE, EVENTS_PRIMARY_KEYS,
+        renamed_event_keys)
 
-    # execute SQL statements
-    try:
-        # stations table
-        for statement in list_sql_rename_station_keys:
-            cursor.execute(statement)
-        cursor.execute(sql_create_new_stations_table)
-        cursor.execute(sql_insert_new_station_keys)
-        cursor.execute(sql_drop_old_stations_table)
-        cursor.execute(sql_rename_new_stations_table)
-        # events table
-        for statement in list_sql_rename_event_keys:
+
+def _version_2_to_3(cursor):
+    """
+    Update a version 2 database to version 3.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    """
+    # New in version 3:
+    #   - secondary indexes:
+    #     Stations (evid, runid), Events (runid)
+    list_sql_create_indexes = [
+        f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)});'
+        for table, indexes in (
+            ('Stations', STATIONS_INDEXES), ('Events', EVENTS_INDEXES))
+        for name, columns in indexes.items()
+    ]
+    with _transaction(cursor):
+        for statement in list_sql_create_indexes:
             cursor.execute(statement)
-        cursor.execute(sql_create_new_events_table)
-        cursor.execute(sql_insert_new_event_keys)
-        cursor.execute(sql_drop_old_events_table)
-        cursor.execute(sql_rename_new_events_table)
-        cursor.execute('PRAGMA user_version = 2;')
-    except Exception as db_err:
-        sys.stderr.write(f'{db_err}\n')
-        sys.exit(1)
+
+
+def _version_3_to_4(cursor):
+    """
+    Update a version 3 database to version 4.
+
+    :param cursor: SQLite cursor
+    :type cursor: sqlite3.Cursor
+    """
+    # New in version 4:
+    #   - summary tables:
+    #     SummaryEvents, SummaryBins, SummaryFits
+    with _transaction(cursor):
+        rebuild_summary_tables(cursor)
+
+
+# Migration steps: {version: function updating from version to version+1}
+# A step can be run again, if the update was interrupted
+MIGRATIONS = {
+    1: _version_1_to_2,
+    2: _version_2_to_3,
+    3: _version_3_to_4,
+}
 
 
 def _overwrite_ok(db_file):
@@ -232,26 +503,69 @@ def update_db_file(db_file):
     """
     Update an existing SourceSpec database from a previous version.
 
+    If a previous update was interrupted, it is resumed (and the backup
+    copy, made before the previous update, is kept).
+
     :param db_file: SQLite database file
     :type db_file: str
     """
     if not _overwrite_ok(db_file):
         return
-    print(f'Updating {db_file}...')
     conn, cursor = _open_sqlite_db(db_file)
     db_version = _get_db_version(cursor, db_file)
-    if db_version == 1:
-        # create a backup copy
-        shutil.copy2(db_file, f'{db_file}.bak')
-        _version_1_to_2(cursor)
-        print(
-            f'{db_file} updated from version {db_version} '
-            f'to version {DB_VERSION}.')
-    elif db_version == DB_VERSION:
+    from_version = _update_in_progress(cursor)
+    resuming = from_version is not None
+    if db_version == DB_VERSION and not resuming:
         print(f'{db_file} is already up-to-date.')
         sys.exit(0)
-    else:
+    if db_version not in MIGRATIONS and db_version != DB_VERSION:
         print(f'ERROR: {db_file} has an unsupported version {db_version}.')
         sys.exit(1)
-    conn.commit()
+    if resuming:
+        # the backup copy was made before the interrupted update:
+        # it must not be overwritten
+        print(
+            f'Resuming interrupted update of {db_file} '
+            f'(from version {from_version})...')
+    else:
+        from_version = db_version
+        print(f'Saving a backup copy to {db_file}.bak...')
+        _backup_db(conn, f'{db_file}.bak')
+        print(f'Updating {db_file}...')
+        # the marker is removed only once all the steps are done
+        with _transaction(cursor):
+            cursor.execute(
+                f'CREATE TABLE {IN_PROGRESS_TABLE} (from_version INTEGER);')
+            cursor.execute(
+                f'INSERT INTO {IN_PROGRESS_TABLE} VALUES (?);',
+                (from_version, ))
+    version = db_version
+    try:
+        while version < DB_VERSION:
+            MIGRATIONS[version](cursor)
+            version += 1
+            cursor.execute(f'PRAGMA user_version = {version:d};')
+        with _transaction(cursor):
+            cursor.execute(f'DROP TABLE IF EXISTS {PROGRESS_TABLE};')
+            cursor.execute(f'DROP TABLE IF EXISTS {IN_PROGRESS_TABLE};')
+    except sqlite3.IntegrityError as db_err:
+        print()
+        sys.stderr.write(f'{db_err}\n')
+        sys.stderr.write(
+            f'Unable to update {db_file} from version {version}: '
+            'some rows are not compatible with the new table definition. '
+            f'The original database is saved in {db_file}.bak.\n')
+        conn.close()
+        sys.exit(1)
+    except (sqlite3.Error, KeyboardInterrupt) as db_err:
+        print()
+        sys.stderr.write(f'{db_err}\n')
+        sys.stderr.write(
+            f'Update of {db_file} interrupted at version {version}. '
+            'Run the update again to resume it.\n')
+        conn.close()
+        sys.exit(1)
+    print(
+        f'{db_file} updated from version {from_version} '
+        f'to version {DB_VERSION}.')
     conn.close()